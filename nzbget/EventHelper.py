@@ -30,10 +30,11 @@
 ##############################################################################
 ### OPTIONS                                                                ###
 
-# Enable or disable the script from executing (Enabled, Disabled, Debug).
+# Enable or disable the script from executing (Enabled, Disabled, Debug, Profile).
 #
 # Allows global execution of the script to be disabled without removing the
-# script from various events.
+# script from various events. Profile records how long each event takes in
+# nzbprofile.json in NZBGet's TempDir.
 #
 #ScriptState=Enabled
 
@@ -56,7 +57,6 @@
 import nzb
 import os
 import sys
-import traceback
 
 # Options
 ##############################################################################
@@ -191,7 +191,7 @@ def main():
         # and executes any event handlers.
         nzb.execute()
     except Exception as e:
-        traceback.print_exc()
+        nzb.log_traceback()
         nzb.exit(nzb.PROCESS_ERROR, e)
 
     nzb.exit(nzb.PROCESS_SUCCESS)
@@ -34,10 +34,11 @@
 ##############################################################################
 ### OPTIONS                                                                ###
 
-# Enable or disable the script from executing (Enabled, Disabled, Debug).
+# Enable or disable the script from executing (Enabled, Disabled, Debug, Profile).
 #
 # Allows global execution of the script to be disabled without removing the
-# script from various events.
+# script from various events. Profile records how long each event takes in
+# nzbprofile.json in NZBGet's TempDir.
 #
 #ScriptState=Enabled
 
@@ -47,52 +48,192 @@
 #
 #CategoryLocations=Other:/share/Media/Other
 
+# Verify files copied to another filesystem (Enabled, Disabled).
+#
+# Files on the same filesystem are only renamed. Otherwise they are cloned
+# when the filesystem supports it, or copied, and a copy is read back and
+# checked against the CRC taken while copying.
+#
+#VerifyMoves=Enabled
+
+# Lowest level of messages written to the log (DEBUG, DETAIL, INFO, WARNING, ERROR).
+#
+# Defaults to DEBUG when ScriptState is Debug, and DETAIL otherwise.
+#
+#LogLevel=
+
+# Also write the log to a JSON lines file.
+#
+# Each message is written as a JSON object with the time, seconds since the
+# script started, level, script, event and thread. Relative paths are in
+# NZBGet's TempDir. Leave empty to disable.
+#
+#LogFile=
+
+# Save a cProfile dump of each event type when profiling (Enabled, Disabled).
+#
+# With ScriptState set to Profile, the dumps are written to NZBGet's TempDir
+# as profile-<script>-<event>.prof.
+#
+#ProfileDump=Disabled
+
+# Record each event to a JSON lines trace for nzbreplay.py.
+#
+# Each record holds the event's environment, with passwords and usernames
+# left out, every line the script wrote to NZBGet and its exit code.
+# Relative paths are in NZBGet's TempDir. Leave empty to disable.
+#
+#TraceFile=
+
+# Sets how long the shared queue/history snapshot is reused (seconds).
+#
+# Scripts share one copy of the NZBGet queue and history lists, which is
+# fetched again at most once per interval.
+#
+#SnapshotTTL=30
+
+# Run events in a resident worker process (Enabled, Disabled).
+#
+# Hands each event to a long-lived worker instead of starting a new Python
+# interpreter for it. The worker is started on the first event and stops
+# after 10 minutes without events. Events run in-process whenever the worker
+# isn't available.
+#
+#ResidentWorker=Disabled
+
 ### NZBGET SCHEDULER/POST-PROCESSING SCRIPT                                ###
 ##############################################################################
 
 
+# Resident worker
+##############################################################################
+# Hand the event to the resident worker when it's enabled. This needs to run
+# before anything else is imported.
+import nzbworker
+nzbworker.forward(__file__)
+
+
 # Imports
 ##############################################################################
 import nzb
-import operator
 import os
 import shutil
 import sys
-import traceback
+import time
 
 
 # Options
 ##############################################################################
 SCRIPT_STATE=nzb.get_script_option('ScriptState')
+SCRIPT_NAME='FileMover'
 CATEGORIES=nzb.get_script_option_dictionary('CategoryLocations')
+VERIFY_MOVES=nzb.get_script_option('VerifyMoves') != 'Disabled'
+
+
+# Constants
+##############################################################################
+STATE_HISTORY_CURSOR='history-cursor'
+
+# Folders that are never searched for the largest video file.
+JUNK_DIRECTORIES=[
+    '_unpack',
+    'backup',
+    'certificate',
+    'extras',
+    'featurettes',
+    'proof',
+    'sample',
+    'samples',
+    'screens',
+]
 
 
 # Handle scheduled
 ##############################################################################
 def on_scheduled():
+    """
+    Hands the history pass to the FileMover that is already running one, if
+    any, since a single pass covers everything that was added.
+    """
+    if not nzb.run_queued_work(SCRIPT_NAME, [{ 'kind' : 'history' }], process_work):
+        nzb.log_info('Another FileMover is running and will pick this up.')
+
+
+def process_work(items):
+    # Any number of queued passes are covered by one.
+    hide_histories()
+
+
+# Handle post processing
+##############################################################################
+def on_post_processing():
+    """
+    Moves the download right away rather than queuing it, since NZBGet only
+    takes the final directory from the script that post-processes the NZB.
+    """
+    directory = nzb.get_nzb_directory()
+    category = nzb.get_nzb_category()
+
+    move_download(directory, category)
+
+
+# Hides the NZBs whose files were moved from the history.
+##############################################################################
+def hide_histories():
+    """
+    Only looks at the history entries that were added since the last run,
+    remembering the newest HistoryTime and the NZBIDs seen in that second.
+    HistoryTime only has whole seconds, so an entry added later in the same
+    second is still picked up. The cursor only moves once the matches were
+    hidden, so a failed edit is tried again.
+    """
     categories = get_categories()
-    proxy = nzb.proxy()
-    histories = proxy.history()
+    cursor = nzb.get_script_state(SCRIPT_NAME, STATE_HISTORY_CURSOR, None) or { 'time' : 0 }
+    last_time = cursor['time']
+    last_nzbids = set(cursor.get('nzbids', []))
+    newest_time = last_time
+    newest_nzbids = set(last_nzbids)
 
     nzb.log_info('Processing histories...')
 
-    for history in histories:
+    nzbids = []
+    for history in nzb.get_history():
+        history_time = int(history.get('HistoryTime', 0))
+        nzbid = int(history['NZBID'])
+
+        if history_time < last_time or (history_time == last_time and nzbid in last_nzbids):
+            continue
+
+        if history_time > newest_time:
+            newest_time = history_time
+            newest_nzbids = set()
+        if history_time == newest_time:
+            newest_nzbids.add(nzbid)
+
         category = history['Category']
         finaldir = history['FinalDir']
         status = history['Status']
-        nzbid = int(history['NZBID'])
         if finaldir and category in categories and status == 'SUCCESS/ALL':
-            if not proxy.editqueue('HistoryDelete', 0, '', [nzbid]):
-                nzb.log_warning('Failed to mark %s as hidden.' % nzbid)
+            nzbids.append(nzbid)
 
-    nzb.log_info('Completed processing histories.')
+    # Hide all of the matches with a single edit.
+    if nzbids:
+        if not nzb.editqueue('HistoryDelete', nzbids):
+            nzb.log_warning('Failed to mark %s as hidden.' % nzbids)
+            return
 
+        nzb.invalidate_snapshot('history')
 
-# Handle post processing
+    if (newest_time, newest_nzbids) != (last_time, last_nzbids):
+        nzb.set_script_state(SCRIPT_NAME, STATE_HISTORY_CURSOR,
+            { 'time' : newest_time, 'nzbids' : sorted(newest_nzbids) })
+
+    nzb.log_info('Completed processing histories, hid %s.' % len(nzbids))
+
+
+# Moves the largest video file of a download.
 ##############################################################################
-def on_post_processing():
-    directory = nzb.get_nzb_directory()
-    category = nzb.get_nzb_category()
+def move_download(directory, category):
     target = get_category_path(category)
 
     if os.path.isdir(directory) and target:
@@ -108,8 +249,10 @@ def on_post_processing():
             if os.path.isfile(target_path):
                 nzb.log_warning('File %s already exists.' % target_path)
             else:
-                nzb.log_detail('Copying %s to %s.' % (file, target_path))
-                shutil.copyfile(source_path, target_path)
+                nzb.log_detail('Moving %s to %s.' % (file, target_path))
+                start = time.time()
+                method = nzb.move_file(source_path, target_path, VERIFY_MOVES)
+                nzb.log_detail('Moved %s (%s) in %.1f seconds.' % (file, method, time.time() - start))
                 nzb.set_nzb_directory_final(target)
 
             shutil.rmtree(directory)
@@ -121,25 +264,21 @@ def on_post_processing():
 
 
 def get_largest_file(category, directory, target):
-    accepted_files = {}
-    populate_filelist(category, directory, target, accepted_files)
-
-    if len(accepted_files) > 0:
-        accepted_files_by_size = sorted(accepted_files.items(), key=operator.itemgetter(1), reverse=True)
-        largest = accepted_files_by_size[0]
-        return largest[0]
-
-    return None
+    """
+    Keeps only the largest video file seen so far while walking the tree,
+    leaving out samples, extras and the other folders that never hold the
+    main video.
+    """
+    largest = None
+    largest_size = -1
 
+    for filepath, size in nzb.iter_files(directory, JUNK_DIRECTORIES):
+        extension = os.path.splitext(filepath)[1].lower()
+        if size > largest_size and extension in nzb.MEDIA_EXTENSIONS:
+            largest = filepath
+            largest_size = size
 
-def populate_filelist(category, directory, target, accepted_files):
-    for file in os.listdir(directory):
-        filepath = os.path.join(directory, file)
-        filename, extension = os.path.splitext(file)
-        if os.path.isfile(filepath) and extension in nzb.MEDIA_EXTENSIONS:
-            accepted_files[filepath] = os.path.getsize(filepath)
-        elif os.path.isdir(filepath):
-            populate_filelist(category, filepath, target, accepted_files)
+    return largest
 
 
 def get_categories():
@@ -164,7 +303,7 @@ def clean_up():
     """
     Perform any script cleanup that is required here.
     """
-    nzb.lock_release('FileMover')
+    nzb.lock_release(SCRIPT_NAME)
 
 
 # Main entry-point
@@ -183,13 +322,6 @@ def main():
         # Check the status before we decide if we can continue.
         nzb.check_nzb_status()
 
-        # Check if lock exists.
-        if nzb.lock_exists('FileMover'):
-            nzb.log_info('Lock exists, skipping execution.')
-            nzb.exit(nzb.PROCESS_SUCCESS)
-        else:
-            nzb.lock_create('FileMover')
-
         # Check version of NZBGet to make sure we can run.
         nzb.check_nzb_version(13.0)
 
@@ -202,7 +334,7 @@ def main():
         # and executes any event handlers.
         nzb.execute()
     except Exception as e:
-        traceback.print_exc()
+        nzb.log_traceback()
         nzb.exit(nzb.PROCESS_ERROR, e)
     finally:
         clean_up()
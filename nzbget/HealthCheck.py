@@ -20,7 +20,7 @@
 #
 
 ##############################################################################
-### NZBGET SCHEDULER/POST-PROCESSING SCRIPT                                ###
+### NZBGET SCHEDULER/QUEUE/POST-PROCESSING SCRIPT                          ###
 
 # Checks for completion of NZB files that fail due to FAILURE/HEALTH.
 #
@@ -33,10 +33,11 @@
 ##############################################################################
 ### OPTIONS                                                                ###
 
-# Enable or disable the script from executing (Enabled, Disabled, Debug).
+# Enable or disable the script from executing (Enabled, Disabled, Debug, Profile).
 #
 # Allows global execution of the script to be disabled without removing the
-# script from various events.
+# script from various events. Profile records how long each event takes in
+# nzbprofile.json in NZBGet's TempDir.
 #
 #ScriptState=Enabled
 
@@ -54,25 +55,128 @@
 # Sets the amount of time to multiple each retry before trying to unpause
 # the file and resume (minutes).
 #
-# NOTE: The algorithm is based on a push-out timer. The first retry will
-# wait 10 (default) minutes. Each subsequent retry will be (X * count);
-# so for example, the third retry will wait 30 minutes before resuming.
+# NOTE: The algorithm adapts to how quickly the articles are propagating.
+# The first retry will wait 10 (default) minutes. While the health keeps
+# improving between retries, it keeps retrying every 10 minutes; each retry
+# that doesn't improve the health doubles the wait instead.
 #
 #RetryMinutes=10
 
-### NZBGET SCHEDULER/POST-PROCESSING SCRIPT                                ###
+# Sets the number of retries in a row that may go without the health
+# improving before giving up (count).
+#
+#StallLimit=3
+
+# What to do with an NZB that par2 can no longer repair (Pause, Delete, Disabled).
+#
+# While files download, the failed article bytes are compared with the
+# recovery blocks in the NZB's par2 volumes. Once the failed bytes are more
+# than the par2 volumes can restore, the rest of the download is wasted, so
+# the NZB is paused or deleted right away instead of after post-processing.
+#
+#RepairCheck=Disabled
+
+# Check that the articles of a new NZB exist before it downloads
+# (Pause, Defer, Disabled).
+#
+# When an NZB is added, a random sample of its articles is looked up on the
+# news server with pipelined STAT commands. If too few of them exist, the NZB
+# is paused, or with Defer, paused and resumed after RetryMinutes so that the
+# articles have time to propagate.
+#
+#CompletionCheck=Disabled
+
+# Percentage of the sampled articles that must exist (0-100).
+#
+#CompletionMinimum=95
+
+# Number of articles sampled from each NZB.
+#
+#CompletionSample=200
+
+# Number of connections used to check the articles (1-8).
+#
+# Never more than the Connections set for the news server in NZBGet.
+#
+#CompletionConnections=2
+
+# News server used to check the articles (host:port).
+#
+# Leave empty to use the first active server from the NZBGet settings.
+#
+#CompletionServer=
+
+# Check the certificate of an encrypted news server (Enabled, Disabled).
+#
+# The certificate and host name are checked against the system's
+# certificates, or the CertStore set in NZBGet. Only disable this for a
+# server with a self-signed certificate that you trust.
+#
+#CompletionCertCheck=Enabled
+
+# Lowest level of messages written to the log (DEBUG, DETAIL, INFO, WARNING, ERROR).
+#
+# Defaults to DEBUG when ScriptState is Debug, and DETAIL otherwise.
+#
+#LogLevel=
+
+# Also write the log to a JSON lines file.
+#
+# Each message is written as a JSON object with the time, seconds since the
+# script started, level, script, event and thread. Relative paths are in
+# NZBGet's TempDir. Leave empty to disable.
+#
+#LogFile=
+
+# Save a cProfile dump of each event type when profiling (Enabled, Disabled).
+#
+# With ScriptState set to Profile, the dumps are written to NZBGet's TempDir
+# as profile-<script>-<event>.prof.
+#
+#ProfileDump=Disabled
+
+# Record each event to a JSON lines trace for nzbreplay.py.
+#
+# Each record holds the event's environment, with passwords and usernames
+# left out, every line the script wrote to NZBGet and its exit code.
+# Relative paths are in NZBGet's TempDir. Leave empty to disable.
+#
+#TraceFile=
+
+# Sets how long the shared queue/history snapshot is reused (seconds).
+#
+# Scripts share one copy of the NZBGet queue and history lists, which is
+# fetched again at most once per interval.
+#
+#SnapshotTTL=30
+
+# Run events in a resident worker process (Enabled, Disabled).
+#
+# Hands each event to a long-lived worker instead of starting a new Python
+# interpreter for it. The worker is started on the first event and stops
+# after 10 minutes without events. Events run in-process whenever the worker
+# isn't available.
+#
+#ResidentWorker=Disabled
+
+### NZBGET SCHEDULER/QUEUE/POST-PROCESSING SCRIPT                          ###
+##############################################################################
+
+
+# Resident worker
 ##############################################################################
+# Hand the event to the resident worker when it's enabled. This needs to run
+# before anything else is imported.
+import nzbworker
+nzbworker.forward(__file__)
 
 
 # Imports
 ##############################################################################
-import datetime
-import json
 import nzb
 import os
 import sys
 import time
-import traceback
 
 
 # Options
@@ -82,6 +186,25 @@ SCRIPT_NAME='HealthCheck'
 AGE_LIMIT=int(nzb.get_script_option('AgeLimit'))
 RETRY_LIMIT=int(nzb.get_script_option('RetryLimit'))
 RETRY_MINUTES=int(nzb.get_script_option('RetryMinutes'))
+STALL_LIMIT=int(nzb.get_script_option('StallLimit') or 3)
+REPAIR_CHECK=nzb.get_script_option('RepairCheck') or 'Disabled'
+COMPLETION_CHECK=nzb.get_script_option('CompletionCheck') or 'Disabled'
+COMPLETION_MINIMUM=float(nzb.get_script_option('CompletionMinimum') or 95)
+COMPLETION_SAMPLE=int(nzb.get_script_option('CompletionSample') or 200)
+COMPLETION_CONNECTIONS=int(nzb.get_script_option('CompletionConnections') or 2)
+COMPLETION_SERVER=nzb.get_script_option('CompletionServer')
+COMPLETION_CERT_CHECK=nzb.get_script_option('CompletionCertCheck') != 'Disabled'
+
+
+# Constants
+##############################################################################
+# The health (per-mille) has to improve by at least this much between retries
+# to count as propagation still making progress.
+HEALTH_IMPROVEMENT=10
+
+# Only these groups are still downloading articles.
+REPAIR_STATUSES=['QUEUED', 'DOWNLOADING']
+REPAIR_COMMANDS={ 'Pause' : 'GroupPause', 'Delete' : 'GroupDelete' }
 
 
 # Handles post-processing of the NZB file.
@@ -93,6 +216,9 @@ def on_post_processing():
     status = nzb.get_nzb_status()
 
     if status != 'FAILURE/HEALTH':
+        # Forget any earlier retries, since it's done now.
+        clean_up()
+        nzb.lock_release(SCRIPT_NAME)
         nzb.log_detail('Nothing to do, status was %s.' % status)
         nzb.exit(nzb.PROCESS_SUCCESS)
 
@@ -103,27 +229,75 @@ def on_post_processing():
         nzb.log_detail('Performing health check on %s (%s).' % (nzbname, status))
 
         check_limit_age(nzbid, nzbname)
-        check_limit_retries(nzbid, nzbname)
+        state = check_limit_retries(nzbid, nzbname)
 
         # Stop all other post-processing because we need to requeue the file.
         nzb.log_warning('Pausing %s due to status of %s.' % (nzbname, status))
-        proxy = nzb.proxy()
+        # Pause the file group before sending it back to the queue, so that
+        # it never comes back unpaused.
+        batch = nzb.RpcBatch()
+        pause = batch.editqueue('GroupPause', [nzbid])
 
-        # Pause the file group.
-        if not proxy.editqueue('GroupPause', 0, '', [nzbid]):
+        if batch.execute()[pause] is not True:
             reason = 'Failed to pause %s (%s).' % (nzbname, nzbid)
             nzb.exit(nzb.PROCESS_FAIL_PROXY, reason)
 
-        # Send the file back to the queue.
-        if not proxy.editqueue('HistoryReturn', 0, '', [nzbid]):
+        requeue = batch.editqueue('HistoryReturn', [nzbid])
+
+        if batch.execute()[requeue] is not True:
             reason = 'Failed to requeue %s (%s).' % (nzbname, nzbid)
             nzb.exit(nzb.PROCESS_FAIL_PROXY, reason)
+
+        # The NZB moved from the history back to the queue.
+        nzb.invalidate_snapshot('groups')
+        nzb.invalidate_snapshot('history')
+
+        # Schedule when the scheduler should resume it.
+        nzb.set_deadline(SCRIPT_NAME, nzbid, time.time() + state['wait'] * 60)
+        nzb.log_detail('Resuming %s in %s minutes.' % (nzbname, state['wait']))
     except Exception as e:
-        traceback.print_exc()
+        nzb.log_traceback()
         nzb.exit(nzb.PROCESS_ERROR, e)
     finally:
+        # The state is kept until the NZB succeeds or we give up, since the
+        # retries are counted across attempts.
         nzb.lock_release(SCRIPT_NAME)
-        clean_up()
+
+
+# Handles when an NZB is added to the queue.
+##############################################################################
+def on_nzb_added():
+    if COMPLETION_CHECK not in ['Pause', 'Defer']:
+        return
+
+    nzbid = nzb.get_nzb_id()
+    nzbname = nzb.get_nzb_name()
+    completion = check_completion(nzbname)
+
+    if completion is None or completion >= COMPLETION_MINIMUM:
+        return
+
+    nzb.log_warning('Pausing %s, only %.1f%% of the sampled articles exist.' % (nzbname, completion))
+
+    if not nzb.editqueue('GroupPause', [nzbid]):
+        reason = 'Failed to pause %s (%s).' % (nzbname, nzbid)
+        nzb.exit(nzb.PROCESS_FAIL_PROXY, reason)
+
+    if COMPLETION_CHECK == 'Defer':
+        nzb.set_deadline(SCRIPT_NAME, nzbid, time.time() + RETRY_MINUTES * 60)
+        nzb.log_detail('Resuming %s in %s minutes.' % (nzbname, RETRY_MINUTES))
+
+
+# Handles when a file in the NZB has been downloaded.
+##############################################################################
+def on_file_downloaded():
+    if REPAIR_CHECK not in REPAIR_COMMANDS:
+        return
+
+    group = nzb.get_queue_group(nzb.get_nzb_id())
+
+    if group:
+        check_repair([group])
 
 
 # Handles scheduled tasks.
@@ -133,33 +307,134 @@ def on_scheduled():
     if nzb.lock_exists(SCRIPT_NAME):
         nzb.exit(nzb.PROCESS_SUCCESS)
 
-    groups = nzb.proxy().listgroups(0)
+    resume_due()
+
+    if REPAIR_CHECK in REPAIR_COMMANDS:
+        check_repair(nzb.get_queue_groups())
+
+
+# Resumes the NZBs whose wait has run out.
+##############################################################################
+def resume_due():
+    """
+    Resumes every NZB whose wait has run out with one edit. Only the expired
+    deadlines are read, so there's nothing to do on most runs. The queue is
+    read fresh, since a cached one could miss an NZB that was just sent back
+    to it. A deadline is only dropped once its NZB was resumed or is gone
+    from both the queue and the history.
+    """
+    nzbids = nzb.get_due_deadlines(SCRIPT_NAME)
+
+    if not nzbids:
+        due = nzb.get_next_deadline(SCRIPT_NAME)
+        if due:
+            nzb.log_detail('Next resume is in %s minutes.' % int(max(0, due - time.time()) / 60))
+        return
+
+    groups = dict((int(group['NZBID']), group['NZBName']) for group in nzb.get_queue_groups(ttl=0))
+    resume = [nzbid for nzbid in nzbids if nzbid in groups]
+    missing = [nzbid for nzbid in nzbids if nzbid not in groups]
+
+    if resume:
+        nzb.log_detail('Resuming download for %s.' % ', '.join('%s (%s)' % (groups[nzbid], nzbid) for nzbid in resume))
+
+        if not nzb.editqueue('GroupResume', resume):
+            reason = 'Failed to resume %s.' % resume
+            nzb.exit(nzb.PROCESS_FAIL_PROXY, reason)
+
+        nzb.invalidate_snapshot('groups')
+
+    # NZBs still in the history may be sent back to the queue yet, and the
+    # ones that are gone get a new deadline if they fail again.
+    if missing:
+        history = set(int(item['NZBID']) for item in nzb.get_history(ttl=0))
+        missing = [nzbid for nzbid in missing if nzbid not in history]
+
+    nzb.delete_deadlines(SCRIPT_NAME, resume + missing)
 
+
+# Estimates how much of the NZB exists on the news server.
+##############################################################################
+def check_completion(nzbname):
+    """
+    Looks up a random sample of the NZB's articles and returns the
+    percentage that exists, or None if it couldn't be checked.
+    """
+    filepath = nzb.get_nzb_filepath()
+    server = nzb.get_nntp_server(COMPLETION_SERVER, COMPLETION_CERT_CHECK)
+
+    if not filepath or not server:
+        nzb.log_warning('Unable to check the articles of %s.' % nzbname)
+        return None
+
+    message_ids = nzb.sample_nzb_articles(filepath, COMPLETION_SAMPLE)
+
+    if not message_ids:
+        return None
+
+    try:
+        result = nzb.check_nntp_articles(server, message_ids, max(1, min(COMPLETION_CONNECTIONS, 8)))
+    except IOError as e:
+        nzb.log_warning('Failed to check the articles of %s (%s).' % (nzbname, e))
+        return None
+
+    if not result['checked']:
+        return None
+
+    completion = 100.0 * result['found'] / result['checked']
+    nzb.log_detail('Found %s of %s sampled articles (%.1f%%) for %s on %s.' % (
+        result['found'], result['checked'], completion, nzbname, server['host']))
+
+    return completion
+
+
+# Checks if the downloads can still be repaired.
+##############################################################################
+def check_repair(groups):
+    """
+    Compares the failed bytes of every downloading NZB with what its par2
+    volumes can restore, and pauses or deletes the ones that can't be
+    repaired anymore with one edit. Only NZBs with failed articles need
+    their file lists, which are fetched together.
+    """
+    groups = [group for group in groups
+        if group['Status'] in REPAIR_STATUSES and int(group.get('FailedArticles', 0)) > 0]
+
+    if not groups:
+        return
+
+    batch = nzb.RpcBatch()
     for group in groups:
-        nzbid = int(group['NZBID'])
-        update_filepath = get_update_filepath(nzbid)
+        batch.call('listfiles', 0, 0, int(group['NZBID']))
+
+    doomed = []
 
-        # Look at the next group if we couldn't find it here.
-        if not os.path.isfile(update_filepath): 
+    for group, filelist in zip(groups, batch.execute()):
+        if not isinstance(filelist, list):
             continue
 
-        nzb.log_detail('Found state file at %s.' % update_filepath)
-        timestamp = int(time.mktime(datetime.datetime.utcnow().timetuple()))
-        state = json.load(open(update_filepath, 'r'))
-        state_nzbname = state['nzbname']
-        state_lastcheck = int(state['lastcheck'])
-        state_retries = int(state['retries'])
-        wait_minutes = state_retries * RETRY_MINUTES
-        elapsed_minutes = (timestamp - state_lastcheck) / 60 / 60
-
-        # If the wait time has elapsed, we need to unpause the file.
-        if elapsed_minutes >= wait_minutes:
-            nzb.log_detail('Resuming download for %s (%s).' % (state_nzbname, nzbid))
-            if not nzb.proxy().editqueue('GroupResume', 0, '', [nzbid]):
-                reason = 'Failed to resume %s (%s).' % (state_nzbname, nzbid)
-                nzb.exit(nzb.PROCESS_FAIL_PROXY, reason)
-        else:
-            nzb.log_detail('Waiting for %s minutes, %s minutes elapsed.' % (wait_minutes, elapsed_minutes))
+        budget = nzb.get_repair_budget(group, filelist, group.get('DestDir'))
+
+        if budget['possible'] is None:
+            nzb.log_debug('Skipping repair check for %s, it has no par2 files.', group['NZBName'])
+            continue
+
+        nzb.log_debug('Repair budget for %s: %s failed bytes, %s recovery bytes in %s blocks.',
+            group['NZBName'], budget['failed'], budget['recovery'], budget['blocks'])
+
+        if not budget['possible']:
+            nzb.log_warning('%s can no longer be repaired (%s failed bytes, %s recovery bytes).' % (
+                group['NZBName'], budget['failed'], budget['recovery']))
+            doomed.append(int(group['NZBID']))
+
+    if not doomed:
+        return
+
+    if not nzb.editqueue(REPAIR_COMMANDS[REPAIR_CHECK], doomed):
+        reason = 'Failed to %s %s.' % (REPAIR_CHECK.lower(), doomed)
+        nzb.exit(nzb.PROCESS_FAIL_PROXY, reason)
+
+    nzb.invalidate_snapshot('groups')
 
 
 # Checks if the file is likely to already have been propagated.
@@ -182,44 +457,77 @@ def check_limit_age(nzbid, nzbname):
 ##############################################################################
 def check_limit_retries(nzbid, nzbname):
     """
-    Checks to see how many retries have already been performed and exits
-    if we are the limit.
+    Checks to see how many retries have already been performed, and whether
+    they are still helping, and exits if we are at the limit. Returns the
+    updated state.
     """
     # Update the state so we can determine how long we should wait.
     state = update_state(nzbid, nzbname)
     retries = int(state['retries'])
-    wait_minutes = retries * RETRY_MINUTES
 
     # If we already reached the limit, we'll bail.
     if retries >= RETRY_LIMIT:
         clean_up()
         reason = 'Number of retries has been reached (%s) for %s (%s).' % (retries, nzbid, nzbname)
-        nzb.exit(nzb.PROCESS_SUCCESS)
+        nzb.exit(nzb.PROCESS_SUCCESS, reason)
+
+    # The articles aren't showing up, so retrying only wastes bandwidth.
+    if state['stalls'] >= STALL_LIMIT:
+        clean_up()
+        reason = 'Health of %s (%s) has not improved in %s retries.' % (nzbname, nzbid, state['stalls'])
+        nzb.exit(nzb.PROCESS_SUCCESS, reason)
+
+    return state
 
 
 # Updates the state of the script to track things like retries.
 ##############################################################################
 def update_state(nzbid, nzbname):
-    filepath = get_update_filepath(nzbid)
-    timestamp = int(time.mktime(datetime.datetime.utcnow().timetuple()))
-
-    if not os.path.exists(filepath):
-        state = { 'nzbid' : nzbid, 'nzbname' : nzbname, 'retries' : 1, 'lastcheck' : timestamp }
-    else:
-        state = json.load(open(filepath, 'r'))
-        retries = int(state['retries'])
-        state['retries'] = retries + 1
+    timestamp = int(time.time())
+    health = nzb.get_nzb_health()
+
+    def increment(state):
+        if state is None:
+            state = { 'nzbid' : nzbid, 'nzbname' : nzbname, 'retries' : 0 }
+
+        state['retries'] = int(state['retries']) + 1
+        state['wait'], state['stalls'] = get_backoff(state, health)
+        state['health'] = health
         state['lastcheck'] = timestamp
 
-    json.dump(state, open(filepath, 'w'))
+        return state
 
-    return state
+    return nzb.update_script_state(SCRIPT_NAME, get_state_name(nzbid), increment, nzbid=nzbid)
 
 
-# Gets the path to the state file.
+# Works out how long to wait before the next retry.
 ##############################################################################
-def get_update_filepath(nzbid):
-    return nzb.get_script_tempfile(SCRIPT_NAME, 'nzb-%s.state' % nzbid)
+def get_backoff(state, health):
+    """
+    Returns the minutes to wait and the number of retries in a row that
+    didn't improve the health. While the health keeps improving, the
+    articles are still propagating, so we check back soon. Otherwise the
+    wait doubles, up to what the old push-out timer would have reached.
+    """
+    previous = state.get('health')
+    stalls = state.get('stalls', 0)
+
+    # Nothing to compare against yet, so use the push-out timer.
+    if previous is None or health is None:
+        return state['retries'] * RETRY_MINUTES, stalls
+
+    if health - previous >= HEALTH_IMPROVEMENT:
+        return RETRY_MINUTES, 0
+
+    wait = max(state.get('wait', RETRY_MINUTES), RETRY_MINUTES) * 2
+
+    return min(wait, RETRY_MINUTES * RETRY_LIMIT), stalls + 1
+
+
+# Gets the name the NZB's state is saved under.
+##############################################################################
+def get_state_name(nzbid):
+    return 'nzb-%s' % nzbid
 
 
 # Cleanup script
@@ -230,18 +538,9 @@ def clean_up():
     """
     nzbid = nzb.get_nzb_id()
 
-    # Remove the state file.
-    update_filepath = get_update_filepath(nzbid)
-    if os.path.isfile(update_filepath):
-        os.remove(update_filepath)
-
-    if SCRIPT_STATE == 'Debug':
-        # Check if the script path has no other files and delete it.
-        # NOTE: We can't blindly remove the directory because there might be
-        #       other instances waiting for their retries and need the state.
-        tempdir = nzb.get_script_tempfolder(SCRIPT_NAME)
-        if len(os.path.listdir(tempdir)) == 0:
-            os.rmdirs(tempdir)
+    # Remove the saved state and any pending resume.
+    nzb.delete_script_state(SCRIPT_NAME, get_state_name(nzbid))
+    nzb.delete_deadlines(SCRIPT_NAME, [nzbid])
 
 
 # Main entry-point
@@ -262,6 +561,8 @@ def main():
 
         # Wire up your event handlers before the call.
         # Use the form nzb.set_handler(<event>, <function>)
+        nzb.set_handler('NZB_ADDED', on_nzb_added)
+        nzb.set_handler('FILE_DOWNLOADED', on_file_downloaded)
         nzb.set_handler('POST_PROCESSING', on_post_processing)
         nzb.set_handler('SCHEDULED', on_scheduled)
 
@@ -269,7 +570,7 @@ def main():
         # and executes any event handlers.
         nzb.execute()
     except Exception as e:
-        traceback.print_exc()
+        nzb.log_traceback()
         nzb.exit(nzb.PROCESS_ERROR, e)
 
 
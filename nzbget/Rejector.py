@@ -31,7 +31,7 @@
 
 
 ##############################################################################
-### NZBGET QUEUE/POST-PROCESSING SCRIPT                                    ###
+### NZBGET SCHEDULER/SCAN/QUEUE/POST-PROCESSING SCRIPT                     ###
 
 #
 # Inspects RAR archives to protect against downloading unwanted files.
@@ -40,16 +40,25 @@
 # protected, and/or are fake releases are rejected before the whole archive
 # is downloaded.
 #
+# When used as a scan script, the file names in the NZB's subjects are
+# checked against the same rules before anything is downloaded. When
+# scheduled, it inspects the new files of every NZB that is downloading.
+#
+# The names of all files described by the par2 set are checked as soon as
+# the first par2 file arrives, and files with obfuscated names are matched to
+# their real names by the MD5 of their first 16 KiB.
+#
 # NOTE: This script requires Python 2.7 to be installed on your system.
 #
 
 ##############################################################################
 ### OPTIONS                                                                ###
 
-# Enable or disable the script from executing (Enabled, Disabled, Debug).
+# Enable or disable the script from executing (Enabled, Disabled, Debug, Profile).
 #
 # Allows global execution of the script to be disabled without removing the
-# script from various events.
+# script from various events. Profile records how long each event takes in
+# nzbprofile.json in NZBGet's TempDir.
 #
 #ScriptState=Enabled
 
@@ -84,7 +93,8 @@
 # Specifies a regex pattern to use when file matching.
 #
 # You can specify multiple regular expressions by separating them with
-# a comma and double-quoting each expression.
+# a comma and double-quoting each expression. The archive is rejected if
+# the path of any file inside it matches one of the expressions.
 #RejectPatterns=
 
 # Determines action to take when an archive is rejected (Pause, Fail, Bad).
@@ -114,19 +124,79 @@
 #
 #FakeWhitelist=rename
 
-### NZBGET QUEUE/POST-PROCESSING SCRIPT                                    ###
+# Number of archives inspected at the same time when scheduled (1-16).
+#
+# The scheduled sweep looks at every NZB that is downloading and inspects
+# the new volumes of each archive in parallel.
+#
+#SweepThreads=4
+
+# Lowest level of messages written to the log (DEBUG, DETAIL, INFO, WARNING, ERROR).
+#
+# Defaults to DEBUG when ScriptState is Debug, and DETAIL otherwise.
+#
+#LogLevel=
+
+# Also write the log to a JSON lines file.
+#
+# Each message is written as a JSON object with the time, seconds since the
+# script started, level, script, event and thread. Relative paths are in
+# NZBGet's TempDir. Leave empty to disable.
+#
+#LogFile=
+
+# Save a cProfile dump of each event type when profiling (Enabled, Disabled).
+#
+# With ScriptState set to Profile, the dumps are written to NZBGet's TempDir
+# as profile-<script>-<event>.prof.
+#
+#ProfileDump=Disabled
+
+# Record each event to a JSON lines trace for nzbreplay.py.
+#
+# Each record holds the event's environment, with passwords and usernames
+# left out, every line the script wrote to NZBGet and its exit code.
+# Relative paths are in NZBGet's TempDir. Leave empty to disable.
+#
+#TraceFile=
+
+# Sets how long the shared queue/history snapshot is reused (seconds).
+#
+# Scripts share one copy of the NZBGet queue and history lists, which is
+# fetched again at most once per interval.
+#
+#SnapshotTTL=30
+
+# Run events in a resident worker process (Enabled, Disabled).
+#
+# Hands each event to a long-lived worker instead of starting a new Python
+# interpreter for it. The worker is started on the first event and stops
+# after 10 minutes without events. Events run in-process whenever the worker
+# isn't available.
+#
+#ResidentWorker=Disabled
+
+### NZBGET SCHEDULER/SCAN/QUEUE/POST-PROCESSING SCRIPT                     ###
+##############################################################################
+
+
+# Resident worker
 ##############################################################################
+# Hand the event to the resident worker when it's enabled. This needs to run
+# before anything else is imported.
+import nzbworker
+nzbworker.forward(__file__)
 
 
 # Imports
 ##############################################################################
 import nzb
-import operator
 import os
 import re
 import shutil
 import sys
-import traceback
+
+from multiprocessing.pool import ThreadPool
 
 
 # Options
@@ -139,13 +209,21 @@ REJECT_DISC_IMAGES=nzb.get_script_option('RejectDiscImages')
 REJECT_DISC_IMAGE_EXTENSIONS=nzb.get_script_option_list('RejectDiscImageExtensions')
 REJECT_FAKES=nzb.get_script_option('RejectFakes')
 REJECT_PASSWORD=nzb.get_script_option('RejectPassword')
-REJECT_PATTERNS=nzb.get_script_option_list('RejectPatterns')
+REJECT_PATTERNS=nzb.get_script_option_quoted_list('RejectPatterns')
+SWEEP_THREADS=int(nzb.get_script_option('SweepThreads') or 4)
 
 
 # Constants
 ##############################################################################
 SCRIPT_NAME='Rejector'
 LOCK_FILELIST='RejectorFileList'
+VARIABLE_SCANNED='REJECTOR_SCANNED'
+VARIABLE_REASON='REJECTOR_REASON'
+SWEEP_STATUSES=['QUEUED', 'DOWNLOADING']
+RIP_EXTENSIONS=['.vob', '.ifo']
+
+# Compiled from the options on first use.
+RULE_MATCHER=None
 
 
 # Handles when a file from the NZB has completed downloading.
@@ -157,14 +235,42 @@ def on_file_downloaded():
     update_filelist(nzbid)
 
 
+# Handles when an NZB file is found in the NzbDir.
+##############################################################################
+def on_scanning():
+    """
+    Checks the NZB before it's added to the queue. We can't fail an NZB that
+    isn't queued yet, so a rejected NZB is added paused and the reason is
+    kept for NZB_ADDED to apply the RejectAction.
+    """
+    reason = scan_nzb_file()
+
+    if reason is None:
+        return
+
+    nzb.set_script_variable(VARIABLE_SCANNED, 'yes')
+
+    if reason:
+        nzb.log_warning('Rejecting %s before download. %s.' % (nzb.get_nzb_name(), reason))
+        nzb.set_script_variable(VARIABLE_REASON, reason)
+        nzb.log_command('PAUSED=1')
+
+
 # Handles when an NZB is added to the queue.
 ##############################################################################
 def on_nzb_added():
     # Clean up any previous runs.
     clean_up()
 
-    # Lock the script from running again.
-    nzb.lock_create(SCRIPT_NAME)
+    # Apply the verdict from scanning, or scan now if that didn't happen.
+    reason = nzb.get_script_variable(VARIABLE_REASON)
+
+    if not reason and not nzb.get_script_variable(VARIABLE_SCANNED):
+        reason = scan_nzb_file()
+
+    if reason:
+        reject(reason)
+
     nzbid = nzb.get_nzb_id()
 
     # Move the last RAR file to the top.
@@ -174,162 +280,472 @@ def on_nzb_added():
 # Handles when an NZB is finished downloading all files.
 ##############################################################################
 def on_nzb_downloaded():
-    if nzb.lock_exists(SCRIPT_NAME):
-        # Only clean up once we're done downloading.
-        clean_up()
+    clean_up()
+
+
+# Handles the scheduled sweep of the whole queue.
+##############################################################################
+def on_scheduled():
+    """
+    Inspects the new files of every NZB that is downloading in one process,
+    so nothing depends on FILE_DOWNLOADED events alone, and applies all of
+    the reject actions in one batch.
+    """
+    groups = [group for group in nzb.get_queue_groups(ttl=0) if group['Status'] in SWEEP_STATUSES]
+    items = [{ 'nzbid' : int(group['NZBID']), 'directory' : group['DestDir'] } for group in groups]
+
+    if not items:
+        return
+
+    rejected = {}
+    nzb.run_queued_work(LOCK_FILELIST, items, lambda items: inspect_downloads(items, rejected))
+
+    if rejected:
+        reject_groups(rejected)
+
+
+# Inspects the new files of the queued NZBs.
+##############################################################################
+def inspect_downloads(items, rejected):
+    """
+    Inspects the archives on a pool of threads when there's more than one,
+    adding the reason for each rejected NZB to rejected.
+    """
+    # Compile the rules before any of the threads need them.
+    get_rule_matcher()
+
+    tasks = get_sweep_tasks(items, rejected)
+
+    if not tasks:
+        return
+
+    if len(tasks) == 1:
+        results = [sweep_archive(tasks[0])]
+    else:
+        pool = ThreadPool(max(1, min(SWEEP_THREADS, 16, len(tasks))))
+        try:
+            results = pool.map(sweep_archive, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    for nzbid, reason in results:
+        if reason and nzbid not in rejected:
+            rejected[nzbid] = reason
+
+    nzb.log_detail('Inspected %s archives in %s NZBs.' % (len(tasks), len(items)))
+
+
+# Finds the new files of each NZB, grouped by the archive they belong to.
+##############################################################################
+def get_sweep_tasks(items, rejected):
+    """
+    Volumes of the same archive are inspected in order by the same thread,
+    since they share the saved inspection. Files are grouped by the name the
+    par2 set knows them by, so obfuscated volumes still end up together.
+    """
+    tasks = {}
+
+    for item in items:
+        nzbid = item['nzbid']
+        directory = item['directory']
+
+        if not os.path.isdir(directory):
+            continue
+
+        # Files are only added to the file list once they've been inspected,
+        # so one that fails is tried again by the next event or sweep.
+        downloaded = [filename for filename in os.listdir(directory) if not filename.endswith('.tmp')]
+        new_files = nzb.filter_filelist(SCRIPT_NAME, nzbid, 'files', downloaded, add=False)
+
+        # Read the par2 files first, so the other files can be identified.
+        new_files.sort(key=lambda filename: not filename.lower().endswith('.par2'))
+        identities = nzb.get_script_state(SCRIPT_NAME, get_par2_state_name(nzbid), None)
+
+        for filename in new_files:
+            if identities is None and filename.lower().endswith('.par2'):
+                identities = read_par2_identities(nzbid, directory, filename, rejected)
+
+            name = identify_download(identities, directory, filename)
+            key = (nzbid, nzb.get_rar_set_name(name))
+            task = tasks.setdefault(key, { 'nzbid' : nzbid, 'directory' : directory, 'files' : [] })
+            task['files'].append((name, filename))
+
+    return [tasks[key] for key in sorted(tasks) if key[0] not in rejected]
+
+
+# Inspects the new volumes of one archive on a worker thread.
+##############################################################################
+def sweep_archive(task):
+    """
+    Each volume is added to the file list as soon as it has been inspected.
+    If one fails, it and the volumes after it are left for the next try.
+    The thread's store connection is closed when the task is done, rather
+    than left open until the pool's thread exits.
+    """
+    nzbid = task['nzbid']
+    filename = None
+
+    try:
+        for name, filename in sorted(task['files']):
+            reason = inspect_download(nzbid, task['directory'], filename, name)
+            nzb.add_filelist(SCRIPT_NAME, nzbid, 'files', [filename])
+
+            if reason:
+                return nzbid, reason
+    except Exception as e:
+        nzb.log_traceback()
+        nzb.log_error('Failed to inspect %s of NZB %s (%s).' % (filename or 'the files', nzbid, e))
+    finally:
+        nzb.store_close()
+
+    return nzbid, None
+
+
+# Reads the files described by the NZB's par2 set.
+##############################################################################
+def read_par2_identities(nzbid, directory, filename, rejected):
+    """
+    Returns the names of the files in the par2 set keyed by the MD5 of their
+    first 16 KiB, and saves them for the files that arrive later. The par2
+    index is among the first files downloaded, so the names are also checked
+    against the rules long before the archives arrive. Returns None if the
+    file doesn't describe any files.
+    """
+    try:
+        info = nzb.get_par2_info(os.path.join(directory, filename))
+    except (IOError, OSError) as e:
+        nzb.log_warning('Failed to read %s (%s).' % (filename, e))
+        return None
+
+    if not info['files']:
+        return None
+
+    identities = {}
+
+    for described in info['files'].values():
+        identities[described['md5_16k']] = described['filename']
+
+        rule = nzb.match_rules(get_rule_matcher(), described['filename'])
+        if rule and nzbid not in rejected:
+            rejected[nzbid] = rule['reason'] % described['filename']
+
+    nzb.log_detail('Read %s file descriptions from %s.' % (len(identities), filename))
+    nzb.set_script_state(SCRIPT_NAME, get_par2_state_name(nzbid), identities, nzbid)
+
+    return identities
+
+
+# Gets the name the par2 set knows a downloaded file by.
+##############################################################################
+def identify_download(identities, directory, filename):
+    """
+    Looks the file up by the MD5 of its first 16 KiB, which works on a file
+    that is only partially downloaded. Returns the file's own name if it
+    isn't in the par2 set.
+    """
+    if not identities or filename.lower().endswith('.par2'):
+        return filename
+
+    try:
+        name = identities.get(nzb.get_par2_hash(os.path.join(directory, filename)))
+    except (IOError, OSError):
+        return filename
 
+    if not name or name == filename:
+        return filename
 
-# Moves the last RAR file to the top of the queue list.
+    nzb.log_detail('Identified %s as %s from the par2 set.' % (filename, name))
+
+    return name
+
+
+def get_par2_state_name(nzbid):
+    return 'par2-%s' % nzbid
+
+
+# Moves the files needed for an early verdict to the top of the queue list.
 ##############################################################################
 def reorder_queued_items(nzbid):
     """
-    Finds the last part of the RAR archive and moves to the top of the queue.
+    Moves the first and last volumes of each RAR set, the par2 index and any
+    .nfo/.sfv files to the top of the queue in one edit, so the archive can
+    be inspected after only a small part of it is downloaded.
     """
     # If another script already sorted, then we can skip sorting.
-    if bool(nzb.get_script_variable('RAR_SORTED')):
-        nzb.log_info('Last RAR file was already sorted.')
+    if bool(nzb.get_script_variable('RAR_SORTED')) or nzb.get_download_plan(nzbid):
+        nzb.log_info('Files were already sorted.')
         return
 
     # Get the list of files for this NZB.
-    proxy = nzb.proxy()
-    filelist = proxy.listfiles(0, 0, nzbid)
-
-    # Enumerate the RAR files from the NZB and try to parse the part number.
-    files = nzb.get_rar_xmlfiles(filelist)
-
-    # If we found RAR files, we need to sort so that the last RAR file is the first
-    # item in the list.
-    if files:
-        files_sorted = sorted(files, key=operator.itemgetter('number'), reverse=True)
-        filename = files_sorted[0]['filename']
-        fileid = int(files_sorted[0]['fileid'])
-
-        if proxy.editqueue('FileMoveTop', 0, '', [fileid]):
-            nzb.log_detail('Moved last RAR file %s to the top.' % filename)
-            nzb.set_script_variable('RAR_SORTED', True)
-        else:
-            nzb.log_warning('Failed to move the last RAR file %s.' % filename)
-    else:
+    filelist = nzb.get_queue_files(nzbid)
+    plan = nzb.create_download_plan(filelist)
+
+    if not plan:
         nzb.log_warning('Failed to get list of files to sort.')
+        return
+
+    if nzb.editqueue('FileMoveTop', [item['fileid'] for item in plan]):
+        planned = sum(item['size'] for item in plan)
+        total = sum(nzb.get_xml_file_size(item) for item in filelist)
+        percent = 100.0 * planned / total if total else 100.0
 
+        nzb.log_detail('Moved %s files (%.1f%% of the NZB) to the top: %s.' %
+            (len(plan), percent, ', '.join(item['filename'] for item in plan)))
+
+        nzb.set_download_plan(nzbid, plan)
+        nzb.set_script_variable('RAR_SORTED', True)
+    else:
+        nzb.log_warning('Failed to move the files to the top.')
 
-# Updates the cached filelist on disk.
+
+# Checks the files listed in the NZB against the rules.
+##############################################################################
+def scan_nzb_file():
+    """
+    Streams the .nzb and checks the filename of each subject, stopping at
+    the first match. Returns the reason to reject, an empty string if the
+    NZB looks fine, or None if it couldn't be checked.
+    """
+    filepath = nzb.get_nzb_filepath()
+    matcher = get_rule_matcher()
+
+    if not filepath or not matcher['rules']:
+        return None
+
+    count = 0
+
+    for item in nzb.iter_nzb_files(filepath):
+        if not item['filename']:
+            continue
+
+        count += 1
+        rule = nzb.match_rules(matcher, item['filename'])
+
+        if rule:
+            return rule['reason'] % item['filename']
+
+    nzb.log_detail('Checked %s file names in %s.' % (count, os.path.basename(filepath)))
+
+    return ''
+
+
+# Inspects the new files of the NZB.
 ##############################################################################
 def update_filelist(nzbid):
-    # If a lock already exists in updating the cache file, bail out.
-    if nzb.lock_exists(LOCK_FILELIST):
+    """
+    Only one process inspects files at a time. If another one is busy, the
+    NZB is queued for it instead, and it checks the directory again before
+    it finishes, so no file is left uninspected.
+    """
+    directory = nzb.get_nzb_directory()
+
+    if not os.path.isdir(directory):
+        nzb.log_warning('Directory %s does not appear valid.' % directory)
         return
 
-    # Get the list of files from cache and from disk.
-    nzb.lock_create(LOCK_FILELIST)
+    rejected = {}
+    item = { 'nzbid' : nzbid, 'directory' : directory }
+    nzb.run_queued_work(LOCK_FILELIST, [item], lambda items: inspect_downloads(items, rejected))
 
-    try:
-        cache_filepath = get_cache_filepath(nzbid)
-        directory = nzb.get_nzb_directory()
+    # Other NZBs may have been inspected on their behalf.
+    reason = rejected.pop(nzbid, None)
 
-        if not os.path.isdir(directory):
-            nzb.log_warning('Directory %s does not appear valid.' % directory)
-
-        filelist = nzb.get_new_files(os.listdir(directory), cache_filepath)
-
-        # Cache the files that we've found that we just processed.
-        with open(cache_filepath, 'a') as cachefile:
-            for filename in filelist:
-                name, extension = os.path.splitext(filename)
-                if extension != '.tmp':
-                    cachefile.write(filename + '\n')
-                    process_download(directory, filename)
-            cachefile.close()
-    except Exception as e:
-        traceback.print_exc()
-        nzb.log_error(e)
-        raise
+    if rejected:
+        reject_groups(rejected)
+
+    if reason:
+        reject(reason)
+
+
+# Inspects a file that has been downloaded.
+##############################################################################
+def inspect_download(nzbid, directory, filename, name=None):
+    """
+    Inspects the archive the file belongs to, returning the reason to reject
+    the NZB if the file gives us one that wasn't already known. The result
+    is saved for the whole volume set, so once a set has been rejected or
+    every one of its volumes listed, nothing more needs to be read. The name
+    is the one the par2 set knows the file by, if it was renamed.
+    """
+    if not os.path.isdir(directory):
+        nzb.log_warning('Directory %s does not appear valid.' % directory)
+
+    state_name = get_archive_state_name(nzbid, name or filename)
+    inspection = nzb.get_script_state(SCRIPT_NAME, state_name, None)
+
+    if inspection and (inspection['complete'] or inspection['reason']):
+        nzb.log_debug('Archive for %s was already inspected.', filename)
+        return
+
+    inspection = inspect_archive(nzbid, os.path.join(directory, filename), inspection)
+    if inspection is None:
+        return
+
+    nzb.set_script_state(SCRIPT_NAME, state_name, inspection, nzbid)
+
+    return inspection['reason']
+
+
+# Gets the name the inspection of an archive is saved under.
+##############################################################################
+def get_archive_state_name(nzbid, filename):
+    return 'archive-%s-%s' % (nzbid, nzb.get_rar_set_name(filename))
+
+
+# Inspects the headers of one volume of an archive.
+##############################################################################
+def inspect_archive(nzbid, filepath, inspection=None):
+    """
+    Works out the listing, encryption, disc image and fake verdicts in a
+    single pass over the entries as they are read, adding to the inspection
+    of any volumes of the same set that were already seen. Reading stops at
+    the first entry that gets the archive rejected. Returns None if the file
+    isn't a RAR archive.
+    """
+    if inspection is None:
+        inspection = { 'volumes' : [], 'last_volume' : None, 'entries' : 0, 'reason' : None, 'complete' : False }
+
+    info = {}
+    entries = nzb.iter_rar_entries(filepath, info)
+    names = []
+
+    try:
+        for entry in entries:
+            inspection['reason'] = inspect_rar_content(entry)
+            if inspection['reason']:
+                break
+
+            names.append(entry['filename'])
+            if len(names) >= nzb.STORE_BATCH_SIZE:
+                inspection['entries'] += record_rar_contents(nzbid, names)
+                names = []
     finally:
-        nzb.lock_release(LOCK_FILELIST)
+        entries.close()
+
+    if not info['format']:
+        return None
+
+    inspection['entries'] += record_rar_contents(nzbid, names)
 
+    if info['volume_number'] is not None and info['volume_number'] not in inspection['volumes']:
+        inspection['volumes'].append(info['volume_number'])
 
-# Gets the full path to the cache file.
+    if info['last_volume'] and info['volume_number'] is not None:
+        inspection['last_volume'] = info['volume_number']
+
+    # Nothing else can be read, or needs to be, once the set is known to
+    # need a password, or once every volume of the set has been read. The
+    # last volume is usually downloaded early, so seeing it isn't enough.
+    inspection['complete'] = info['encrypted_headers'] or not info['volume'] or is_archive_complete(inspection)
+
+    if info['encrypted_headers'] and REJECT_PASSWORD != 'Disabled':
+        inspection['reason'] = 'Requires a password to extract.'
+
+    return inspection
+
+
+# Checks whether every volume of the set has been inspected.
 ##############################################################################
-def get_cache_filepath(name):
-    tempdir = get_temp_path()
-    filename = 'cached-%s.filelist' % name
+def is_archive_complete(inspection):
+    last_volume = inspection.get('last_volume')
+
+    if last_volume is None:
+        return False
 
-    return os.path.join(tempdir, filename)
+    return set(range(last_volume + 1)) <= set(inspection['volumes'])
 
 
-# Processes a file that has been downloaded.
+# Records the files seen inside the archive.
 ##############################################################################
-def process_download(directory, filename):
-    if not os.path.isdir(directory):
-        nzb.log_warning('Directory %s does not appear valid.' % directory)
+def record_rar_contents(nzbid, names):
+    """
+    Returns how many of the names weren't seen before, since files split
+    across volumes are listed in each of them.
+    """
+    new_names = nzb.get_new_files(names, script_name=SCRIPT_NAME, nzbid=nzbid, kind='contents') if names else []
 
-    filepath = os.path.join(directory, filename)
-    cache_filepath = get_cache_filepath('%s-contents' % nzb.get_nzb_id())
-    contentlist = nzb.get_rar_filelist(filepath)
-    filelist = nzb.get_new_files(contentlist, cache_filepath)
+    for name in new_names:
+        nzb.log_detail('Checked RAR content file %s.' % name)
 
-    with open(cache_filepath, 'a') as cachefile:
-        for file in filelist:
-            inspect_rar_content(directory, file)
-            cachefile.write(file + '\n')
-        cachefile.close()
+    return len(new_names)
 
 
 # Inspects the specified file from inside a RAR archive.
 ##############################################################################
-def inspect_rar_content(directory, filename):
-    nzb.log_detail('Checking RAR content file %s.' % filename)
-
-    if REJECT_DISC_IMAGES != 'Disabled':
-        check_disc_image(filename)
+def inspect_rar_content(entry):
+    """
+    Returns the reason to reject the archive because of this file, if any.
+    """
+    filename = entry['filename']
+    rule = nzb.match_rules(get_rule_matcher(), filename)
 
-    if REJECT_FAKES != 'Disabled':
-        check_fake(filename)
+    if rule:
+        return rule['reason'] % filename
 
-    if REJECT_PASSWORD != 'Disabled':
-        check_protected(directory, filename)
+    if REJECT_PASSWORD != 'Disabled' and entry['encrypted']:
+        return 'Requires a password to extract.'
 
 
-# Checks if the file looks like a disc image.
+# Gets the matcher for the disc image, fake and pattern rules.
 ##############################################################################
-def check_disc_image(filename):
-    name, extension = os.path.splitext(filename)
+def get_rule_matcher():
+    """
+    Compiles the rules from the options once, so each file is checked
+    against all of them with a single lookup.
+    """
+    global RULE_MATCHER
 
-    if REJECT_DISC_IMAGES == 'All' or REJECT_DISC_IMAGES == 'Image':
-        if extension in REJECT_DISC_IMAGE_EXTENSIONS:
-            reject('Contains a disc image file (%s).' % filename)
+    if RULE_MATCHER is None:
+        RULE_MATCHER = nzb.compile_rules(get_rules())
 
-    if REJECT_DISC_IMAGES == 'All' or REJECT_DISC_IMAGES == 'Rip':
-        if extension == '.vob' or extension == '.ifo':
-            reject('Contains a file (%s) indicating it was a rip.' % filename)
+    return RULE_MATCHER
 
 
-# Checks if the file is considered part of being fake.
+# Builds the list of rules from the options.
 ##############################################################################
-def check_fake(filename):
+def get_rules():
     """
-    Checks if the name or extension is in the FAKE_BLACKLIST collection. If
-    the file has a name or extension that has been blacklisted, the entire
-    NZB is considered a fake.
+    Rules are checked in order, so disc images are reported before fakes,
+    and fakes before patterns. Whitelisted names only exclude a file from
+    the fake rules.
     """
-    name, extension = os.path.splitext(filename)
+    rules = []
 
-    if name.lower() in FAKE_WHITELIST or extension.lower() in FAKE_WHITELIST:
-        return
+    if REJECT_DISC_IMAGES == 'All' or REJECT_DISC_IMAGES == 'Image':
+        for extension in REJECT_DISC_IMAGE_EXTENSIONS:
+            add_rule(rules, 'disc', extension, 'Contains a disc image file (%s).')
 
-    blacklisted = name.lower() in FAKE_BLACKLIST or extension.lower() in FAKE_BLACKLIST
-    # TODO: Don't remember why we had to do this?
-    # invalid = False if extension in nzb.MEDIA_EXTENSIONS else nzb.is_video_invalid(filename)
+    if REJECT_DISC_IMAGES == 'All' or REJECT_DISC_IMAGES == 'Rip':
+        for extension in RIP_EXTENSIONS:
+            add_rule(rules, 'disc', extension, 'Contains a file (%s) indicating it was a rip.')
+
+    if REJECT_FAKES != 'Disabled':
+        for value in FAKE_WHITELIST:
+            add_rule(rules, 'fake', value, None, exclude=True)
 
-    if blacklisted:
-        reject('Contains a file (%s) that appears to indicate a fake.' % filename)
+        for value in FAKE_BLACKLIST:
+            add_rule(rules, 'fake', value, 'Contains a file (%s) that appears to indicate a fake.')
 
+    for pattern in REJECT_PATTERNS:
+        reason = 'Contains a file (%%s) matching the pattern %s.' % pattern.replace('%', '%%')
+        rules.append({ 'kind' : 'pattern', 'value' : pattern, 'group' : 'pattern', 'reason' : reason })
 
-# Checks if the file is password protected.
-def check_protected(directory, filename):
-    filepath = os.path.join(directory, filename)
-    if nzb.is_rar_protected(filepath):
-        reject('Requires a password to extract.')
+    return rules
+
+
+def add_rule(rules, group, value, reason, exclude=False):
+    """
+    Adds a name or extension rule. Values starting with a dot are treated as
+    extensions and anything else as a name.
+    """
+    value = value.strip()
+
+    if not value:
+        return
+
+    kind = 'extension' if value.startswith('.') else 'name'
+    rules.append({ 'kind' : kind, 'value' : value, 'group' : group, 'reason' : reason, 'exclude' : exclude })
 
 
 # Rejects the archive and marks the NZB according to the REJECT_ACTION.
@@ -343,7 +759,7 @@ def reject(reason):
 
     if REJECT_ACTION == 'Pause':
         nzb.log_error('File %s was rejected, pausing download.' % nzbname)
-        response = nzb.proxy().editqueue('GroupPause', 0, '', [nzbid])
+        response = nzb.editqueue('GroupPause', [nzbid])
     elif REJECT_ACTION == 'Bad':
         nzb.log_error('File %s was rejected, marking as bad.' % nzbname)
         nzb.set_nzb_bad()
@@ -359,10 +775,47 @@ def reject(reason):
     nzb.exit(nzb.PROCESS_ERROR)
 
 
-# Gets the temp folder for the script.
+# Rejects several NZBs from the queue in one batch.
 ##############################################################################
-def get_temp_path():
-    return nzb.get_script_tempfolder(SCRIPT_NAME)
+def reject_groups(rejected):
+    """
+    Applies the REJECT_ACTION to every rejected NZB with one batch of calls.
+    NZBs can only be marked bad from their own queue events, so Bad falls
+    back to failing them here.
+    """
+    nzbids = sorted(rejected)
+
+    for nzbid in nzbids:
+        group = nzb.get_queue_group(nzbid)
+        nzbname = group['NZBName'] if group else nzbid
+        nzb.log_error('Rejecting %s. %s.' % (nzbname, rejected[nzbid]))
+
+    batch = nzb.RpcBatch()
+    handle = None
+
+    if REJECT_ACTION == 'Pause':
+        handle = batch.editqueue('GroupPause', nzbids)
+    else:
+        for nzbid in nzbids:
+            batch.call('listfiles', 0, 0, nzbid)
+
+        delete_ids = []
+
+        for listing in batch.execute():
+            if isinstance(listing, list):
+                delete_ids.extend(nzb.get_nzb_fail_ids(listing))
+
+        # Nothing is left to delete when every file already finished.
+        if delete_ids:
+            handle = batch.editqueue('FileDelete', delete_ids)
+
+    if handle is not None and batch.execute()[handle] is not True:
+        nzb.log_error('Failed to apply the reject action to %s NZBs.' % len(nzbids))
+
+    for nzbid in nzbids:
+        nzb.invalidate_snapshot('files-%s' % nzbid)
+
+    nzb.invalidate_snapshot('groups')
 
 
 # Cleanup script
@@ -371,16 +824,9 @@ def clean_up():
     """
     Perform any script cleanup that is required here.
     """
-    if nzb.lock_exists(SCRIPT_NAME):
-        nzb.lock_release(SCRIPT_NAME)
-
-    if nzb.lock_exists(LOCK_FILELIST):
-        nzb.lock_release(LOCK_FILELIST)
-
-    tempdir = get_temp_path()
-    if len(os.listdir(tempdir)) == 0:
-        if os.path.exists(tempdir):
-            shutil.rmtree(tempdir)
+    nzbid = nzb.get_nzb_id()
+    nzb.delete_nzb_state(nzbid, SCRIPT_NAME)
+    nzb.delete_download_plan(nzbid)
 
 
 # Main entry-point
@@ -400,7 +846,8 @@ def main():
         DiscImageEnabled = REJECT_DISC_IMAGES != 'Disabled'
         FakeCheckEnabled = REJECT_FAKES != 'Disabled'
         PasswordCheckEnabled = REJECT_PASSWORD != 'Disabled'
-        if not (DiscImageEnabled and FakeCheckEnabled and PasswordCheckEnabled):
+        PatternCheckEnabled = bool(REJECT_PATTERNS)
+        if not (DiscImageEnabled or FakeCheckEnabled or PasswordCheckEnabled or PatternCheckEnabled):
             nzb.log_info('No features enabled. Skipping script execution.')
             nzb.exit(nzb.PROCESS_SUCCESS)
 
@@ -412,12 +859,14 @@ def main():
         nzb.set_handler('FILE_DOWNLOADED', on_file_downloaded)
         nzb.set_handler('NZB_ADDED', on_nzb_added)
         nzb.set_handler('NZB_DOWNLOADED', on_nzb_downloaded)
+        nzb.set_handler('SCANNING', on_scanning)
+        nzb.set_handler('SCHEDULED', on_scheduled)
 
         # Do not change this line, it checks the current event
         # and executes any event handlers.
         nzb.execute()
     except Exception as e:
-        traceback.print_exc()
+        nzb.log_traceback()
         nzb.exit(nzb.PROCESS_ERROR, e)
         clean_up()
 
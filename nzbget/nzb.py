@@ -29,18 +29,51 @@
 # Imports
 #############################################################################
 
+import atexit
 import base64
+import contextlib
+import csv
 import datetime
+import errno
+import hashlib
+import httplib
 import json
+import math
 import os
+import random
 import re
 import shlex
+import socket
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
-import urllib
-import urllib2
+import xmlrpclib
+import zlib
+
+from xml.etree import cElementTree
+
+# File locking is only available on POSIX systems. Without it, concurrent
+# scripts may occasionally refresh the same snapshot twice.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# scandir is built into Python 3.5 and later, and is a separate package for
+# older versions. Without it, directories are walked with listdir and stat.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 # Import aliases
@@ -67,6 +100,20 @@ NZBGET_PASSWORD=os.environ['NZBOP_CONTROLPASSWORD']
 # If the IP address has no real value, set to localhost.
 if NZBGET_HOST == '0.0.0.0': NZBGET_HOST = '127.0.0.1'
 
+# Seconds to wait on the control port before giving up on a request.
+NZBGET_TIMEOUT=30
+
+# Seconds a queue/history snapshot is reused before it is fetched again. Can
+# be overridden per script with the SnapshotTTL option.
+SNAPSHOT_TTL=30
+SNAPSHOT_FOLDER='Snapshots'
+
+# Script state, file lists and locks all live in a single SQLite database in
+# NZBOP_TEMPDIR.
+STORE_FILENAME='nzbstate.db'
+STORE_TIMEOUT=30
+STORE_BATCH_SIZE=500
+
 MEDIA_EXTENSIONS=[
     '.avi',
     '.divx',
@@ -95,58 +142,461 @@ EVENTS = {
 # Logging
 #############################################################################
 
-def log_debug(message):
-    log_write('DEBUG', message)
+LOG_LEVELS={
+    'DEBUG' : 10,
+    'DETAIL' : 20,
+    'INFO' : 30,
+    'WARNING' : 40,
+    'ERROR' : 50,
+}
+
+# Lines are held back until this many are waiting, this many seconds have
+# passed since they were last written, a warning or error is logged, or the
+# script exits. Anything about to block for a while flushes them first.
+LOG_BUFFER_LINES=100
+LOG_BUFFER_SECONDS=1
+
+LOG_LOCK=threading.Lock()
+LOG_STATE={ 'started' : time.time() }
+
+def log_debug(message, *args):
+    log_write('DEBUG', message, *args)
+
+
+def log_detail(message, *args):
+    log_write('DETAIL', message, *args)
+
+
+def log_error(message, *args):
+    log_write('ERROR', message, *args)
+
+
+def log_info(message, *args):
+    log_write('INFO', message, *args)
+
+
+def log_warning(message, *args):
+    log_write('WARNING', message, *args)
 
 
-def log_detail(message):
-    log_write('DETAIL', message)
+def log_write(type, message, *args):
+    """
+    Writes the message using NZBGet's [LEVEL] protocol if the level is
+    enabled. Any arguments are only formatted into the message once we know
+    it's going to be written, so a disabled level costs a lookup.
+    """
+    level = LOG_LEVELS.get(type, LOG_LEVELS['INFO'])
+    state = get_log_state()
+
+    if level < state['level']:
+        return
+
+    if args:
+        message = message % args
+    elif not isinstance(message, basestring):
+        message = str(message)
+
+    with LOG_LOCK:
+        state['lines'].append('[%s] %s\n' % (type, message))
+
+        if state['sink']:
+            now = time.time()
+            state['records'].append(json.dumps({
+                'time' : now,
+                'elapsed' : round(now - state['started'], 6),
+                'level' : type,
+                'script' : state['script'],
+                'event' : state['event'],
+                'pid' : os.getpid(),
+                'thread' : threading.current_thread().name,
+                'message' : to_unicode(message),
+            }) + '\n')
+
+        if level >= LOG_LEVELS['WARNING'] or len(state['lines']) >= LOG_BUFFER_LINES \
+                or time.time() - state['flushed'] >= LOG_BUFFER_SECONDS:
+            write_log_buffer(state)
+
+
+def log_command(command):
+    """
+    Sends an [NZB] command to NZBGet. It goes through the same buffer as
+    the log lines, so they reach NZBGet in the order they were written.
+    """
+    state = get_log_state()
+
+    with LOG_LOCK:
+        state['lines'].append('[NZB] %s\n' % command)
+        write_log_buffer(state)
+
+
+def log_enabled(type):
+    """
+    Checks whether the level is written, for callers that need to do some
+    work to build the message.
+    """
+    return LOG_LEVELS.get(type, LOG_LEVELS['INFO']) >= get_log_state()['level']
+
+
+def log_flush():
+    state = LOG_STATE.get('current')
+    if state:
+        with LOG_LOCK:
+            write_log_buffer(state)
+
+
+def log_traceback():
+    """
+    Prints the traceback of the exception being handled to stderr, after
+    the lines that were logged before it.
+    """
+    log_flush()
+    traceback.print_exc()
+
 
+def log_reset():
+    """
+    Flushes anything waiting and reads the LogLevel and LogFile options
+    again, for the resident worker, which runs many events in one process.
+    The elapsed time of the JSON records starts over from here.
+    """
+    log_flush()
+    LOG_STATE.pop('current', None)
+    LOG_STATE['started'] = time.time()
+
+
+def get_log_state():
+    state = LOG_STATE.get('current')
+
+    if state is None:
+        level = get_script_option('LogLevel')
+        if level not in LOG_LEVELS:
+            level = 'DEBUG' if get_script_option('ScriptState') == 'Debug' else 'DETAIL'
+
+        sink = get_script_option('LogFile')
+        if sink and not os.path.isabs(sink) and os.environ.get('NZBOP_TEMPDIR'):
+            sink = os.path.join(os.environ['NZBOP_TEMPDIR'], sink)
+
+        state = {
+            'level' : LOG_LEVELS[level],
+            'sink' : sink or None,
+            'script' : get_script_name(),
+            'event' : os.environ.get('NZBNA_EVENT') or os.environ.get('NZBPP_EVENT') or None,
+            'started' : LOG_STATE['started'],
+            'lines' : [],
+            'records' : [],
+            'flushed' : time.time(),
+        }
+        LOG_STATE['current'] = state
 
-def log_error(message):
-    log_write('ERROR', message)
+    return state
 
 
-def log_info(message):
-    log_write('INFO', message)
+def write_log_buffer(state):
+    """
+    Writes the waiting lines in one go. Expects LOG_LOCK to be held.
+    """
+    state['flushed'] = time.time()
 
+    if state['lines']:
+        lines, state['lines'] = state['lines'], []
+        sys.stdout.write(''.join(lines))
+        sys.stdout.flush()
 
-def log_warning(message):
-    log_write('WARNING', message)
+    if state['records']:
+        records, state['records'] = state['records'], []
+        try:
+            with open(state['sink'], 'a') as sink:
+                sink.write(''.join(records))
+        except IOError as e:
+            state['sink'] = None
+            sys.stdout.write('[WARNING] Failed to write to log file %s (%s).\n' % (e.filename, e.strerror))
 
 
-def log_write(type, message):
-    print('[%s] %s' % (type, message))
+atexit.register(log_flush)
 
 
 # API
 #############################################################################
 
-def command(url_command):
-    url = 'http://%s:%s/jsonrpc/%s' % (NZBGET_HOST, NZBGET_PORT, url_command)
-    log_debug('Command: %s.' % url)
+class RpcConnection(object):
+    """
+    A single HTTP/1.1 keep-alive connection to the NZBGet control port that
+    is shared by every RPC helper. Requests are serialized, and a dropped
+    connection is reopened and the request sent once more.
+    """
+    def __init__(self, host, port, username, password, timeout=NZBGET_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.Lock()
+        self.stats = {}
+
+        auth = '%s:%s' % (username, password)
+        self.auth_header = 'Basic %s' % base64.b64encode(auth)
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, name, method, path, body=None, headers={}):
+        """
+        Sends the request and returns the response body. The name is only
+        used to key the latency counters.
+        """
+        request_headers = {
+            'Authorization' : self.auth_header,
+            'Connection' : 'keep-alive',
+        }
+        request_headers.update(headers)
+
+        with self.lock:
+            start = time.time()
+            reused = self.connection is not None
+            try:
+                try:
+                    return self._send(method, path, body, request_headers)
+                except (socket.error, httplib.HTTPException):
+                    # The server (or something in between) may have closed
+                    # the idle connection, so reconnect and try once more.
+                    # A fresh connection failing is a real error.
+                    self.close()
+                    if not reused:
+                        raise
+                    self._record(name, 'reconnects')
+                    return self._send(method, path, body, request_headers)
+            except Exception:
+                self.close()
+                self._record(name, 'errors')
+                raise
+            finally:
+                self._record(name, 'calls', time.time() - start)
+
+    def _send(self, method, path, body, headers):
+        if not self.connection:
+            self.connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        data = response.read()
+
+        if response.getheader('connection', '').lower() == 'close':
+            self.close()
+
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError(self.host + path, response.status, response.reason, response.msg)
+
+        return data
+
+    def _record(self, name, counter, seconds=None):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = { 'calls' : 0, 'errors' : 0, 'reconnects' : 0, 'seconds' : 0.0, 'max' : 0.0 }
+            self.stats[name] = stats
+
+        if seconds is None:
+            stats[counter] += 1
+        else:
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            profile_record('rpc:%s' % name, seconds)
+
+
+class RpcTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport that sends every request over the shared RpcConnection
+    instead of opening a new socket per call.
+    """
+    REGEX_METHOD = re.compile(r'<methodName>([^<]+)</methodName>')
+
+    def __init__(self, connection):
+        xmlrpclib.Transport.__init__(self)
+        self.rpc_connection = connection
+
+    def request(self, host, handler, request_body, verbose=0):
+        match = self.REGEX_METHOD.search(request_body, 0, 512)
+        name = match.group(1) if match else 'xmlrpc'
+        headers = { 'Content-Type' : 'text/xml' }
 
-    auth = '%s:%s' % (NZBGET_USERNAME, NZBGET_PASSWORD)
-    auth_token = base64.encodestring(auth).replace('\n', '')
+        data = self.rpc_connection.request(name, 'POST', handler, request_body, headers)
 
-    request = urllib2.Request(url)
-    request.add_header('Authorization', 'Basic %s' % auth_token)
+        parser, unmarshaller = self.getparser()
+        parser.feed(data)
+        parser.close()
 
-    response = retry(lambda: urllib2.urlopen(request))
+        return unmarshaller.close()
 
-    return response.read()
+
+RPC_CONNECTION = None
+RPC_PROXY = None
+
+
+def connection():
+    """
+    Gets the shared keep-alive connection to NZBGet, creating it on first use.
+    """
+    global RPC_CONNECTION
+
+    if RPC_CONNECTION is None:
+        RPC_CONNECTION = RpcConnection(NZBGET_HOST, NZBGET_PORT, NZBGET_USERNAME, NZBGET_PASSWORD)
+
+    return RPC_CONNECTION
+
+
+def command(url_command):
+    path = '/jsonrpc/%s' % url_command
+    log_debug('Command: %s.', path)
+
+    name = url_command.split('?', 1)[0]
+
+    return retry(lambda: connection().request(name, 'GET', path))
 
 
 def proxy():
-    # Make sure we encode the username and password since it will be used in
-    # the url we create.
-    username = urllib.quote(NZBGET_USERNAME, safe='')
-    password = urllib.quote(NZBGET_PASSWORD, safe='')
-    url = 'http://%s:%s@%s:%s/xmlrpc' % (username, password, NZBGET_HOST, NZBGET_PORT)
+    """
+    Gets the shared XML-RPC proxy. The credentials are sent as a header by
+    the connection, so they no longer need to be part of the url.
+    """
+    global RPC_PROXY
+
+    if RPC_PROXY is None:
+        url = 'http://%s:%s/xmlrpc' % (NZBGET_HOST, NZBGET_PORT)
+        log_debug('Proxy: %s.', url)
+        RPC_PROXY = ServerProxy(url, transport=RpcTransport(connection()))
+
+    return RPC_PROXY
 
-    log_debug('Proxy: %s.' % url)
 
-    return ServerProxy(url)
+def editqueue(command, ids, param='', offset=0):
+    """
+    Applies the queue edit command to all of the IDs in a single call.
+    """
+    ids = [int(id) for id in ids]
+
+    if not ids:
+        return True
+
+    return retry(lambda: proxy().editqueue(command, offset, param, ids))
+
+
+class RpcBatch(object):
+    """
+    Collects RPC calls so they can be sent in as few round trips as possible.
+    Queue edits that share the same command, offset and parameter are merged
+    into a single editqueue call, and everything else is sent together with
+    system.multicall. Each queued call returns a handle that is used to look
+    up its own result once the batch has executed.
+
+        batch = nzb.RpcBatch()
+        pause = batch.editqueue('GroupPause', [nzbid])
+        files = batch.call('listfiles', 0, 0, nzbid)
+        results = batch.execute()
+        if not results[pause]: ...
+    """
+    def __init__(self, client=None):
+        self.client = client
+        self.calls = []
+        self.handles = []
+        self.edits = {}
+
+    def __len__(self):
+        return len(self.handles)
+
+    def call(self, method, *args):
+        """
+        Queues a call to the named method and returns its handle.
+        """
+        self.calls.append((method, args))
+        self.handles.append(len(self.calls) - 1)
+
+        return len(self.handles) - 1
+
+    def editqueue(self, command, ids, param='', offset=0):
+        """
+        Queues a queue edit. The IDs are merged with any other edit that uses
+        the same command, offset and parameter, and every handle for the
+        merged edit gets the result of the combined call.
+        """
+        key = (command, offset, param)
+
+        if key in self.edits:
+            index = self.edits[key]
+            self.calls[index][1][3].extend([int(id) for id in ids])
+        else:
+            index = len(self.calls)
+            self.calls.append(('editqueue', [command, offset, param, [int(id) for id in ids]]))
+            self.edits[key] = index
+
+        self.handles.append(index)
+
+        return len(self.handles) - 1
+
+    def execute(self):
+        """
+        Sends the queued calls and returns the results indexed by handle. A
+        call that faults gets the xmlrpclib.Fault as its result instead of
+        failing the whole batch.
+        """
+        client = self.client if self.client is not None else proxy()
+        calls = [(method, list(args)) for method, args in self.calls]
+
+        self.calls = []
+        self.edits = {}
+        handles, self.handles = self.handles, []
+
+        if not calls:
+            return []
+        elif len(calls) == 1:
+            results = [self.execute_single(client, calls[0])]
+        else:
+            results = self.execute_multicall(client, calls)
+
+        return [results[index] for index in handles]
+
+    def execute_single(self, client, call):
+        method, args = call
+        try:
+            return retry(lambda: getattr(client, method)(*args))
+        except xmlrpclib.Fault as fault:
+            return fault
+
+    def execute_multicall(self, client, calls):
+        request = [{ 'methodName' : method, 'params' : args } for method, args in calls]
+
+        try:
+            responses = retry(lambda: client.system.multicall(request))
+        except xmlrpclib.Fault as fault:
+            # Older servers may not support system.multicall, so fall back to
+            # sending the calls one at a time.
+            log_debug('Multicall failed (%s), sending %s calls separately.', fault.faultString, len(calls))
+            return [self.execute_single(client, call) for call in calls]
+
+        results = []
+        for response in responses:
+            if isinstance(response, dict):
+                results.append(xmlrpclib.Fault(response['faultCode'], response['faultString']))
+            else:
+                results.append(response[0])
+
+        return results
+
+
+def get_rpc_stats():
+    """
+    Gets the per-method latency counters for calls made by this process.
+    Each entry has the number of calls, errors, reconnects, and the total
+    and max seconds spent waiting on NZBGet.
+    """
+    return connection().stats
+
+
+def log_rpc_stats():
+    for name, stats in sorted(get_rpc_stats().items()):
+        average = stats['seconds'] / stats['calls'] if stats['calls'] else 0
+        log_debug('RPC %s: %s calls, %s errors, %s reconnects, %.1fms avg, %.1fms max.',
+            name, stats['calls'], stats['errors'], stats['reconnects'], average * 1000, stats['max'] * 1000)
 
 
 # Script checking
@@ -176,9 +626,9 @@ def check_nzb_version(min_version):
             reason = 'Requires version %s, but found %s.' % (min_version, version)
             exit(PROCESS_FAIL_RUNTIME, reason)
 
-        log_debug('Running NZBGet %s on %s.' % (version, os.name))
+        log_debug('Running NZBGet %s on %s.', version, os.name)
     except Exception:
-        traceback.print_exc()
+        log_traceback()
         reason = 'Unable to determine server version. Requires version >= %s.' % min_version
         exit(PROCESS_FAIL_RUNTIME, reason)
 
@@ -189,6 +639,8 @@ def exit(exit_code, reason=None):
     elif reason:
         log_error(reason)
 
+    log_flush()
+    trace_finish(exit_code)
     sys.exit(exit_code)
 
 
@@ -238,6 +690,45 @@ def set_handler(event, callback):
         EVENTS[event] = callback
 
 
+def reset_handlers():
+    """
+    Clears all of the event handlers. Only needed when a process runs more
+    than one script, like the resident worker.
+    """
+    for event in EVENTS:
+        EVENTS[event] = None
+
+
+def reset_state():
+    """
+    Starts the module over for the next event, for the resident worker,
+    which runs many events in one process. Everything read from the
+    environment is read again, and the RPC connection, snapshots, store
+    connection and lock owner of the last event are dropped.
+    """
+    global NZBGET_HOST, NZBGET_PORT, NZBGET_USERNAME, NZBGET_PASSWORD, RPC_CONNECTION, RPC_PROXY
+
+    if RPC_CONNECTION:
+        RPC_CONNECTION.close()
+    RPC_CONNECTION = RPC_PROXY = None
+
+    NZBGET_HOST = os.environ['NZBOP_CONTROLIP']
+    NZBGET_PORT = os.environ['NZBOP_CONTROLPORT']
+    NZBGET_USERNAME = os.environ['NZBOP_CONTROLUSERNAME']
+    NZBGET_PASSWORD = os.environ['NZBOP_CONTROLPASSWORD']
+    if NZBGET_HOST == '0.0.0.0': NZBGET_HOST = '127.0.0.1'
+
+    store_close()
+    STORE_READY.clear()
+
+    SNAPSHOTS.clear()
+    LOCK_OWNER['owner'] = None
+
+    reset_handlers()
+    log_reset()
+    profile_reset()
+
+
 def execute():
     """
     Executes the event handler associated with the current event.
@@ -245,9 +736,252 @@ def execute():
     event = get_nzb_event()
     handler = get_handler(event)
 
+    trace_start(event)
+
     if handler:
         log_info('Handler found for %s.' % event)
-        handler()
+
+        if is_profiling():
+            run_profiled(event, handler)
+        else:
+            handler()
+
+    if RPC_CONNECTION:
+        log_rpc_stats()
+
+
+# Profiling
+#############################################################################
+
+PROFILE_FILENAME='nzbprofile.json'
+PROFILE_SAMPLES=500
+PROFILE_PERCENTILES=[50, 90, 99]
+
+# Timings recorded for the current event when ScriptState is Profile. The
+# startup time is only known for a process that runs a single event.
+PROFILE={ 'loaded' : time.time(), 'enabled' : None, 'single' : True, 'timings' : {} }
+
+def is_profiling():
+    if PROFILE['enabled'] is None:
+        PROFILE['enabled'] = get_script_option('ScriptState') == 'Profile'
+
+    return PROFILE['enabled']
+
+
+def profile_record(name, seconds):
+    """
+    Records a timing for the current event. Costs a lookup when the script
+    isn't being profiled.
+    """
+    if is_profiling():
+        PROFILE['timings'].setdefault(name, []).append(round(seconds, 6))
+
+
+def profile_reset():
+    """
+    Starts the timings over, for the resident worker, which runs many events
+    in one process.
+    """
+    PROFILE['loaded'] = time.time()
+    PROFILE['enabled'] = None
+    PROFILE['single'] = False
+    PROFILE['timings'] = {}
+
+
+def run_profiled(event, handler):
+    """
+    Runs the handler, recording its wall and CPU time, and adds the timings
+    of the event to the stats file, even if the handler exits. With the
+    ProfileDump option, the handler also runs under cProfile and the result
+    is saved for each event type.
+    """
+    started = get_process_started() if PROFILE['single'] else None
+    if started:
+        profile_record('startup', PROFILE['loaded'] - started)
+
+    profile_record('options', time.time() - PROFILE['loaded'])
+
+    profiler = None
+    if get_script_option('ProfileDump') == 'Enabled':
+        import cProfile
+        profiler = cProfile.Profile()
+
+    wall = time.time()
+    cpu = get_cpu_time()
+
+    try:
+        if profiler:
+            profiler.runcall(handler)
+        else:
+            handler()
+    finally:
+        profile_record('handler', time.time() - wall)
+        profile_record('handler_cpu', get_cpu_time() - cpu)
+
+        name = '%s-%s' % (get_script_name(), event)
+
+        if profiler:
+            profiler.dump_stats(os.path.join(get_script_tempfolder(), 'profile-%s.prof' % name))
+
+        save_profile(name)
+
+
+def save_profile(name):
+    """
+    Adds the timings to the stats shared by every run, keeping the latest
+    samples of each timing and the percentiles worked out from them.
+    """
+    timings = PROFILE['timings']
+    PROFILE['timings'] = {}
+
+    filepath = os.path.join(get_script_tempfolder(), PROFILE_FILENAME)
+
+    with lock_file(filepath + '.lock'):
+        try:
+            with open(filepath, 'r') as stats_file:
+                stats = json.load(stats_file)
+        except (IOError, ValueError):
+            stats = {}
+
+        for timing, samples in timings.items():
+            entry = stats.setdefault(name, {}).setdefault(timing, { 'count' : 0, 'samples' : [] })
+            entry['count'] += len(samples)
+            entry['samples'] = (entry['samples'] + samples)[-PROFILE_SAMPLES:]
+
+            ordered = sorted(entry['samples'])
+            for percentile in PROFILE_PERCENTILES:
+                entry['p%s' % percentile] = get_percentile(ordered, percentile)
+            entry['max'] = ordered[-1]
+
+        write_file_atomic(filepath, json.dumps(stats, indent=2, sort_keys=True))
+
+    if 'handler' in timings:
+        log_detail('Profiled %s in %.3fs (%.3fs CPU).', name, timings['handler'][0], timings['handler_cpu'][0])
+
+
+def get_percentile(ordered, percentile):
+    # Nearest-rank percentile of an already sorted list.
+    index = int(math.ceil(percentile / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(index, len(ordered) - 1))]
+
+
+def get_cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def get_process_started():
+    """
+    Gets the time the process started, which is only known on Linux.
+    """
+    try:
+        with open('/proc/self/stat', 'r') as stat_file:
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', 'r') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+
+        return time.time() - uptime + float(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def get_script_name():
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0] if sys.argv and sys.argv[0] else 'nzb'
+
+
+# Tracing
+#############################################################################
+
+# Environment variables whose values are left out of traces.
+TRACE_REDACTED=['PASSWORD', 'USERNAME']
+
+TRACE={ 'record' : None, 'writer' : None }
+
+class TraceWriter(object):
+    """
+    Passes everything written to the stream through, keeping a copy of each
+    complete line for the trace.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = []
+        self.partial = ''
+
+    def write(self, data):
+        self.stream.write(data)
+
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        self.lines.extend(lines)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def trace_start(event):
+    """
+    Starts recording the event when the TraceFile option is set, capturing
+    the environment and every line the script writes to NZBGet. The record
+    is written when the script exits, so it can be replayed later with
+    nzbreplay.py.
+    """
+    filepath = get_script_option('TraceFile')
+
+    if not filepath or TRACE['record']:
+        return
+
+    if not os.path.isabs(filepath) and os.environ.get('NZBOP_TEMPDIR'):
+        filepath = os.path.join(os.environ['NZBOP_TEMPDIR'], filepath)
+
+    environment = dict(os.environ)
+    for key in environment:
+        if any(redacted in key.upper() for redacted in TRACE_REDACTED):
+            environment[key] = ''
+
+    TRACE['record'] = {
+        'filepath' : filepath,
+        'time' : time.time(),
+        'script' : get_script_name(),
+        'event' : event,
+        'argv' : sys.argv,
+        'env' : environment,
+    }
+
+    log_flush()
+    TRACE['writer'] = sys.stdout = TraceWriter(sys.stdout)
+
+
+def trace_finish(exit_code=None):
+    if not TRACE['record']:
+        return
+
+    # Buffered log lines belong in the trace too.
+    log_flush()
+
+    record, writer = TRACE['record'], TRACE['writer']
+    TRACE['record'] = TRACE['writer'] = None
+
+    if sys.stdout is writer:
+        sys.stdout = writer.stream
+
+    filepath = record.pop('filepath')
+    record['elapsed'] = round(time.time() - record['time'], 6)
+    record['exit_code'] = exit_code
+    record['output'] = [to_unicode(line) for line in writer.lines + ([writer.partial] if writer.partial else [])]
+    record['env'] = dict((key, to_unicode(value)) for key, value in record['env'].items())
+
+    try:
+        with lock_file(filepath + '.lock'):
+            with open(filepath, 'a') as trace_file:
+                trace_file.write(json.dumps(record, sort_keys=True) + '\n')
+    except IOError as e:
+        log_warning('Failed to write trace to %s (%s).', filepath, e)
+
+
+atexit.register(trace_finish)
 
 
 # NZBGet helpers
@@ -258,15 +992,13 @@ def get_nzb_age(nzbid):
     Gets the age based on the first time an article was posted.
     """
     now = datetime.datetime.utcnow()
-    groups = retry(lambda: proxy().listgroups(0))
+    group = get_queue_group(nzbid)
 
-    for group in groups:
-        group_nzbid = int(group['NZBID'])
-        if group_nzbid == nzbid:
-            timestamp = int(group['MinPostTime'])
-            last_post = datetime.datetime.fromtimestamp(timestamp)
-            delta = now - last_post
-            return int(delta.total_seconds() / 60 / 60)
+    if group:
+        timestamp = int(group['MinPostTime'])
+        last_post = datetime.datetime.fromtimestamp(timestamp)
+        delta = now - last_post
+        return int(delta.total_seconds() / 60 / 60)
 
     return 0
 
@@ -276,7 +1008,7 @@ def set_nzb_bad():
     Mark an NZB file as being bad. Note that the MarkAsBad in the XML RPC
     method doesn't seem to work.
     """
-    print('[NZB] MARK=BAD')
+    log_command('MARK=BAD')
 
 
 def get_nzb_category():
@@ -295,7 +1027,16 @@ def get_nzb_directory_final():
 
 
 def set_nzb_directory_final(directory):
-    print('[NZB] FINALDIR=%s' % directory)
+    log_command('FINALDIR=%s' % directory)
+
+
+def get_nzb_filepath():
+    """
+    Gets the path to the .nzb file, which is only available while scanning
+    (NZBNP_FILENAME) and when the NZB was added (NZBNA_QUEUEDFILE).
+    """
+    filepath = os.environ.get('NZBNP_FILENAME') or os.environ.get('NZBNA_QUEUEDFILE')
+    return filepath if filepath and os.path.isfile(filepath) else None
 
 
 def get_nzb_id():
@@ -309,9 +1050,26 @@ def set_nzb_fail(nzbid):
     reasons other than internal ones. This forces the issue by deleting as
     much data as possible to force into into a FAILURE/PAR status.
     """
-    client = proxy()
-    nzb_files = retry(lambda: client.listfiles(0, 0, nzbid))
-    
+    # Always refresh here, since deleting from a stale list could miss files
+    # that were queued after the snapshot was taken.
+    delete_ids = get_nzb_fail_ids(get_queue_files(nzbid, ttl=0))
+
+    if not editqueue('FileDelete', delete_ids):
+        log_error('Failed to delete files %s.' % delete_ids)
+        return False
+
+    invalidate_snapshot('files-%s' % nzbid)
+
+    return True
+
+
+def get_nzb_fail_ids(nzb_files):
+    """
+    Picks the files from a listfiles result to delete in order to fail the
+    NZB, which is everything but the first RAR volume.
+    """
+    delete_ids = []
+
     for nzb_file in nzb_files:
         nzb_file_id = int(nzb_file['ID'])
         nzb_file_name = nzb_file['Filename']
@@ -326,11 +1084,9 @@ def set_nzb_fail(nzbid):
 
         if delete_file:
             log_warning('Deleting %s to force a failure.' % nzb_file_name)
-            if not client.editqueue('FileDelete', 0, '', [nzb_file_id]):
-                log_error('Failed to delete file %s.' % nzb_file_id)
-                return False
+            delete_ids.append(nzb_file_id)
 
-    return True
+    return delete_ids
 
 
 def get_nzb_name():
@@ -344,9 +1100,24 @@ def get_nzb_prefix():
     or post-processing-script) a different set of parameters (env. vars)
     is passed. They also have different prefixes:
       - NZBNA_ in queue-script mode;
+      - NZBNP_ in scan-script mode;
       - NZBPP_ in pp-script mode.
     """
-    return 'NZBNA_' if 'NZBNA_EVENT' in os.environ else 'NZBPP_'
+    if 'NZBNA_EVENT' in os.environ:
+        return 'NZBNA_'
+    elif 'NZBNP_NZBNAME' in os.environ:
+        return 'NZBNP_'
+    else:
+        return 'NZBPP_'
+
+
+def get_nzb_health():
+    """
+    Gets the health of the NZB in per-mille (1000 is fully healthy), or None
+    if NZBGet didn't provide it.
+    """
+    key = get_nzb_prefix() + 'HEALTH'
+    return int(os.environ[key]) if key in os.environ else None
 
 
 def get_nzb_status():
@@ -363,141 +1134,1440 @@ def get_nzb_tempfolder():
     return os.environ.get('NZBOP_TEMPDIR')
 
 
-# Script helpers
+# Snapshot cache
 ##############################################################################
 
-def get_script_option(name):
-    return os.environ.get('NZBPO_' + name)
+SNAPSHOTS = {}
 
 
-def get_script_option_dictionary(name, separator=':'):
-    items = get_script_option(name).split(',')
+def get_snapshot(name, fetch, ttl=None):
+    """
+    Gets the named snapshot of a list returned by NZBGet, calling fetch to
+    refresh it when it is older than the ttl (seconds). Snapshots are shared
+    by every script through NZBOP_TEMPDIR, and only one script refreshes a
+    stale snapshot while the others wait and then read the new one.
 
-    dictionary = []
-    for item in items:
-        parts = item.split(separator)
-        key = parts[0]
-        value = parts[1]
-        dictionary.append({ 'key' : key, 'value' : value })
+    The snapshot is a dictionary with the timestamp, the items, and an index
+    of NZBID to the positions of the matching items.
+    """
+    if ttl is None:
+        ttl = get_snapshot_ttl()
 
-    return dictionary
+    snapshot = SNAPSHOTS.get(name)
+    if snapshot and time.time() - snapshot['timestamp'] < ttl:
+        return snapshot
 
+    filepath = get_snapshot_filepath(name)
+    snapshot = read_snapshot(filepath, ttl)
 
-def get_script_option_list(name, separator=','):
-    return get_script_option(name).split(separator)
+    if not snapshot:
+        with lock_file(filepath + '.lock'):
+            # Another script may have refreshed while we waited for the lock.
+            snapshot = read_snapshot(filepath, ttl)
 
+            if not snapshot:
+                log_debug('Refreshing snapshot %s.', name)
+                items = retry(fetch)
+                snapshot = {
+                    'timestamp' : time.time(),
+                    'items' : items,
+                    'index' : get_snapshot_index(items),
+                }
+                write_file_atomic(filepath, json.dumps(snapshot))
 
-def get_script_state(script_name, filename, default={}):
-    """
-    Checks to see if a JSON file with state data exists on disk.
-    If no file exists, it will use the provided default.
-    """
-    tempdir = get_script_tempfolder(script_name)
-    filepath = os.path.join(tempdir, filename + '.state')
+    SNAPSHOTS[name] = snapshot
 
-    if not os.path.isfile(filepath):
-        return default
-    else:
-        return json.load(open(filepath, 'r'))
+    return snapshot
 
-def set_script_state(script_name, filename, state):
-    """
-    Saves the state date to the state file.
-    """
-    tempdir = get_script_tempfolder(script_name)
-    filepath = os.path.join(tempdir, filename + '.state')
 
-    json.dump(state, open(filepath, 'w'))
+def get_snapshot_filepath(name):
+    tempdir = get_script_tempfolder(SNAPSHOT_FOLDER)
+    return os.path.join(tempdir, name + '.json')
 
-    return state
 
+def get_snapshot_index(items):
+    index = {}
 
-def get_script_tempfolder(*args):
-    tempdir = os.environ.get('NZBOP_TEMPDIR')
+    for position, item in enumerate(items):
+        if 'NZBID' in item:
+            index.setdefault(str(item['NZBID']), []).append(position)
 
-    for arg in args:
-        tempdir = os.path.join(tempdir, arg)
+    return index
 
-    if not os.path.exists(tempdir):
-        os.makedirs(tempdir)
 
-    return tempdir
+def get_snapshot_items(name, fetch, nzbid, ttl=None):
+    """
+    Gets the items in the snapshot that belong to the NZBID.
+    """
+    snapshot = get_snapshot(name, fetch, ttl)
+    positions = snapshot['index'].get(str(nzbid), [])
 
+    return [snapshot['items'][position] for position in positions]
 
-def get_script_tempfile(script_name, filename):
-    tempdir = get_script_tempfolder(script_name)
-    return os.path.join(tempdir, filename)
 
+def get_snapshot_ttl():
+    ttl = get_script_option('SnapshotTTL')
+    return int(ttl) if ttl else SNAPSHOT_TTL
 
-def get_script_variable(name, default=None):
-    key = '[NZB] NZBPR_%s' % name.upper()
-    return default if not key in os.environ else os.environ.get(key)
 
+def invalidate_snapshot(name):
+    """
+    Discards the snapshot so the next read fetches it again. Call this after
+    editing the queue when the caller needs to see the change right away.
+    """
+    SNAPSHOTS.pop(name, None)
 
-def set_script_variable(name, value):
-    print('[NZB] NZBPR_%s=%s' % (name.upper(), value))
+    filepath = get_snapshot_filepath(name)
+    if os.path.isfile(filepath):
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
 
 
-# Script locking functions
-##############################################################################
+def read_snapshot(filepath, ttl):
+    try:
+        if time.time() - os.path.getmtime(filepath) >= ttl:
+            return None
 
-def lock_create(name):
-    tempdir = get_nzb_tempfolder()
-    lockfile = os.path.join(tempdir, name + '.lock')
+        with open(filepath, 'r') as snapshot_file:
+            return json.load(snapshot_file)
+    except (IOError, OSError, ValueError):
+        return None
 
-    if os.path.isfile(lockfile):
-        log_warning('Lock file %s already exists.' % lockfile)
-    else:
-        file = open(lockfile, 'w')
-        try:
-            file.write(name)
-            log_debug('Lock file %s created.' % lockfile)
-        finally:
-            file.close()
+
+def get_queue_groups(ttl=None):
+    return get_snapshot('groups', lambda: proxy().listgroups(0), ttl)['items']
+
+
+def get_queue_group(nzbid, ttl=None):
+    items = get_snapshot_items('groups', lambda: proxy().listgroups(0), nzbid, ttl)
+    return items[0] if items else None
+
+
+def get_queue_files(nzbid, ttl=None):
+    return get_snapshot('files-%s' % nzbid, lambda: proxy().listfiles(0, 0, nzbid), ttl)['items']
+
+
+def get_history(ttl=None):
+    return get_snapshot('history', lambda: proxy().history(), ttl)['items']
+
+
+def get_history_item(nzbid, ttl=None):
+    items = get_snapshot_items('history', lambda: proxy().history(), nzbid, ttl)
+    return items[0] if items else None
+
+
+# State store
+##############################################################################
+
+STORE = threading.local()
+
+# Databases whose schema this process already made sure of, so the threads
+# of a pool don't each run it again.
+STORE_READY = set()
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    script TEXT NOT NULL,
+    name TEXT NOT NULL,
+    nzbid INTEGER,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (script, name)
+);
+CREATE INDEX IF NOT EXISTS state_nzbid ON state (nzbid);
+
+CREATE TABLE IF NOT EXISTS seen (
+    script TEXT NOT NULL,
+    nzbid INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS seen_hash ON seen (script, nzbid, kind, hash);
+CREATE INDEX IF NOT EXISTS seen_nzbid ON seen (nzbid);
+
+CREATE TABLE IF NOT EXISTS deadlines (
+    script TEXT NOT NULL,
+    nzbid INTEGER NOT NULL,
+    due REAL NOT NULL,
+    PRIMARY KEY (script, nzbid)
+);
+CREATE INDEX IF NOT EXISTS deadlines_due ON deadlines (script, due);
+
+CREATE TABLE IF NOT EXISTS locks (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    acquired REAL NOT NULL,
+    expires REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS work (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    item TEXT NOT NULL,
+    added REAL NOT NULL,
+    UNIQUE (name, item)
+);
+"""
+
+
+def get_store():
+    """
+    Gets this thread's connection to the state store, creating the database
+    on first use. The database runs in WAL mode so readers don't block the
+    script that is writing.
+    """
+    store = getattr(STORE, 'connection', None)
+
+    if store is None:
+        filepath = os.path.join(get_nzb_tempfolder(), STORE_FILENAME)
+        store = sqlite3.connect(filepath, timeout=STORE_TIMEOUT, isolation_level=None)
+        store.text_factory = str
+        store.execute('PRAGMA journal_mode=WAL')
+        store.execute('PRAGMA synchronous=NORMAL')
+
+        if filepath not in STORE_READY:
+            store.executescript(STORE_SCHEMA)
+            STORE_READY.add(filepath)
+
+        STORE.connection = store
+        STORE.depth = 0
+
+    return store
+
+
+def store_close():
+    """
+    Closes this thread's connection to the state store, unless it's in the
+    middle of a transaction. The next call to get_store() opens a new one.
+    """
+    store = getattr(STORE, 'connection', None)
+
+    if store is not None and not STORE.depth:
+        store.close()
+        STORE.connection = None
+
+
+@contextlib.contextmanager
+def store_transaction():
+    """
+    Runs the block inside a write transaction, committing when it completes
+    and rolling back if it raises. Nested blocks join the outer transaction.
+    """
+    store = get_store()
+
+    if STORE.depth == 0:
+        store.execute('BEGIN IMMEDIATE')
+
+    STORE.depth += 1
+    try:
+        yield store
+    except Exception:
+        STORE.depth -= 1
+        if STORE.depth == 0:
+            store.execute('ROLLBACK')
+        raise
+    else:
+        STORE.depth -= 1
+        if STORE.depth == 0:
+            store.execute('COMMIT')
+
+
+def get_filelist(script_name, nzbid, kind):
+    """
+    Gets the set of names saved in the script's file list for the NZB.
+    """
+    rows = get_store().execute('SELECT name FROM seen WHERE script = ? AND nzbid = ? AND kind = ?',
+        (script_name, nzbid, kind))
+
+    return set(row[0] for row in rows)
+
+
+def add_filelist(script_name, nzbid, kind, names):
+    with store_transaction() as store:
+        store.executemany('INSERT OR IGNORE INTO seen (script, nzbid, kind, hash, name) VALUES (?, ?, ?, ?, ?)',
+            [(script_name, nzbid, kind, get_name_hash(name), to_unicode(name)) for name in names])
+
+
+def filter_filelist(script_name, nzbid, kind, names, add=True):
+    """
+    Gets the names that are not in the script's file list for the NZB yet,
+    in the order they were given. Lookups go through the hash index, so the
+    cost depends on how many names are passed in rather than how many have
+    been seen before. When add is set, the new names are saved in the same
+    transaction, so two scripts checking at once can't both get the same
+    name back.
+    """
+    hashes = {}
+    for name in names:
+        hashes.setdefault(get_name_hash(name), name)
+
+    with store_transaction() as store:
+        found = set()
+        keys = hashes.keys()
+
+        # Stay well below SQLite's limit on the number of parameters.
+        for start in range(0, len(keys), STORE_BATCH_SIZE):
+            chunk = keys[start:start + STORE_BATCH_SIZE]
+            query = 'SELECT hash FROM seen WHERE script = ? AND nzbid = ? AND kind = ? AND hash IN (%s)' % ','.join('?' * len(chunk))
+            found.update(row[0] for row in store.execute(query, [script_name, nzbid, kind] + chunk))
+
+        new_names = [name for key, name in hashes.items() if key not in found]
+
+        if add and new_names:
+            add_filelist(script_name, nzbid, kind, new_names)
+
+    order = {}
+    for position, name in enumerate(names):
+        order.setdefault(name, position)
+
+    return sorted(new_names, key=order.get)
+
+
+def get_name_hash(name):
+    """
+    Gets a 64-bit hash of the name, used to keep the file list index small.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+
+    return struct.unpack('<q', hashlib.md5(name).digest()[:8])[0]
+
+
+def to_unicode(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, str) else value
+
+
+# Script helpers
+##############################################################################
+
+def get_script_option(name):
+    return os.environ.get('NZBPO_' + name)
+
+
+def get_script_option_dictionary(name, separator=':'):
+    items = get_script_option(name).split(',')
+
+    dictionary = []
+    for item in items:
+        parts = item.split(separator)
+        key = parts[0]
+        value = parts[1]
+        dictionary.append({ 'key' : key, 'value' : value })
+
+    return dictionary
+
+
+def get_script_option_list(name, separator=','):
+    return get_script_option(name).split(separator)
+
+
+def get_script_option_quoted_list(name):
+    """
+    Gets a comma-separated option whose values may be double-quoted, so that
+    they can contain commas of their own (e.g. regular expressions).
+    """
+    value = get_script_option(name)
+
+    if not value:
+        return []
+
+    values = next(csv.reader([value], skipinitialspace=True), [])
+
+    return [item.strip() for item in values if item.strip()]
+
+
+def get_script_state(script_name, filename, default={}):
+    """
+    Gets the state saved under the name for the script. If no state exists,
+    it will use the provided default.
+    """
+    row = get_store().execute('SELECT value FROM state WHERE script = ? AND name = ?',
+        (script_name, filename)).fetchone()
+
+    return default if row is None else json.loads(row[0])
+
+
+def set_script_state(script_name, filename, state, nzbid=None):
+    """
+    Saves the state under the name for the script. Passing the NZBID allows
+    the state to be looked up and cleaned up by NZB.
+    """
+    with store_transaction() as store:
+        store.execute('INSERT OR REPLACE INTO state (script, name, nzbid, value, updated) VALUES (?, ?, ?, ?, ?)',
+            (script_name, filename, nzbid, json.dumps(state), time.time()))
+
+    return state
+
+
+def update_script_state(script_name, filename, callback, default=None, nzbid=None):
+    """
+    Reads the state, passes it to the callback and saves whatever the callback
+    returns, all inside one transaction so concurrent scripts can't lose each
+    other's changes.
+    """
+    with store_transaction():
+        state = callback(get_script_state(script_name, filename, default))
+        return set_script_state(script_name, filename, state, nzbid)
+
+
+def delete_script_state(script_name, filename):
+    with store_transaction() as store:
+        store.execute('DELETE FROM state WHERE script = ? AND name = ?', (script_name, filename))
+
+
+def get_script_states(script_name):
+    """
+    Gets all of the script's state that was saved with an NZBID, keyed by
+    NZBID.
+    """
+    rows = get_store().execute('SELECT nzbid, value FROM state WHERE script = ? AND nzbid IS NOT NULL',
+        (script_name,))
+
+    return dict((nzbid, json.loads(value)) for nzbid, value in rows)
+
+
+def delete_nzb_state(nzbid, script_name):
+    """
+    Removes all of the state and file lists the script saved for the NZB,
+    and the snapshot of its queued files.
+    """
+    with store_transaction() as store:
+        store.execute('DELETE FROM state WHERE nzbid = ? AND script = ?', (nzbid, script_name))
+        store.execute('DELETE FROM seen WHERE nzbid = ? AND script = ?', (nzbid, script_name))
+        store.execute('DELETE FROM deadlines WHERE nzbid = ? AND script = ?', (nzbid, script_name))
+
+    invalidate_snapshot('files-%s' % nzbid)
+
+
+def set_deadline(script_name, nzbid, due):
+    """
+    Sets when the script next needs to act on the NZB (a time.time() value),
+    replacing any earlier deadline.
+    """
+    with store_transaction() as store:
+        store.execute('INSERT OR REPLACE INTO deadlines (script, nzbid, due) VALUES (?, ?, ?)',
+            (script_name, nzbid, due))
+
+
+def get_due_deadlines(script_name, now=None):
+    """
+    Gets the NZBIDs whose deadline has passed, earliest first. The deadlines
+    are indexed by time, so only the expired ones are read.
+    """
+    now = time.time() if now is None else now
+    rows = get_store().execute('SELECT nzbid FROM deadlines WHERE script = ? AND due <= ? ORDER BY due',
+        (script_name, now))
+
+    return [row[0] for row in rows]
+
+
+def get_next_deadline(script_name):
+    row = get_store().execute('SELECT MIN(due) FROM deadlines WHERE script = ?', (script_name,)).fetchone()
+    return row[0]
+
+
+def delete_deadlines(script_name, nzbids):
+    with store_transaction() as store:
+        store.executemany('DELETE FROM deadlines WHERE script = ? AND nzbid = ?',
+            [(script_name, nzbid) for nzbid in nzbids])
+
+
+def get_script_tempfolder(*args):
+    tempdir = os.environ.get('NZBOP_TEMPDIR')
+
+    for arg in args:
+        tempdir = os.path.join(tempdir, arg)
+
+    if not os.path.exists(tempdir):
+        os.makedirs(tempdir)
+
+    return tempdir
+
+
+def get_script_tempfile(script_name, filename):
+    tempdir = get_script_tempfolder(script_name)
+    return os.path.join(tempdir, filename)
+
+
+def get_script_variable(name, default=None):
+    key = 'NZBPR_%s' % name.upper()
+    return default if not key in os.environ else os.environ.get(key)
+
+
+def set_script_variable(name, value):
+    log_command('NZBPR_%s=%s' % (name.upper(), value))
+
+
+# Script locking functions
+##############################################################################
+
+# Seconds before a lock is considered abandoned, even if its owner is still
+# running.
+LOCK_TIMEOUT=3600
+
+# Locks are owned by the event rather than the process, since the resident
+# worker runs many events in one process. The owner starts with the process
+# ID, so a lock left behind by a process that has exited can be taken over.
+LOCK_OWNER={ 'owner' : None }
+
+def get_lock_owner():
+    if LOCK_OWNER['owner'] is None:
+        LOCK_OWNER['owner'] = '%s-%s' % (os.getpid(), base64.b16encode(os.urandom(6)).lower())
+
+    return LOCK_OWNER['owner']
+
+
+def lock_create(name, timeout=LOCK_TIMEOUT):
+    """
+    Takes the named lock for this event. A lock whose owner has exited or
+    that has expired is taken over. Returns True if the lock was taken.
+    """
+    now = time.time()
+    owner = get_lock_owner()
+
+    with store_transaction() as store:
+        row = store.execute('SELECT owner, expires FROM locks WHERE name = ?', (name,)).fetchone()
+
+        if row and row[0] != owner and not is_lock_stale(row[0], row[1], now):
+            log_debug('Lock %s is held by %s.', name, row[0])
+            return False
+
+        if row and row[0] != owner:
+            log_warning('Taking over lock %s abandoned by %s.' % (name, row[0]))
+
+        store.execute('INSERT OR REPLACE INTO locks (name, owner, acquired, expires) VALUES (?, ?, ?, ?)',
+            (name, owner, now, now + timeout))
+
+    log_debug('Lock %s created.', name)
+
+    return True
 
 
 def lock_exists(name):
-    tempdir = get_nzb_tempfolder()
-    lockfile = os.path.join(tempdir, name + '.lock')
+    row = get_store().execute('SELECT owner, expires FROM locks WHERE name = ?', (name,)).fetchone()
+    return row is not None and not is_lock_stale(row[0], row[1], time.time())
+
+
+def lock_release(name, force=False):
+    """
+    Releases the named lock if this event owns it, or regardless of the
+    owner when forced.
+    """
+    try:
+        with store_transaction() as store:
+            if force:
+                cursor = store.execute('DELETE FROM locks WHERE name = ?', (name,))
+            else:
+                cursor = store.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, get_lock_owner()))
+
+        if cursor.rowcount:
+            log_debug('Lock %s released.', name)
+    except Exception:
+        log_traceback()
+        log_error('Failed to release lock %s.' % name)
+
+
+def lock_renew(name, timeout=LOCK_TIMEOUT):
+    """
+    Pushes back the expiry of a lock this event owns. Returns False if the
+    lock was taken over in the meantime.
+    """
+    with store_transaction() as store:
+        cursor = store.execute('UPDATE locks SET expires = ? WHERE name = ? AND owner = ?',
+            (time.time() + timeout, name, get_lock_owner()))
+
+    return cursor.rowcount > 0
+
+
+def lock_reset(name, recreate=True):
+    lock_release(name, force=True)
+    if recreate: lock_create(name)
+
+
+def lock_release_owned():
+    """
+    Releases every lock this event still holds, for the resident worker,
+    which keeps running after the event is done.
+    """
+    if LOCK_OWNER['owner'] is None:
+        return
+
+    with store_transaction() as store:
+        cursor = store.execute('DELETE FROM locks WHERE owner = ?', (LOCK_OWNER['owner'],))
+
+    if cursor.rowcount:
+        log_debug('Released %s locks left by the event.', cursor.rowcount)
+
+
+def is_lock_stale(owner, expires, now):
+    try:
+        pid = int(str(owner).split('-', 1)[0])
+    except ValueError:
+        return True
+
+    return expires < now or not is_process_running(pid)
+
+
+def is_process_running(pid):
+    # On Windows, os.kill would terminate the process, so only the expiry
+    # is used there.
+    if os.name == 'nt':
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+# Queued work
+##############################################################################
+
+def queue_work(name, items):
+    """
+    Queues items for whoever holds the named lock. Queuing an item that is
+    already waiting moves it to the back, so an item being worked on right
+    now is still seen again afterwards.
+    """
+    now = time.time()
+
+    with store_transaction() as store:
+        store.executemany('INSERT OR REPLACE INTO work (name, item, added) VALUES (?, ?, ?)',
+            [(name, json.dumps(item, sort_keys=True), now) for item in items])
+
+
+def run_queued_work(name, items, callback, timeout=LOCK_TIMEOUT):
+    """
+    Queues the items and, unless another process holds the named lock,
+    takes it and calls the callback with batches of queued items until none
+    are left, including any queued by other processes in the meantime. If
+    the lock is held, the holder picks the items up before it releases the
+    lock, so nothing is dropped. Returns True if this process did the work.
+
+    Items stay queued until the callback returns, so if it fails they are
+    tried again by the next process to take the lock.
+    """
+    queue_work(name, items)
+
+    if not lock_create(name, timeout):
+        log_detail('Queued %s items for %s, which is busy.' % (len(items), name))
+        return False
+
+    try:
+        while True:
+            rows = get_store().execute('SELECT id, item FROM work WHERE name = ? ORDER BY id LIMIT ?',
+                (name, STORE_BATCH_SIZE)).fetchall()
+
+            if not rows:
+                if lock_release_idle(name):
+                    return True
+                continue
+
+            callback([json.loads(row[1]) for row in rows])
+
+            with store_transaction() as store:
+                store.executemany('DELETE FROM work WHERE id = ?', [(row[0],) for row in rows])
+
+            if not lock_renew(name, timeout):
+                log_warning('Lock %s was taken over, leaving the rest of the work.' % name)
+                return True
+    except BaseException:
+        lock_release(name)
+        raise
+
+
+def lock_release_idle(name):
+    """
+    Releases the named lock only if no work is waiting for it, checking both
+    in one transaction so nothing can be queued in between.
+    """
+    with store_transaction() as store:
+        if store.execute('SELECT 1 FROM work WHERE name = ? LIMIT 1', (name,)).fetchone():
+            return False
+
+        store.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, get_lock_owner()))
+
+    log_debug('Lock %s released.', name)
+
+    return True
+
+
+# File and path functions
+##############################################################################
+
+def get_new_files(filelist, cache_filepath=None, script_name=None, nzbid=None, kind='files'):
+    """
+    Gets the list of files in the provided filelist that haven't been seen
+    before. When a script_name and nzbid are provided, the files are checked
+    against (and added to) the script's file list in the state store, which
+    only costs as much as the filelist passed in.
+
+    If a cache_filepath is provided instead, it will join the lists together,
+    removing files that already existed in the cache.
+    """
+    if script_name is not None:
+        return filter_filelist(script_name, nzbid, kind, filelist)
+    elif cache_filepath and os.path.isfile(cache_filepath):
+        with open(cache_filepath, 'r') as cachefile:
+            cachedlist = cachefile.read().splitlines()
+            cachefile.close()
+
+        return list(set(filelist)-set(cachedlist))
+    else:
+        return filelist
+
+
+def iter_files(directory, skip_directories=[]):
+    """
+    Walks the directory tree in one pass, yielding the path and size of
+    every file. Directories whose lowercase name is in skip_directories
+    aren't entered, and symlinked directories aren't followed. With scandir,
+    the type and size come from the directory listing itself, which saves a
+    stat per entry on most platforms.
+    """
+    pending = [directory]
+
+    while pending:
+        current = pending.pop()
+
+        try:
+            entries = scandir(current) if scandir else os.listdir(current)
+        except OSError as e:
+            log_warning('Failed to read directory %s (%s).' % (current, e))
+            continue
+
+        for entry in entries:
+            try:
+                if scandir:
+                    path, name = entry.path, entry.name
+                    is_directory = entry.is_dir(follow_symlinks=False)
+                    size = None if is_directory or not entry.is_file() else entry.stat().st_size
+                else:
+                    path, name = os.path.join(current, entry), entry
+                    status = os.lstat(path)
+                    is_directory = stat.S_ISDIR(status.st_mode)
+                    if stat.S_ISLNK(status.st_mode):
+                        status = os.stat(path)
+                    size = status.st_size if stat.S_ISREG(status.st_mode) else None
+            except OSError:
+                # The file went away while we were looking at it.
+                continue
+
+            if is_directory:
+                if name.lower() not in skip_directories:
+                    pending.append(path)
+            elif size is not None:
+                yield path, size
+
+
+@contextlib.contextmanager
+def lock_file(filepath):
+    """
+    Holds an exclusive lock on the file for the duration of the block. This
+    blocks until the lock is available.
+    """
+    with open(filepath, 'a') as handle:
+        if fcntl:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield handle
+        finally:
+            if fcntl:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+def write_file_atomic(filepath, data):
+    """
+    Writes the data to a temporary file next to the target and renames it into
+    place, so readers never see a partially written file.
+    """
+    directory = os.path.dirname(filepath)
+    handle, temppath = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+
+    try:
+        with os.fdopen(handle, 'w') as tempfile_handle:
+            tempfile_handle.write(data)
+
+        if os.name == 'nt' and os.path.exists(filepath):
+            os.remove(filepath)
+
+        os.rename(temppath, filepath)
+    except Exception:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+
+
+FILE_COPY_BUFFER=8 * 1024 * 1024
+
+# ioctl that makes a file share the extents of another on filesystems with
+# reflinks (Btrfs, XFS), which also works across Btrfs subvolumes where a
+# rename doesn't.
+FICLONE=0x40049409
+
+def move_file(source, target, verify=True):
+    """
+    Moves the file, which only renames it when both paths are on the same
+    filesystem. Otherwise the file is cloned or copied to a temporary file
+    next to the target, which is renamed into place once the copy is
+    complete, so the target never holds a partial file. Returns how the file
+    was moved (rename, clone or copy).
+    """
+    try:
+        os.rename(source, target)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    partial = target + '.part'
+    log_flush()
+
+    try:
+        method = copy_file(source, partial, verify)
+        os.rename(partial, target)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    os.remove(source)
+
+    return method
+
+
+def copy_file(source, target, verify=True):
+    """
+    Clones the file when the filesystem supports it, and otherwise copies it
+    with large buffers, working out its CRC in the same pass. With verify,
+    the copy is read back and compared against that CRC. Returns clone or
+    copy.
+    """
+    checksum = 0
+    data = bytearray(FILE_COPY_BUFFER)
+
+    with open(source, 'rb') as reader:
+        with open(target, 'wb') as writer:
+            if clone_file(reader, writer):
+                return 'clone'
+
+            count = reader.readinto(data)
+            while count:
+                chunk = buffer(data, 0, count)
+                writer.write(chunk)
+                checksum = zlib.crc32(chunk, checksum)
+                count = reader.readinto(data)
+
+            writer.flush()
+            os.fsync(writer.fileno())
+
+    if verify and get_file_crc(target, data) != checksum:
+        raise IOError('Copy of %s to %s failed verification.' % (source, target))
+
+    return 'copy'
+
+
+def clone_file(reader, writer):
+    if not fcntl or not sys.platform.startswith('linux'):
+        return False
+
+    try:
+        fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+        return True
+    except IOError:
+        return False
+
+
+def get_file_crc(filepath, data=None):
+    checksum = 0
+    data = data or bytearray(FILE_COPY_BUFFER)
+
+    with open(filepath, 'rb') as reader:
+        count = reader.readinto(data)
+        while count:
+            checksum = zlib.crc32(buffer(data, 0, count), checksum)
+            count = reader.readinto(data)
+
+    return checksum
+
+
+# NZB file functions
+##############################################################################
+
+REGEX_SUBJECT_QUOTED = re.compile(r'"([^"]+)"')
+REGEX_SUBJECT_FILENAME = re.compile(r'([^\s"<>|:*?/\\]+\.[a-z0-9]{1,5}(?:\.\d{3})?)(?:\s|$)', re.IGNORECASE)
+
+def iter_nzb_files(filepath):
+    """
+    Streams the files listed in the .nzb, yielding the subject, the filename
+    guessed from it, the number of segments and bytes, and the message IDs
+    of the segments. Each element is
+    dropped once it has been read, so memory use doesn't grow with the size
+    of the NZB and callers can stop as soon as they've seen enough.
+    """
+    root = None
+    context = cElementTree.iterparse(filepath, events=('start', 'end'))
+
+    try:
+        for event, element in context:
+            if root is None:
+                root = element
+
+            if event != 'end' or get_xml_tag(element) != 'file':
+                continue
+
+            subject = element.get('subject', '')
+            articles = []
+            size = 0
+
+            for segment in element.iter():
+                if get_xml_tag(segment) == 'segment':
+                    articles.append((segment.text or '').strip())
+                    size += int(segment.get('bytes') or 0)
+
+            yield {
+                'subject' : subject,
+                'filename' : get_subject_filename(subject),
+                'segments' : len(articles),
+                'bytes' : size,
+                'articles' : articles,
+            }
+
+            root.clear()
+    except SyntaxError as e:
+        log_warning('Failed to read %s (%s).' % (filepath, e))
+
+
+def sample_nzb_articles(filepath, count):
+    """
+    Picks up to count message IDs from the .nzb at random with reservoir
+    sampling, so every article is as likely to be picked without holding
+    all of them in memory.
+    """
+    sample = []
+    seen = 0
+
+    for item in iter_nzb_files(filepath):
+        for article in item['articles']:
+            if not article:
+                continue
+
+            seen += 1
+            if len(sample) < count:
+                sample.append(article)
+            else:
+                index = random.randint(0, seen - 1)
+                if index < count:
+                    sample[index] = article
+
+    return sample
+
+
+def get_xml_tag(element):
+    # Strip the namespace, which differs between NZB writers.
+    tag = element.tag
+    return tag.rsplit('}', 1)[-1] if tag[:1] == '{' else tag
 
-    return os.path.isfile(lockfile)
 
+def get_subject_filename(subject):
+    """
+    Gets the filename from a subject line. Most posters quote it, otherwise
+    the last thing that looks like a filename is used.
+    """
+    match = REGEX_SUBJECT_QUOTED.search(subject)
+    if match:
+        return os.path.basename(match.group(1).strip())
+
+    matches = REGEX_SUBJECT_FILENAME.findall(subject)
+    return matches[-1] if matches else None
 
-def lock_release(name):
-    tempdir = get_nzb_tempfolder()
-    lockfile = os.path.join(tempdir, name + '.lock')
 
-    if os.path.isfile(lockfile):
+# NNTP functions
+##############################################################################
+
+NNTP_TIMEOUT=30
+NNTP_PIPELINE=32
+NNTP_ARTICLE_EXISTS=223
+NNTP_ARTICLE_MISSING=[423, 430]
+
+class NntpConnection(object):
+    """
+    A bare-bones NNTP connection that can only check whether articles exist.
+    STAT commands are sent in pipelined windows, so a whole window of them
+    costs a single round trip.
+    """
+    def __init__(self, server, timeout=NNTP_TIMEOUT):
+        self.server = server
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        server = self.server
+        self.sock = socket.create_connection((server['host'], int(server['port'])), self.timeout)
+
+        if server['encryption']:
+            import ssl
+            try:
+                self.sock = get_nntp_ssl_context(server).wrap_socket(self.sock, server_hostname=server['host'])
+            except ssl.CertificateError as e:
+                self.sock.close()
+                raise IOError('Server %s sent a certificate for another host (%s).' % (server['host'], e))
+
+        self.reader = self.sock.makefile('rb')
+
+        code, line = self.read_response()
+        if code not in [200, 201]:
+            raise IOError('Server %s refused the connection (%s).' % (server['host'], line))
+
+        if server['username']:
+            code, line = self.command('AUTHINFO USER %s' % server['username'])
+            if code == 381:
+                code, line = self.command('AUTHINFO PASS %s' % server['password'])
+            if code != 281:
+                raise IOError('Server %s refused the login (%s).' % (server['host'], line))
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.sendall('QUIT\r\n')
+            except socket.error:
+                pass
+            if self.reader:
+                self.reader.close()
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def command(self, line):
+        self.sock.sendall(line + '\r\n')
+        return self.read_response()
+
+    def read_response(self):
+        line = self.reader.readline()
+        if not line:
+            raise IOError('Server %s closed the connection.' % self.server['host'])
+
+        line = line.rstrip('\r\n')
         try:
-            os.remove(lockfile)
-            log_debug('Lock file %s released.' % lockfile)
-        except Exception:
-            traceback.print_exc()
-            log_error('Failed to release lock file %s.' % lockfile)
+            return int(line[:3]), line
+        except ValueError:
+            raise IOError('Server %s sent an invalid response (%s).' % (self.server['host'], line))
 
+    def stat(self, message_ids):
+        """
+        Returns how many of the articles the server has.
+        """
+        found = 0
 
-def lock_reset(name, recreate=True):
-    if lock_exists(name): lock_release(name)
-    if recreate: lock_create(name)    
+        for start in range(0, len(message_ids), NNTP_PIPELINE):
+            window = message_ids[start:start + NNTP_PIPELINE]
+            self.sock.sendall(''.join('STAT <%s>\r\n' % message_id.strip('<>') for message_id in window))
 
+            for message_id in window:
+                code, line = self.read_response()
+                if code == NNTP_ARTICLE_EXISTS:
+                    found += 1
+                elif code not in NNTP_ARTICLE_MISSING:
+                    raise IOError('Failed to check article <%s> (%s).' % (message_id, line))
 
-# File and path functions
+        return found
+
+
+def get_nntp_ssl_context(server):
+    """
+    Gets the context for an encrypted connection. The certificate and host
+    name are checked against the system's certificates, or the CertStore
+    from the NZBGet options, unless the server's verify is turned off.
+    """
+    import ssl
+
+    if not server.get('verify', True):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.verify_mode = ssl.CERT_NONE
+        return context
+
+    return ssl.create_default_context(cafile=os.environ.get('NZBOP_CERTSTORE') or None)
+
+
+def get_nntp_server(host=None, verify=True):
+    """
+    Gets the first active news server from the NZBGet options, or when host
+    is given as host:port, a plain server without a login. Encrypted
+    connections check the server's certificate unless verify is False.
+    """
+    if host:
+        host, _, port = host.partition(':')
+        return {
+            'host' : host,
+            'port' : int(port or 119),
+            'username' : None,
+            'password' : None,
+            'encryption' : False,
+            'connections' : None,
+            'verify' : verify,
+        }
+
+    number = 1
+    while 'NZBOP_SERVER%s_HOST' % number in os.environ:
+        prefix = 'NZBOP_SERVER%s_' % number
+        number += 1
+
+        if os.environ.get(prefix + 'ACTIVE', 'yes').lower() != 'yes':
+            continue
+
+        return {
+            'host' : os.environ[prefix + 'HOST'],
+            'port' : int(os.environ.get(prefix + 'PORT') or 119),
+            'username' : os.environ.get(prefix + 'USERNAME'),
+            'password' : os.environ.get(prefix + 'PASSWORD'),
+            'encryption' : os.environ.get(prefix + 'ENCRYPTION', 'no').lower() == 'yes',
+            'connections' : int(os.environ.get(prefix + 'CONNECTIONS') or 0) or None,
+            'verify' : verify,
+        }
+
+    return None
+
+
+def check_nntp_articles(server, message_ids, connections=2):
+    """
+    Checks which of the articles the server has over a few connections at
+    once, each pipelining its share of the STAT commands. Never opens more
+    connections than the server allows. Returns how many articles were
+    checked and how many were found. Articles on a connection that failed
+    aren't counted, and if every connection fails the error is raised.
+    """
+    if server.get('connections'):
+        connections = min(connections, server['connections'])
+
+    log_flush()
+
+    shares = [message_ids[index::connections] for index in range(max(1, connections))]
+    shares = [share for share in shares if share]
+    results = [None] * len(shares)
+    errors = []
+
+    def check(index):
+        connection = NntpConnection(server)
+        try:
+            connection.connect()
+            results[index] = (len(shares[index]), connection.stat(shares[index]))
+        except IOError as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=check, args=(index,)) for index in range(len(shares))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results = [result for result in results if result]
+    if errors and not results:
+        raise errors[0]
+
+    for error in errors:
+        log_warning('Failed to check articles on %s (%s).' % (server['host'], error))
+
+    return {
+        'checked' : sum(result[0] for result in results),
+        'found' : sum(result[1] for result in results),
+    }
+
+
+# Download planning
 ##############################################################################
 
-def get_new_files(filelist, cache_filepath=None):
+PLAN_SCRIPT_NAME='DownloadPlan'
+PLAN_EXTENSIONS=['.nfo', '.sfv']
+REGEX_PAR2_VOLUME = re.compile(r'.*\.vol\d+\+(\d+)\.par2$', re.IGNORECASE)
+
+def create_download_plan(filelist):
     """
-    Gets the list of files in the provided filelist. If a cache_filepath is
-    provided, it will join the lists together, removing files that already
-    existed in the cache.
+    Picks the files from a listfiles result that let us reach a verdict on
+    the NZB before most of it is downloaded: the first volume of each RAR
+    set (which holds the archive headers), the .nfo/.sfv files and the par2
+    index, and the last volume of each set. Returns them in the order they
+    should be downloaded.
+
+    The last volume tells us how many volumes the set has, but files can
+    start in any of them, so the middle volumes still have to be inspected
+    as they arrive before a set counts as fully listed.
     """
-    if cache_filepath and os.path.isfile(cache_filepath):
-        with open(cache_filepath, 'r') as cachefile:
-            cachedlist = cachefile.read().splitlines()
-            cachefile.close()
+    sets = {}
+    small = []
+    par2_index = None
 
-        return list(set(filelist)-set(cachedlist))
-    else:
-        return filelist
+    for item in filelist:
+        filename = item['Filename']
+        lower = filename.lower()
+        index = get_rar_volume_index(filename)
+
+        if index is not None:
+            sets.setdefault(get_rar_set_name(filename).lower(), []).append((index, item))
+        elif os.path.splitext(lower)[1] in PLAN_EXTENSIONS:
+            small.append(item)
+        elif lower.endswith('.par2') and not REGEX_PAR2_VOLUME.match(filename):
+            if par2_index is None or get_xml_file_size(item) < get_xml_file_size(par2_index):
+                par2_index = item
+
+    firsts = []
+    lasts = []
+
+    for name in sorted(sets):
+        volumes = sorted(sets[name], key=lambda volume: volume[0])
+        firsts.append(volumes[0][1])
+
+        if len(volumes) > 1:
+            lasts.append(volumes[-1][1])
+
+    if par2_index:
+        small.append(par2_index)
+
+    return [{
+        'fileid' : int(item['ID']),
+        'filename' : item['Filename'],
+        'size' : get_xml_file_size(item),
+    } for item in firsts + small + lasts]
+
+
+def get_download_plan(nzbid):
+    """
+    Gets the plan already applied to the NZB, if any, so that scripts don't
+    sort the queue again.
+    """
+    return get_script_state(PLAN_SCRIPT_NAME, 'plan-%s' % nzbid, None)
+
+
+def set_download_plan(nzbid, plan):
+    set_script_state(PLAN_SCRIPT_NAME, 'plan-%s' % nzbid, plan, nzbid)
+
+
+def delete_download_plan(nzbid):
+    delete_script_state(PLAN_SCRIPT_NAME, 'plan-%s' % nzbid)
+
+
+def get_xml_file_size(item):
+    return (int(item.get('FileSizeHi', 0)) << 32) + int(item.get('FileSizeLo', 0))
+
+
+# PAR2 functions
+##############################################################################
+
+PAR2_MAGIC='PAR2\x00PKT'
+PAR2_HEADER=struct.Struct('<8sQ16s16s16s')
+PAR2_BODY_LIMIT=1024 * 1024
+PAR2_SCAN_CHUNK=1024 * 1024
+PAR2_HASH_LENGTH=16 * 1024
+
+# Packet types.
+PAR2_PACKET_MAIN='PAR 2.0\x00Main\x00\x00\x00\x00'
+PAR2_PACKET_FILE='PAR 2.0\x00FileDesc'
+PAR2_PACKET_RECOVERY='PAR 2.0\x00RecvSlic'
+
+def iter_par2_packets(filepath):
+    """
+    Streams the packets of a par2 file, yielding the type and body of each.
+    The bodies of recovery slices are skipped rather than read, so even a
+    large volume only costs a read per packet header. Damaged or missing
+    parts of a partially downloaded file are stepped over by looking for the
+    next packet signature, and packets that fail their MD5 are dropped.
+    """
+    with open(filepath, 'rb') as handle:
+        size = get_file_size(handle)
+        offset = 0
+
+        while offset is not None and offset + PAR2_HEADER.size <= size:
+            handle.seek(offset)
+            magic, length, checksum, recovery_set, packet_type = PAR2_HEADER.unpack(handle.read(PAR2_HEADER.size))
+
+            if magic != PAR2_MAGIC or length < PAR2_HEADER.size or length % 4 or offset + length > size:
+                offset = find_par2_packet(handle, offset + 1)
+                continue
+
+            if packet_type == PAR2_PACKET_RECOVERY:
+                yield packet_type, None
+            elif length - PAR2_HEADER.size <= PAR2_BODY_LIMIT:
+                body = handle.read(length - PAR2_HEADER.size)
+
+                if hashlib.md5(recovery_set + packet_type + body).digest() != checksum:
+                    offset = find_par2_packet(handle, offset + 1)
+                    continue
+
+                yield packet_type, body
+
+            offset += length
+
+
+def find_par2_packet(handle, offset):
+    """
+    Returns the offset of the next packet signature, or None if there are
+    no more packets.
+    """
+    handle.seek(offset)
+
+    while True:
+        data = handle.read(PAR2_SCAN_CHUNK)
+        if len(data) < len(PAR2_MAGIC):
+            return None
+
+        position = data.find(PAR2_MAGIC)
+        if position >= 0:
+            return offset + position
+
+        # Keep enough of the chunk to find a signature split across reads.
+        offset += len(data) - len(PAR2_MAGIC) + 1
+        handle.seek(offset)
+
+
+def get_par2_info(filepath):
+    """
+    Reads the slice size, the description of every file in the recovery set
+    and the number of recovery blocks in a par2 file. Files are keyed by
+    their par2 file ID, and each has its name, size, MD5 and the MD5 of its
+    first 16 KiB.
+    """
+    info = { 'slice_size' : None, 'files' : {}, 'blocks' : 0 }
+
+    for packet_type, body in iter_par2_packets(filepath):
+        if packet_type == PAR2_PACKET_RECOVERY:
+            info['blocks'] += 1
+        elif packet_type == PAR2_PACKET_MAIN and len(body) >= 12:
+            info['slice_size'] = struct.unpack_from('<Q', body)[0]
+        elif packet_type == PAR2_PACKET_FILE and len(body) > 56:
+            fileid, md5, md5_16k, size = struct.unpack_from('<16s16s16sQ', body)
+            info['files'][fileid.encode('hex')] = {
+                'filename' : body[56:].rstrip('\x00'),
+                'size' : size,
+                'md5' : md5.encode('hex'),
+                'md5_16k' : md5_16k.encode('hex'),
+            }
+
+    return info
+
+
+def get_par2_hash(filepath):
+    """
+    Gets the MD5 of the first 16 KiB of the file, which par2 keeps for every
+    file so that renamed files can be told apart by their start alone.
+    """
+    with open(filepath, 'rb') as handle:
+        return hashlib.md5(handle.read(PAR2_HASH_LENGTH)).hexdigest()
+
+
+def find_par2_index(directory):
+    """
+    Finds the smallest par2 file in the directory, which is the index when
+    it's there. Returns None if there's no par2 file.
+    """
+    found = None
+
+    for filename in os.listdir(directory):
+        if not filename.lower().endswith('.par2'):
+            continue
+
+        filepath = os.path.join(directory, filename)
+        size = os.path.getsize(filepath)
+
+        if found is None or size < found[0]:
+            found = (size, filepath)
+
+    return found[1] if found else None
+
+
+# Repair budget
+##############################################################################
+
+def get_repair_budget(group, filelist, directory=None):
+    """
+    Works out whether par2 can still repair an NZB that is downloading, from
+    its listgroups counters and the par2 files listed in the queue or
+    already written to its directory. Returns the failed and recovery bytes,
+    the recovery block count and whether a repair is still possible, which
+    is None when the NZB has no par2 files to go by.
+
+    Once a par2 file is in the directory, the recovery bytes are the blocks
+    times its slice size, since the volumes also hold copies of the file
+    descriptions. Until then the size of the volumes is used.
+
+    Every failed article damages at least its own bytes, and the recovery
+    blocks can't restore more bytes than they hold, so once the failed bytes
+    outgrow the recovery bytes the repair is bound to fail. NZBGet's Health
+    only counts failures outside the par2 files, so the rest of the failed
+    bytes are lost from the volumes and come off the recovery bytes instead.
+    """
+    total_articles = int(group.get('TotalArticles', 0))
+    failed_articles = int(group.get('FailedArticles', 0))
+    size = get_xml_file_size(group)
+
+    failed = 0
+    if total_articles:
+        failed = failed_articles * size / total_articles
+
+    par2_size = 0
+    volume_size = 0
+    blocks = 0
+    slice_size = None
+    seen = set()
+
+    for item in filelist:
+        if item['Filename'].lower().endswith('.par2'):
+            par2_size += get_xml_file_size(item)
+            seen.add(item['Filename'].lower())
+
+        match = REGEX_PAR2_VOLUME.match(item['Filename'])
+        if match:
+            volume_size += get_xml_file_size(item)
+            blocks += int(match.group(1))
+
+    # Files that finished downloading have left the queue.
+    if directory and os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if not filename.lower().endswith('.par2') or filename.lower() in seen:
+                continue
+
+            filesize = os.path.getsize(os.path.join(directory, filename))
+            par2_size += filesize
+            seen.add(filename.lower())
+
+            match = REGEX_PAR2_VOLUME.match(filename)
+            if match:
+                volume_size += filesize
+                blocks += int(match.group(1))
+
+        index = find_par2_index(directory)
+        slice_size = get_par2_info(index)['slice_size'] if index else None
+
+    budget = {
+        'failed' : failed,
+        'recovery' : blocks * slice_size if slice_size else volume_size,
+        'blocks' : blocks,
+        'possible' : None,
+    }
+
+    if not seen:
+        return budget
+
+    health = group.get('Health')
+    if health is not None and size > par2_size and volume_size:
+        budget['failed'] = min(failed, (1000 - int(health)) * (size - par2_size) / 1000)
+        lost = min(failed - budget['failed'], volume_size)
+        budget['recovery'] = budget['recovery'] * (volume_size - lost) / volume_size
+
+    budget['possible'] = budget['failed'] <= budget['recovery']
+
+    # NZBGet works out the same thing from the par2 sizes it knows about.
+    critical = group.get('CriticalHealth')
+    if health is not None and critical is not None and int(health) < int(critical):
+        budget['possible'] = False
+
+    return budget
 
 
 # RAR functions
@@ -506,6 +2576,8 @@ def get_new_files(filelist, cache_filepath=None):
 RAR_PASSWORD_STRINGS='*,wrong password,The specified password is incorrect,encrypted headers'
 REGEX_RAR = re.compile('.*\.r(\d+)', re.IGNORECASE)
 REGEX_RAR_PART = re.compile('.*\.part(\d+)\.rar', re.IGNORECASE)
+REGEX_RAR_SET = re.compile(r'^(.*?)(\.part\d+\.rar|\.rar|\.[rs]\d+)$', re.IGNORECASE)
+REGEX_RAR_VOLUME = re.compile(r'.*\.[rs](\d+)$', re.IGNORECASE)
 
 def get_rar():
     """
@@ -525,20 +2597,513 @@ def get_rar():
     return filename
 
 
+RAR4_SIGNATURE='Rar!\x1a\x07\x00'
+RAR5_SIGNATURE='Rar!\x1a\x07\x01\x00'
+RAR_SFX_LIMIT=2 * 1024 * 1024
+RAR_SFX_EXTENSIONS=['.exe', '.rar', '.sfx']
+RAR_HEADER_LIMIT=2 * 1024 * 1024
+
+# RAR 1.5-4.x block types and flags.
+RAR4_BLOCK_MAIN=0x73
+RAR4_BLOCK_FILE=0x74
+RAR4_BLOCK_OLD_SUB=0x77
+RAR4_BLOCK_END=0x7b
+RAR4_LONG_BLOCK=0x8000
+RAR4_MAIN_VOLUME=0x0001
+RAR4_MAIN_COMMENT=0x0002
+RAR4_MAIN_SOLID=0x0008
+RAR4_MAIN_PASSWORD=0x0080
+RAR4_MAIN_FIRSTVOLUME=0x0100
+RAR4_MAIN_ENCRYPTVER=0x0200
+RAR4_FILE_SPLIT_BEFORE=0x0001
+RAR4_FILE_SPLIT_AFTER=0x0002
+RAR4_FILE_PASSWORD=0x0004
+RAR4_FILE_COMMENT=0x0008
+RAR4_FILE_DIRECTORY=0x00e0
+RAR4_FILE_LARGE=0x0100
+RAR4_FILE_UNICODE=0x0200
+RAR4_END_NEXT_VOLUME=0x0001
+RAR4_END_DATACRC=0x0002
+RAR4_END_VOLNUMBER=0x0008
+
+# RAR 5.x header types and flags.
+RAR5_HEADER_MAIN=1
+RAR5_HEADER_FILE=2
+RAR5_HEADER_ENCRYPTION=4
+RAR5_HEADER_END=5
+RAR5_FLAG_EXTRA=0x0001
+RAR5_FLAG_DATA=0x0002
+RAR5_FLAG_SPLIT_BEFORE=0x0008
+RAR5_FLAG_SPLIT_AFTER=0x0010
+RAR5_MAIN_VOLUME=0x0001
+RAR5_MAIN_VOLNUMBER=0x0002
+RAR5_MAIN_SOLID=0x0004
+RAR5_FILE_DIRECTORY=0x0001
+RAR5_FILE_MTIME=0x0002
+RAR5_FILE_CRC=0x0004
+RAR5_EXTRA_ENCRYPTION=0x01
+RAR5_END_NOT_LAST=0x0001
+
+
+def get_rar_info(filepath):
+    """
+    Reads the block headers of a RAR 4 or RAR 5 archive without extracting
+    anything. Only the headers are read; the packed data is skipped with a
+    seek, so this works on a partially downloaded volume too, returning
+    whatever it could read before the file ended.
+
+    Returns None if the file isn't a RAR archive, otherwise a dictionary with
+    the format, the volume flags and number, whether the headers are
+    encrypted, and the entries (filename, size, encrypted, directory and the
+    split flags). The number of the first volume is 0.
+    """
+    info = {}
+    entries = list(iter_rar_headers(filepath, info))
+
+    if not info.get('format'):
+        return None
+
+    info['entries'] = entries
+
+    return info
+
+
+def iter_rar_headers(filepath, info):
+    """
+    Yields the entries of the archive as their headers are read, filling in
+    the rest of the details in info. The details are only complete once all
+    of the entries have been read; info['format'] stays None if the file
+    isn't a RAR archive.
+    """
+    info['format'] = None
+
+    try:
+        with open(filepath, 'rb') as handle:
+            # Only look past the start of the file when the name suggests it
+            # could be a self-extracting archive.
+            name, extension = os.path.splitext(filepath.lower())
+            scan = extension in RAR_SFX_EXTENSIONS or is_rar_file(filepath)
+            offset, version = find_rar_signature(handle, scan)
+            if offset is None:
+                return
+
+            info.update({
+                'format' : version,
+                'volume' : False,
+                'first_volume' : True,
+                'volume_number' : None,
+                'last_volume' : None,
+                'solid' : False,
+                'encrypted_headers' : False,
+                'truncated' : False,
+                'corrupt' : False,
+            })
+
+            reader = read_rar4_headers if version == 4 else read_rar5_headers
+            for entry in reader(handle, offset, info):
+                yield entry
+    except IOError as e:
+        log_error('Failed reading RAR headers for %s. Error was %s.' % (filepath, e))
+        info['format'] = None
+        return
+
+    if info['volume_number'] is None and (info['first_volume'] or not info['volume']):
+        info['volume_number'] = 0
+
+
+def find_rar_signature(handle, scan=False):
+    """
+    Finds the RAR signature at the start of the file, or when scan is set,
+    inside the stub of a self-extracting archive. Returns the offset just
+    past the signature and the format version.
+    """
+    data = handle.read(len(RAR5_SIGNATURE))
+
+    if data.startswith(RAR5_SIGNATURE):
+        return len(RAR5_SIGNATURE), 5
+    elif data.startswith(RAR4_SIGNATURE):
+        return len(RAR4_SIGNATURE), 4
+    elif not scan:
+        return None, None
+
+    handle.seek(0)
+    data = handle.read(RAR_SFX_LIMIT)
+
+    position = data.find(RAR4_SIGNATURE[:6])
+    while position >= 0:
+        if data.startswith(RAR5_SIGNATURE, position):
+            return position + len(RAR5_SIGNATURE), 5
+        elif data.startswith(RAR4_SIGNATURE, position):
+            return position + len(RAR4_SIGNATURE), 4
+        position = data.find(RAR4_SIGNATURE[:6], position + 1)
+
+    return None, None
+
+
+def read_rar4_headers(handle, offset, info):
+    while True:
+        handle.seek(offset)
+        base = handle.read(7)
+        if len(base) < 7:
+            info['truncated'] = offset != get_file_size(handle)
+            return
+
+        crc, block_type, flags, size = struct.unpack('<HBHH', base)
+        if size < 7:
+            info['corrupt'] = True
+            return
+
+        header = handle.read(size - 7)
+        if len(header) < size - 7:
+            info['truncated'] = True
+            return
+
+        if not check_rar4_crc(crc, block_type, flags, base, header):
+            info['corrupt'] = True
+            return
+
+        data_size = 0
+        if flags & RAR4_LONG_BLOCK and len(header) >= 4:
+            data_size = struct.unpack('<I', header[:4])[0]
+
+        if block_type == RAR4_BLOCK_MAIN:
+            info['volume'] = bool(flags & RAR4_MAIN_VOLUME)
+            info['first_volume'] = bool(flags & RAR4_MAIN_FIRSTVOLUME) or not info['volume']
+            info['solid'] = bool(flags & RAR4_MAIN_SOLID)
+
+            # Everything after the main header is encrypted.
+            if flags & RAR4_MAIN_PASSWORD:
+                info['encrypted_headers'] = True
+                return
+        elif block_type == RAR4_BLOCK_FILE:
+            entry, data_size = parse_rar4_file(flags, header)
+            if entry is None:
+                info['corrupt'] = True
+                return
+
+            # Older archives have no first volume flag, but a file continued
+            # from a previous volume tells us this isn't the first one.
+            if entry['split_before']:
+                info['first_volume'] = False
+
+            yield entry
+        elif block_type == RAR4_BLOCK_END:
+            info['last_volume'] = not flags & RAR4_END_NEXT_VOLUME
+            position = 4 if flags & RAR4_END_DATACRC else 0
+            if flags & RAR4_END_VOLNUMBER and len(header) >= position + 2:
+                info['volume_number'] = struct.unpack('<H', header[position:position + 2])[0]
+            return
+
+        offset += size + data_size
+
+
+def check_rar4_crc(crc, block_type, flags, base, header):
+    """
+    Checks the header CRC, which only covers part of the header for some of
+    the older block types.
+    """
+    if block_type == RAR4_BLOCK_MAIN:
+        # Any comment embedded in the main header isn't covered.
+        header = header[:7 if flags & RAR4_MAIN_ENCRYPTVER else 6]
+    elif block_type == RAR4_BLOCK_FILE and flags & RAR4_FILE_COMMENT:
+        return True
+    elif block_type == RAR4_BLOCK_OLD_SUB:
+        # RAR 2.x includes the data in the CRC, so it can't be checked here.
+        return True
+
+    return zlib.crc32(base[2:] + header) & 0xffff == crc
+
+
+def parse_rar4_file(flags, header):
+    if len(header) < 25:
+        return None, 0
+
+    packed_size, size, host_os, file_crc, mtime, version, method, name_size, attributes = struct.unpack('<IIBIIBBHI', header[:25])
+    position = 25
+
+    if flags & RAR4_FILE_LARGE:
+        if len(header) < position + 8:
+            return None, 0
+        high_packed_size, high_size = struct.unpack('<II', header[position:position + 8])
+        packed_size += high_packed_size << 32
+        size += high_size << 32
+        position += 8
+
+    name = header[position:position + name_size]
+    if flags & RAR4_FILE_UNICODE:
+        name = decode_rar4_filename(name)
+
+    # Archives created on DOS and Windows use backslashes.
+    name = name.replace('\\', '/')
+
+    entry = {
+        'filename' : name,
+        'size' : size,
+        'packed_size' : packed_size,
+        'encrypted' : bool(flags & RAR4_FILE_PASSWORD),
+        'directory' : flags & RAR4_FILE_DIRECTORY == RAR4_FILE_DIRECTORY,
+        'split_before' : bool(flags & RAR4_FILE_SPLIT_BEFORE),
+        'split_after' : bool(flags & RAR4_FILE_SPLIT_AFTER),
+    }
+
+    return entry, packed_size
+
+
+def decode_rar4_filename(name):
+    """
+    Decodes the compressed unicode form RAR 3/4 stores after the plain name,
+    returning it as UTF-8. Falls back to the plain name if it can't.
+    """
+    if '\x00' not in name:
+        return name
+
+    plain, encoded = name.split('\x00', 1)
+    if not encoded:
+        return plain
+
+    try:
+        data = [ord(char) for char in encoded]
+        high = data[0]
+        position = 1
+        flags = 0
+        flagbits = 0
+        chars = []
+
+        while position < len(data):
+            if flagbits == 0:
+                flags = data[position]
+                position += 1
+                flagbits = 8
+
+            flagbits -= 2
+            mode = (flags >> flagbits) & 3
+
+            if mode == 0:
+                chars.append(data[position])
+                position += 1
+            elif mode == 1:
+                chars.append(data[position] | (high << 8))
+                position += 1
+            elif mode == 2:
+                chars.append(data[position] | (data[position + 1] << 8))
+                position += 2
+            else:
+                length = data[position]
+                position += 1
+                if length & 0x80:
+                    correction = data[position]
+                    position += 1
+                    for _ in range((length & 0x7f) + 2):
+                        chars.append(((ord(plain[len(chars)]) + correction) & 0xff) | (high << 8))
+                else:
+                    for _ in range(length + 2):
+                        chars.append(ord(plain[len(chars)]))
+
+        return u''.join(unichr(char) for char in chars).encode('utf-8')
+    except (IndexError, ValueError):
+        return plain
+
+
+def read_rar5_headers(handle, offset, info):
+    while True:
+        handle.seek(offset)
+        prefix = handle.read(7)
+        if len(prefix) < 5:
+            info['truncated'] = offset != get_file_size(handle)
+            return
+
+        try:
+            size, position = read_rar5_vint(prefix, 4)
+        except IndexError:
+            info['truncated'] = True
+            return
+
+        if size > RAR_HEADER_LIMIT:
+            info['corrupt'] = True
+            return
+
+        handle.seek(offset)
+        block = handle.read(position + size)
+        if len(block) < position + size:
+            info['truncated'] = True
+            return
+
+        if zlib.crc32(block[4:]) & 0xffffffff != struct.unpack('<I', block[:4])[0]:
+            info['corrupt'] = True
+            return
+
+        try:
+            data_size, entry = parse_rar5_header(block, position, info)
+        except (IndexError, struct.error):
+            info['corrupt'] = True
+            return
+
+        if entry:
+            yield entry
+
+        if data_size is None:
+            return
+
+        offset += position + size + data_size
+
+
+def parse_rar5_header(block, position, info):
+    """
+    Parses a single RAR 5 header and returns the size of its data area, or
+    None when there is nothing more that can be read, and the entry for a
+    file header.
+    """
+    header_type, position = read_rar5_vint(block, position)
+    flags, position = read_rar5_vint(block, position)
+
+    extra_size = data_size = 0
+    if flags & RAR5_FLAG_EXTRA:
+        extra_size, position = read_rar5_vint(block, position)
+    if flags & RAR5_FLAG_DATA:
+        data_size, position = read_rar5_vint(block, position)
+
+    if header_type == RAR5_HEADER_MAIN:
+        archive_flags, position = read_rar5_vint(block, position)
+        info['volume'] = bool(archive_flags & RAR5_MAIN_VOLUME)
+        info['solid'] = bool(archive_flags & RAR5_MAIN_SOLID)
+
+        # The volume number is left out of the first volume.
+        if archive_flags & RAR5_MAIN_VOLNUMBER:
+            info['volume_number'], position = read_rar5_vint(block, position)
+            info['first_volume'] = info['volume_number'] == 0
+    elif header_type == RAR5_HEADER_FILE:
+        file_flags, position = read_rar5_vint(block, position)
+        size, position = read_rar5_vint(block, position)
+        attributes, position = read_rar5_vint(block, position)
+        if file_flags & RAR5_FILE_MTIME:
+            position += 4
+        if file_flags & RAR5_FILE_CRC:
+            position += 4
+        compression, position = read_rar5_vint(block, position)
+        host_os, position = read_rar5_vint(block, position)
+        name_size, position = read_rar5_vint(block, position)
+        name = block[position:position + name_size]
+
+        return data_size, {
+            'filename' : name,
+            'size' : size,
+            'packed_size' : data_size,
+            'encrypted' : has_rar5_extra(block, extra_size, RAR5_EXTRA_ENCRYPTION),
+            'directory' : bool(file_flags & RAR5_FILE_DIRECTORY),
+            'split_before' : bool(flags & RAR5_FLAG_SPLIT_BEFORE),
+            'split_after' : bool(flags & RAR5_FLAG_SPLIT_AFTER),
+        }
+    elif header_type == RAR5_HEADER_ENCRYPTION:
+        # Everything after the encryption header is encrypted.
+        info['encrypted_headers'] = True
+        return None, None
+    elif header_type == RAR5_HEADER_END:
+        end_flags, position = read_rar5_vint(block, position)
+        info['last_volume'] = not end_flags & RAR5_END_NOT_LAST
+        return None, None
+
+    return data_size, None
+
+
+def has_rar5_extra(block, extra_size, record_type):
+    position = len(block) - extra_size
+
+    while position < len(block):
+        record_size, start = read_rar5_vint(block, position)
+        current_type, _ = read_rar5_vint(block, start)
+        if current_type == record_type:
+            return True
+        position = start + record_size
+
+    return False
+
+
+def get_file_size(handle):
+    return os.fstat(handle.fileno()).st_size
+
+
+def read_rar5_vint(data, position):
+    """
+    Reads a RAR 5 variable length integer, returning it and the position
+    just past it.
+    """
+    result = 0
+    shift = 0
+
+    while True:
+        byte = ord(data[position])
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
 def get_rar_filelist(filepath):
     """
-    Gets the list of the file contents from a RAR file.
+    Gets the list of the file contents from a RAR file. The headers are read
+    directly, and unrar is only used when they look damaged.
+    """
+    return [entry['filename'] for entry in iter_rar_entries(filepath)]
+
+
+def iter_rar_entries(filepath, info=None):
+    """
+    Yields the entries of a RAR file as they are read, so callers can stop
+    as soon as they've seen enough without the whole listing being held in
+    memory. When the headers look damaged, the listing is streamed from
+    unrar instead, which is killed if the caller stops early.
     """
+    if info is None:
+        info = {}
+
+    count = 0
+
+    for entry in iter_rar_headers(filepath, info):
+        count += 1
+        yield entry
+
+    if info['format'] and info['corrupt'] and not count:
+        for entry in iter_unrar_entries(filepath):
+            yield entry
+
+
+def iter_unrar_entries(filepath):
+    devnull = open(os.devnull, 'w')
+
+    start = time.time()
+
     try:
         rar_command = [get_rar(), 'vb', filepath]
-        process = subprocess.Popen(rar_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        filelist, error = process.communicate()
-
-        return filelist.splitlines()
+        process = subprocess.Popen(rar_command, stdout=subprocess.PIPE, stderr=devnull)
     except Exception as e:
-        traceback.print_exc()
+        devnull.close()
+        log_traceback()
         log_error('Failed checking RAR contents for %s. Error was %s.' % (filepath, e))
-        pass
+        return
+
+    try:
+        # Read line by line; iterating the pipe would wait to fill a buffer.
+        for line in iter(process.stdout.readline, ''):
+            filename = line.rstrip('\r\n').replace('\\', '/')
+            if filename:
+                yield {
+                    'filename' : filename,
+                    'size' : None,
+                    'packed_size' : None,
+                    'encrypted' : False,
+                    'directory' : False,
+                    'split_before' : False,
+                    'split_after' : False,
+                }
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        devnull.close()
+        profile_record('subprocess:unrar', time.time() - start)
+
 
 def get_rar_xmlfiles(filelist):
     """
@@ -571,14 +3136,44 @@ def get_rar_number(filename):
         return int(match.group(1))
 
 
+def get_rar_set_name(filename):
+    """
+    Gets the name shared by all of the volumes of a RAR archive, or the
+    filename itself if it doesn't look like a volume.
+    """
+    match = REGEX_RAR_SET.match(filename)
+    return match.group(1) if match else filename
+
+
+def get_rar_volume_index(filename):
+    """
+    Gets the position of the volume within its set, where the first volume
+    is the lowest. Returns None if the file isn't a RAR volume.
+    """
+    match = REGEX_RAR_PART.match(filename)
+    if match:
+        return int(match.group(1))
+
+    # Old-style sets start at .rar and continue with .r00, .r01, ...
+    if filename.lower().endswith('.rar'):
+        return -1
+
+    match = REGEX_RAR_VOLUME.match(filename)
+    if match:
+        return int(match.group(1))
+
+
 def is_rar_file(filename):
     match = REGEX_RAR.match(filename) or REGEX_RAR_PART.match(filename)
     return True if match else False
 
 
 def is_rar_password_error(text, error):
-    log_debug(text.translate(None, '\r\n'))
-    log_debug(error.translate(None, '\r\n'))
+    # The unrar output is long, so only clean it up when it's going to be
+    # written.
+    if log_enabled('DEBUG'):
+        log_debug(text.translate(None, '\r\n'))
+        log_debug(error.translate(None, '\r\n'))
 
     password_strings = RAR_PASSWORD_STRINGS.split(',')
 
@@ -592,20 +3187,148 @@ def is_rar_password_error(text, error):
 
 def is_rar_protected(filepath):
     """
-    Attempts to check if the RAR is password protected.
+    Attempts to check if the RAR is password protected, either because the
+    headers are encrypted or any of the files are. The headers are read
+    directly, and unrar is only used when they look damaged.
     """
+    info = get_rar_info(filepath)
+
+    if info is None:
+        return False
+    elif info['encrypted_headers'] or info['entries'] or not info['corrupt']:
+        return is_rar_info_protected(info)
+
     try:
+        start = time.time()
         rar_command = [get_rar(), 'l', '-p-', '-c-', filepath]
         rar_process = subprocess.Popen(rar_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         text, error = rar_process.communicate()
+        profile_record('subprocess:unrar', time.time() - start)
 
         return is_rar_password_error(text, error)
     except Exception as e:
-        traceback.print_exc()
+        log_traceback()
         log_error('Failed checking RAR %s for password. Error was %s.' % (filepath, e))
         return False
 
 
+def is_rar_info_protected(info):
+    if info['encrypted_headers']:
+        return True
+
+    for entry in info['entries']:
+        if entry['encrypted']:
+            return True
+
+    return False
+
+
+# Rule matching
+##############################################################################
+
+# Python 2 only allows 100 groups in a single expression.
+GROUPS_PER_PATTERN=99
+
+# Patterns with back-references, named groups or inline flags can't share an
+# expression.
+REGEX_STANDALONE_PATTERN=re.compile(r'\\[1-9]|\(\?P[=<]|\(\?[iLmsux]+\)')
+
+
+def compile_rules(rules):
+    """
+    Compiles a list of rules into a matcher that checks a filename against
+    all of them in one go. Each rule is a dict with the kind ('name',
+    'extension' or 'pattern'), the value, the group it belongs to and the
+    reason to report. Rules with 'exclude' set stop the other rules of their
+    group from matching.
+
+    Names and extensions are looked up in hash tables and patterns are
+    combined into as few expressions as possible.
+    """
+    matcher = { 'rules' : rules, 'names' : {}, 'extensions' : {}, 'patterns' : [] }
+    combined = []
+    groups = 0
+
+    for index, rule in enumerate(rules):
+        kind = rule['kind']
+        value = rule['value']
+
+        if kind == 'pattern':
+            try:
+                compiled = re.compile(value)
+            except re.error as e:
+                log_warning('Ignoring invalid pattern %s (%s).' % (value, e))
+                continue
+
+            # Back-references would point at the wrong group once the pattern
+            # is wrapped, two patterns could use the same group name, and
+            # inline flags would apply to every pattern.
+            if REGEX_STANDALONE_PATTERN.search(value) or compiled.groups >= GROUPS_PER_PATTERN:
+                matcher['patterns'].append((compiled, index))
+                continue
+
+            if groups + compiled.groups + 1 > GROUPS_PER_PATTERN:
+                matcher['patterns'].extend(combine_patterns(combined))
+                combined = []
+                groups = 0
+
+            combined.append((compiled, index))
+            groups += compiled.groups + 1
+        else:
+            matcher[kind + 's'].setdefault(value.lower(), []).append(index)
+
+    matcher['patterns'].extend(combine_patterns(combined))
+
+    return matcher
+
+
+def combine_patterns(patterns):
+    """
+    Joins the compiled patterns into one expression, with a named group
+    around each that tells which one matched. Falls back to checking them
+    one by one if they can't be joined.
+    """
+    if len(patterns) < 2:
+        return patterns
+
+    try:
+        return [(re.compile('|'.join('(?P<_r%s>%s)' % (index, compiled.pattern) for compiled, index in patterns)), None)]
+    except re.error as e:
+        log_debug('Checking patterns one by one, since they could not be combined (%s).', e)
+        return patterns
+
+
+def match_rules(matcher, filename):
+    """
+    Returns the first rule that matches the filename, or None. Names and
+    extensions are matched against the base name, ignoring case, while
+    patterns are searched for in the whole filename.
+    """
+    name, extension = os.path.splitext(os.path.basename(filename))
+
+    indexes = set(matcher['names'].get(name.lower(), ()))
+    indexes.update(matcher['extensions'].get(extension.lower(), ()))
+
+    for regex, index in matcher['patterns']:
+        match = regex.search(filename)
+        if match:
+            # The wrapping group closes last, so it's the one reported.
+            indexes.add(index if index is not None else int(match.lastgroup[2:]))
+
+    if not indexes:
+        return None
+
+    rules = matcher['rules']
+    excluded = set(rules[index]['group'] for index in indexes if rules[index].get('exclude'))
+
+    for index in sorted(indexes):
+        rule = rules[index]
+        if not rule.get('exclude') and rule['group'] not in excluded:
+            return rule
+
+    return None
+
+
 # Other helpers
 ##############################################################################
 
@@ -615,8 +3338,12 @@ def retry(callback, max_retries=3, seconds=0.1, pushout=True):
     while count < max_retries:
         try:
             return callback()
+        except xmlrpclib.Fault:
+            # A fault is the server's answer to the call, so trying again
+            # would only get the same answer.
+            raise
         except Exception as e:
-            log_error('Retry got exception %s (%s/%s).' % (count, retry_count, e))
+            log_error('Retry got exception %s (%s/%s).' % (e, count + 1, max_retries))
             sleep_time = seconds * count if pushout else seconds
             time.sleep(sleep_time)
             count += 1
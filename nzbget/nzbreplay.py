@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 NativeCode Development <support@nativecode.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+##############################################################################
+#
+# Replays recorded events through the scripts and reports how long they took.
+#
+# Scripts record their events when the TraceFile option is set. Each event in
+# the trace is run again with its recorded environment, against the fake
+# control port from nzbserver.py and a scratch TempDir, so nothing touches
+# the real NZBGet or its state. Every run is profiled, and the report shows
+# the latency, RPC requests and calls, and subprocesses of each event.
+#
+#   python nzbreplay.py trace.jsonl [--scripts Rejector,HealthCheck]
+#       [--latency 0.01] [--repeat 3] [--root DIR] [--json results.jsonl]
+#       [--groups 20000 --history 50000] [--error-rate 0.01]
+#
+# The fake server takes the same queue size and error options as
+# nzbserver.py, so a trace can be replayed against a realistic queue.
+#
+# With --scripts, every event is fed through each of the listed scripts
+# instead of only the one that recorded it. Download directories are mapped
+# into --root (an empty scratch folder by default), since FileMover moves
+# and deletes what it finds there.
+#
+##############################################################################
+
+
+# Imports
+##############################################################################
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# nzb.py reads the control port settings when it is imported. Every replayed
+# script gets its own, so placeholders will do for the replay itself.
+for name in ['NZBOP_CONTROLIP', 'NZBOP_CONTROLPORT', 'NZBOP_CONTROLUSERNAME', 'NZBOP_CONTROLPASSWORD']:
+    os.environ.setdefault(name, '')
+
+import nzb
+import nzbserver
+
+
+# Constants
+##############################################################################
+
+SCRIPT_DIRECTORY=os.path.dirname(os.path.abspath(__file__))
+
+# Options that would make the replay write to real files or skip profiling.
+REPLAY_OPTIONS={
+    'ScriptState' : 'Profile',
+    'ResidentWorker' : 'Disabled',
+    'TraceFile' : '',
+    'LogFile' : '',
+    'ProfileDump' : 'Disabled',
+}
+
+DIRECTORY_VARIABLES=['NZBNA_DIRECTORY', 'NZBPP_DIRECTORY', 'NZBNP_DIRECTORY', 'NZBPP_FINALDIR']
+REGEX_OPTION=re.compile(r'^#(\w+)=(.*)$')
+
+
+# Trace
+##############################################################################
+
+def read_trace(filepath):
+    """
+    Reads the events from the trace, skipping lines that aren't valid, like
+    one cut short by a full disk.
+    """
+    records = []
+
+    with open(filepath, 'r') as trace_file:
+        for line in trace_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+
+            if record.get('script') and record.get('env'):
+                records.append(record)
+
+    return records
+
+
+def get_record_group(record):
+    """
+    Gets the NZB the event was about, so it can be put in the fake queue.
+    """
+    env = record['env']
+
+    for prefix in ['NZBNA_', 'NZBPP_', 'NZBNP_']:
+        if env.get(prefix + 'NZBID'):
+            return {
+                'nzbid' : int(env[prefix + 'NZBID']),
+                'name' : env.get(prefix + 'NZBNAME', ''),
+                'directory' : env.get(prefix + 'DIRECTORY', ''),
+                'category' : env.get(prefix + 'CATEGORY', ''),
+            }
+
+    return None
+
+
+# Scripts
+##############################################################################
+
+def get_script_defaults(script):
+    """
+    Reads the default options from the script's header, so that a script
+    can be fed events recorded by another one.
+    """
+    defaults = {}
+    in_options = False
+
+    with open(get_script_path(script), 'r') as script_file:
+        for line in script_file:
+            if line.startswith('### OPTIONS'):
+                in_options = True
+            elif line.startswith('### NZBGET') and in_options:
+                break
+            elif in_options:
+                match = REGEX_OPTION.match(line.strip())
+                if match:
+                    defaults[match.group(1)] = match.group(2)
+
+    return defaults
+
+
+def get_script_path(script):
+    return os.path.join(SCRIPT_DIRECTORY, '%s.py' % script)
+
+
+def get_environment(record, script, server, tempdir, root):
+    """
+    Builds the environment to run the script with: the recorded one,
+    pointed at the fake server and the scratch TempDir, with the script's
+    default options filled in and the download directories mapped into the
+    root.
+    """
+    env = dict((str(key), value.encode('utf-8')) for key, value in record['env'].items())
+
+    for name, value in get_script_defaults(script).items():
+        if 'NZBPO_' + name not in env and 'NZBPO_' + name.upper() not in env:
+            set_option(env, name, value)
+
+    for name, value in REPLAY_OPTIONS.items():
+        set_option(env, name, value)
+
+    for key in DIRECTORY_VARIABLES:
+        if env.get(key):
+            env[key] = os.path.join(root, os.path.basename(env[key].rstrip('/\\')))
+
+    env['NZBOP_CONTROLIP'] = '127.0.0.1'
+    env['NZBOP_CONTROLPORT'] = str(server.port)
+    env['NZBOP_CONTROLUSERNAME'] = env.get('NZBOP_CONTROLUSERNAME') or 'nzbget'
+    env['NZBOP_CONTROLPASSWORD'] = env.get('NZBOP_CONTROLPASSWORD') or 'nzbget'
+    env['NZBOP_TEMPDIR'] = tempdir
+    env['NZBOP_VERSION'] = env.get('NZBOP_VERSION') or nzbserver.NZBGET_VERSION
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+    return env
+
+
+def set_option(env, name, value):
+    # NZBGet passes every option under its own name and in uppercase.
+    env['NZBPO_' + name] = value
+    env['NZBPO_' + name.upper()] = value
+
+
+# Replay
+##############################################################################
+
+def add_record_groups(records, nzbget, root):
+    """
+    Puts the NZBs the events were about in the fake queue. Synthetic groups
+    are added after these, so they never take their IDs.
+    """
+    for group in [get_record_group(record) for record in records]:
+        if group and group['nzbid'] not in nzbget.groups:
+            directory = os.path.join(root, os.path.basename(group['directory'].rstrip('/\\')))
+            nzbget.add_group(group['nzbid'], group['name'], directory, group['category'])
+
+
+def replay(records, scripts, server, tempdir, root, repeat=1):
+    """
+    Runs every event through the scripts, one at a time, and returns a
+    result for each run.
+    """
+    results = []
+
+    for iteration in range(repeat):
+        for record in records:
+            for script in scripts or [record['script']]:
+                results.append(replay_event(record, script, server, tempdir, root))
+
+    return results
+
+
+def replay_event(record, script, server, tempdir, root):
+    env = get_environment(record, script, server, tempdir, root)
+    name = '%s-%s' % (script, record['event'])
+
+    counters = server.get_counters()
+    subprocesses = get_profile_counts(tempdir, name, 'subprocess:')
+
+    start = time.time()
+    process = subprocess.Popen([sys.executable, get_script_path(script)] + record.get('argv', [])[1:],
+        env=env, cwd=SCRIPT_DIRECTORY, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = process.communicate()
+    elapsed = time.time() - start
+
+    calls = subtract_counts(server.get_counters(), counters)
+    requests = calls.pop('requests', 0)
+
+    return {
+        'script' : script,
+        'event' : record['event'],
+        'nzbid' : (get_record_group(record) or {}).get('nzbid'),
+        'exit_code' : process.returncode,
+        'recorded_exit_code' : record.get('exit_code') if script == record['script'] else None,
+        'elapsed' : round(elapsed, 6),
+        'requests' : requests,
+        'calls' : calls,
+        'subprocesses' : sum(subtract_counts(get_profile_counts(tempdir, name, 'subprocess:'), subprocesses).values()),
+        'errors' : error.strip().splitlines()[-1:] if process.returncode not in [93, 95] else [],
+    }
+
+
+def get_profile_counts(tempdir, name, prefix):
+    """
+    Gets how many times each timing with the prefix was recorded for the
+    script and event, from the stats the profiled scripts keep.
+    """
+    try:
+        with open(os.path.join(tempdir, nzb.PROFILE_FILENAME), 'r') as stats_file:
+            stats = json.load(stats_file).get(name, {})
+    except (IOError, ValueError):
+        return {}
+
+    return dict((timing, entry['count']) for timing, entry in stats.items() if timing.startswith(prefix))
+
+
+def subtract_counts(after, before):
+    counts = {}
+
+    for name, count in after.items():
+        if count - before.get(name, 0):
+            counts[name] = count - before.get(name, 0)
+
+    return counts
+
+
+# Report
+##############################################################################
+
+def print_report(results):
+    print('%-12s %-16s %8s %5s %9s %9s %6s %5s' % ('Script', 'Event', 'NZBID', 'Exit', 'ms', 'Requests', 'Calls', 'Subp'))
+
+    for result in results:
+        exit_code = result['exit_code']
+        if result['recorded_exit_code'] not in [None, exit_code]:
+            exit_code = '%s!' % exit_code
+
+        print('%-12s %-16s %8s %5s %9.1f %9s %6s %5s' % (result['script'], result['event'], result['nzbid'] or '',
+            exit_code, result['elapsed'] * 1000, result['requests'], sum(result['calls'].values()), result['subprocesses']))
+
+        for line in result['errors']:
+            print('    %s' % line)
+
+    print('')
+    print('%-12s %-16s %5s %9s %9s %9s %9s %6s' % ('Script', 'Event', 'Runs', 'p50 ms', 'p90 ms', 'max ms', 'Requests', 'Subp'))
+
+    summary = {}
+    for result in results:
+        summary.setdefault((result['script'], result['event']), []).append(result)
+
+    for key in sorted(summary):
+        runs = summary[key]
+        latencies = sorted(result['elapsed'] * 1000 for result in runs)
+
+        print('%-12s %-16s %5s %9.1f %9.1f %9.1f %9.1f %6.1f' % (key[0], key[1], len(runs),
+            nzb.get_percentile(latencies, 50), nzb.get_percentile(latencies, 90), latencies[-1],
+            float(sum(result['requests'] for result in runs)) / len(runs),
+            float(sum(result['subprocesses'] for result in runs)) / len(runs)))
+
+    print('')
+    print('Events whose exit code differs from the recorded one are marked with !.')
+
+
+# Main entry-point
+##############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays recorded events through the NZBGet scripts.')
+    parser.add_argument('trace', help='trace file written with the TraceFile option')
+    parser.add_argument('--scripts', help='comma-separated scripts to feed every event to')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times to replay the trace')
+    parser.add_argument('--root', help='folder the download directories are mapped into')
+    parser.add_argument('--json', help='also write the results to this JSON lines file')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch TempDir')
+    nzbserver.add_arguments(parser)
+    args = parser.parse_args()
+
+    records = read_trace(args.trace)
+    if not records:
+        print('No events found in %s.' % args.trace)
+        return 1
+
+    scripts = [script.strip() for script in args.scripts.split(',')] if args.scripts else None
+    tempdir = tempfile.mkdtemp(prefix='nzbreplay-')
+    root = os.path.abspath(args.root) if args.root else os.path.join(tempdir, 'downloads')
+    server = nzbserver.start(**nzbserver.get_arguments(args))
+    add_record_groups(records, server.nzbget, root)
+    server.nzbget.populate(args.groups, args.files, args.history, seed=args.seed)
+
+    try:
+        results = replay(records, scripts, server, tempdir, root, args.repeat)
+    finally:
+        server.stop()
+        if args.keep:
+            print('Kept %s.' % tempdir)
+        else:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            for result in results:
+                results_file.write(json.dumps(result, sort_keys=True) + '\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,667 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 NativeCode Development <support@nativecode.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+##############################################################################
+#
+# Stand-in for the NZBGet control port, for running the scripts offline.
+#
+# Serves the methods the scripts use (version, listgroups, listfiles, history,
+# editqueue and system.multicall) from an in-memory queue, over XML-RPC at
+# /xmlrpc and JSON-RPC at /jsonrpc. The queue can be filled with tens of
+# thousands of synthetic groups, files and history entries. Requests can be
+# delayed to mimic a slow NAS, or fail with HTTP errors, dropped connections
+# and per-method faults, so the batching, caching and retries can be tried
+# against realistic queues. Every request and call is counted.
+#
+# It can be run on its own:
+#
+#   python nzbserver.py [--port 6789] [--groups 20000 --files 30 --history 50000]
+#       [--latency 0.05 --jitter 0.02] [--error-rate 0.01] [--drop-rate 0.01]
+#       [--fault editqueue=0.1]
+#
+# where GET /counters returns the counters as JSON, or started in-process,
+# which is what nzbreplay.py does:
+#
+#   server = nzbserver.start(latency=0.01, error_rate=0.05)
+#   server.nzbget.populate(groups=10000, files=20, history=20000)
+#   server.nzbget.add_group(1, 'Some.NZB', '/downloads/Some.NZB')
+#   server.faults['editqueue'] = 0.5
+#   ... point NZBOP_CONTROLPORT at server.port ...
+#   server.stop()
+#
+# There is also a stand-in news server, which only answers the STAT checks
+# HealthCheck makes before a download, optionally over TLS:
+#
+#   news = nzbserver.start_news(articles=['part1@example'], username='user', password='secret')
+#   ... point NZBOP_SERVER1_HOST and NZBOP_SERVER1_PORT at news.port ...
+#   news.stop()
+#
+##############################################################################
+
+
+# Imports
+##############################################################################
+import SimpleXMLRPCServer
+import SocketServer
+import json
+import random
+import ssl
+import sys
+import threading
+import time
+import urlparse
+import xmlrpclib
+
+
+# Constants
+##############################################################################
+
+NZBGET_VERSION='21.0'
+
+# The methods served to the scripts. Everything else on FakeNzbget is only
+# used to set up the queue.
+RPC_METHODS=['version', 'listgroups', 'listfiles', 'history', 'editqueue']
+
+# Fault code used for injected faults. NZBGet itself uses small positive
+# codes, so this is easy to tell apart.
+FAULT_INJECTED=-32000
+
+SYNTHETIC_STATUSES=['QUEUED'] * 6 + ['DOWNLOADING', 'PAUSED', 'PP_QUEUED']
+SYNTHETIC_HISTORY_STATUSES=['SUCCESS/ALL'] * 6 + ['SUCCESS/UNPACK', 'FAILURE/PAR', 'FAILURE/HEALTH', 'DELETED/MANUAL']
+SYNTHETIC_CATEGORIES=['', 'movies', 'tv', 'music']
+SYNTHETIC_ARTICLE_SIZE=768000
+
+
+# Fake queue
+##############################################################################
+
+class FakeNzbget(object):
+    """
+    The queue and history of a fake NZBGet, with the RPC methods that read
+    and edit them. Results use the same fields as NZBGet, but only the ones
+    the scripts look at.
+    """
+    def __init__(self):
+        self.groups = {}
+        self.files = {}
+        self.history_items = []
+        self.next_file_id = 1
+        self.lock = threading.RLock()
+
+    def add_group(self, nzbid, name, directory='', category='', status='DOWNLOADING', files=()):
+        """
+        Adds an NZB to the queue, along with its files as (filename, size)
+        pairs.
+        """
+        with self.lock:
+            now = int(time.time())
+            self.groups[int(nzbid)] = {
+                'NZBID' : int(nzbid),
+                'NZBName' : name,
+                'NZBNicename' : name,
+                'Category' : category,
+                'DestDir' : directory,
+                'FinalDir' : '',
+                'Status' : status,
+                'MinPostTime' : now,
+                'MaxPostTime' : now,
+                'FileSizeLo' : 0,
+                'FileSizeHi' : 0,
+                'TotalArticles' : 0,
+                'SuccessArticles' : 0,
+                'FailedArticles' : 0,
+                'Health' : 1000,
+                'CriticalHealth' : 0,
+            }
+            self.files.setdefault(int(nzbid), [])
+
+            for filename, size in files:
+                self.add_file(nzbid, filename, size)
+
+    def populate(self, groups=0, files=0, history=0, directory='/downloads', seed=None):
+        """
+        Fills the queue with synthetic groups, each with a par2 set and RAR
+        volumes, and the history with finished entries. A few groups have
+        failed articles, so the health and repair checks have something to
+        do. Returns self, so it can be chained.
+        """
+        generator = random.Random(seed)
+
+        with self.lock:
+            nzbid = max(self.groups.keys() + [item['NZBID'] for item in self.history_items] + [0]) + 1
+            now = int(time.time())
+
+            for index in range(groups):
+                name = 'Synthetic.Release.%05d.720p-GRP' % nzbid
+                category = generator.choice(SYNTHETIC_CATEGORIES)
+                status = generator.choice(SYNTHETIC_STATUSES)
+                self.add_group(nzbid, name, '%s/%s' % (directory, name), category, status,
+                    get_synthetic_files(generator, name, files))
+
+                group = self.groups[nzbid]
+                size = (group['FileSizeHi'] << 32) + group['FileSizeLo']
+                group['TotalArticles'] = max(1, size // SYNTHETIC_ARTICLE_SIZE)
+                if generator.random() < 0.1:
+                    group['FailedArticles'] = generator.randint(1, max(1, group['TotalArticles'] // 10))
+                    group['Health'] = 1000 - 1000 * group['FailedArticles'] // group['TotalArticles']
+                    group['CriticalHealth'] = 900
+                group['SuccessArticles'] = group['TotalArticles'] - group['FailedArticles']
+                nzbid += 1
+
+            for index in range(history):
+                name = 'Synthetic.Release.%05d.720p-GRP' % nzbid
+                self.add_history(nzbid, name, generator.choice(SYNTHETIC_CATEGORIES),
+                    generator.choice(SYNTHETIC_HISTORY_STATUSES), '%s/%s' % (directory, name))
+                self.history_items[-1]['HistoryTime'] = now - (history - index) * 60
+                nzbid += 1
+
+        return self
+
+    def add_file(self, nzbid, filename, size=0):
+        with self.lock:
+            group = self.groups[int(nzbid)]
+            self.files[int(nzbid)].append({
+                'ID' : self.next_file_id,
+                'NZBID' : int(nzbid),
+                'Filename' : filename,
+                'FileSizeLo' : size & 0xFFFFFFFF,
+                'FileSizeHi' : size >> 32,
+                'Paused' : False,
+            })
+            self.next_file_id += 1
+
+            total = (group['FileSizeHi'] << 32) + group['FileSizeLo'] + size
+            group['FileSizeLo'], group['FileSizeHi'] = total & 0xFFFFFFFF, total >> 32
+
+    def add_history(self, nzbid, name, category='', status='SUCCESS/ALL', finaldir=''):
+        with self.lock:
+            self.history_items.append({
+                'NZBID' : int(nzbid),
+                'Name' : name,
+                'NZBName' : name,
+                'Category' : category,
+                'Status' : status,
+                'FinalDir' : finaldir,
+                'DestDir' : finaldir,
+                'HistoryTime' : int(time.time()),
+                'Kind' : 'NZB',
+            })
+
+    # RPC methods
+
+    def version(self):
+        return NZBGET_VERSION
+
+    def listgroups(self, number=0):
+        with self.lock:
+            return [self.groups[nzbid] for nzbid in sorted(self.groups)]
+
+    def listfiles(self, first=0, last=0, nzbid=0):
+        with self.lock:
+            if nzbid:
+                return list(self.files.get(int(nzbid), []))
+
+            return [item for key in sorted(self.files) for item in self.files[key]]
+
+    def history(self, hidden=False):
+        with self.lock:
+            return list(self.history_items)
+
+    def editqueue(self, command, offset, param, ids):
+        """
+        Applies the edits the scripts make. Commands that don't change
+        anything the scripts read back are accepted and ignored.
+        """
+        ids = set(int(id) for id in ids)
+
+        with self.lock:
+            if command in ['GroupPause', 'GroupResume']:
+                for nzbid in ids & set(self.groups):
+                    self.groups[nzbid]['Status'] = 'PAUSED' if command == 'GroupPause' else 'QUEUED'
+            elif command == 'GroupDelete':
+                for nzbid in ids & set(self.groups):
+                    group = self.groups.pop(nzbid)
+                    self.files.pop(nzbid, None)
+                    self.add_history(nzbid, group['NZBName'], group['Category'], 'DELETED/MANUAL')
+            elif command == 'FileDelete':
+                for nzbid in self.files:
+                    self.files[nzbid] = [item for item in self.files[nzbid] if item['ID'] not in ids]
+            elif command == 'FileMoveTop':
+                for nzbid in self.files:
+                    files = self.files[nzbid]
+                    files.sort(key=lambda item: item['ID'] not in ids)
+            elif command == 'HistoryDelete':
+                self.history_items = [item for item in self.history_items if item['NZBID'] not in ids]
+            elif command == 'HistoryReturn':
+                for item in [item for item in self.history_items if item['NZBID'] in ids]:
+                    self.history_items.remove(item)
+                    self.add_group(item['NZBID'], item['Name'], item['DestDir'], item['Category'], 'QUEUED')
+
+        return True
+
+
+def get_synthetic_files(generator, name, count):
+    """
+    Makes up the files of a release: an index par2, recovery volumes for
+    about a tenth of the size, and RAR volumes for the rest.
+    """
+    if count <= 0:
+        return []
+
+    volume_size = generator.choice([50, 100, 250]) * 1024 * 1024
+    recovery = max(1, count // 10) if count > 2 else 0
+    volumes = max(1, count - recovery - 1)
+
+    files = [('%s.par2' % name, 40000)]
+    files.extend(('%s.part%02d.rar' % (name, index + 1), volume_size) for index in range(volumes))
+
+    block = 1
+    for index in range(recovery):
+        blocks = 2 ** min(index, 6)
+        files.append(('%s.vol%03d+%02d.par2' % (name, block, blocks), volume_size // 10 * blocks // 4 + 40000))
+        block += blocks
+
+    return files[:count]
+
+
+# Server
+##############################################################################
+
+class RequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    """
+    Serves XML-RPC at /xmlrpc and JSON-RPC at /jsonrpc, after applying the
+    server's latency and injected errors.
+    """
+    # Keep-alive, like NZBGet, so connection reuse is measured too.
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ('/xmlrpc',)
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path)
+
+        if path.path == '/counters':
+            self.send_body(200, json.dumps(self.server.get_counters(), sort_keys=True), 'application/json')
+        elif path.path.startswith('/jsonrpc/') and self.inject():
+            # NZBGet takes the parameters of a GET call in order, ignoring
+            # their names.
+            params = [get_json_value(value) for name, value in urlparse.parse_qsl(path.query, True)]
+            self.send_jsonrpc(path.path[len('/jsonrpc/'):], params, None)
+        elif not path.path.startswith('/jsonrpc/'):
+            self.send_body(404, '', 'text/plain')
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path
+
+        if not self.inject():
+            return
+
+        if path == '/jsonrpc':
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+            try:
+                request = json.loads(body)
+            except ValueError:
+                self.send_body(400, '', 'text/plain')
+                return
+
+            self.send_jsonrpc(request.get('method', ''), request.get('params', []), request.get('id'))
+        else:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def inject(self):
+        """
+        Counts the request and applies the latency and injected errors.
+        Returns False if the request has already been answered or dropped.
+        """
+        server = self.server
+        server.record('requests')
+
+        latency = server.latency + (server.random.uniform(0, server.jitter) if server.jitter else 0)
+        if latency:
+            time.sleep(latency)
+
+        if server.drop_rate and server.random.random() < server.drop_rate:
+            # Close without answering, like a NAS dropping an idle socket.
+            server.record('drops')
+            self.close_connection = 1
+            if self.command == 'POST':
+                self.rfile.read(int(self.headers.get('content-length', 0)))
+            return False
+
+        if server.error_rate and server.random.random() < server.error_rate:
+            server.record('errors')
+            if self.command == 'POST':
+                self.rfile.read(int(self.headers.get('content-length', 0)))
+            self.send_body(500, '', 'text/plain')
+            return False
+
+        return True
+
+    def send_jsonrpc(self, method, params, id):
+        response = { 'version' : '1.1', 'id' : id }
+
+        try:
+            response['result'] = self.server._dispatch(str(method), params)
+        except xmlrpclib.Fault as fault:
+            response['error'] = { 'name' : 'JSONRPCError', 'code' : fault.faultCode, 'message' : fault.faultString }
+        except Exception as e:
+            response['error'] = { 'name' : 'JSONRPCError', 'code' : 1, 'message' : str(e) }
+
+        self.send_body(200, json.dumps(response), 'application/json')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_json_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class Server(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """
+    Serves a FakeNzbget, counting every request and method call. Calls
+    inside a system.multicall are counted under their own method names as
+    well.
+
+    The latency (plus up to jitter more) is added to every request, and
+    error_rate and drop_rate are the chances of a request failing with an
+    HTTP 500 or having its connection closed without an answer. faults maps
+    method names to the chance of the call returning a fault instead, which
+    inside a system.multicall only fails that one call. All of these can be
+    changed while the server is running.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0, nzbget=None, jitter=0, error_rate=0, drop_rate=0, faults=None, seed=None):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, ('127.0.0.1', port), RequestHandler, logRequests=False)
+        self.nzbget = nzbget or FakeNzbget()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.faults = dict(faults or {})
+        self.random = random.Random(seed)
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+        self.thread = None
+
+        self.register_multicall_functions()
+        for method in RPC_METHODS:
+            self.register_function(getattr(self.nzbget, method), method)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def _dispatch(self, method, params):
+        self.record(method)
+
+        rate = self.faults.get(method)
+        if rate and self.random.random() < rate:
+            self.record('faults')
+            raise xmlrpclib.Fault(FAULT_INJECTED, 'Injected fault in %s.' % method)
+
+        return SimpleXMLRPCServer.SimpleXMLRPCServer._dispatch(self, method, params)
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on slow or failed requests are expected here.
+        if not isinstance(sys.exc_info()[1], IOError):
+            SimpleXMLRPCServer.SimpleXMLRPCServer.handle_error(self, request, client_address)
+
+    def record(self, name):
+        with self.counters_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def get_counters(self):
+        with self.counters_lock:
+            return dict(self.counters)
+
+    def reset_counters(self):
+        with self.counters_lock:
+            self.counters = {}
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def start(port=0, latency=0, nzbget=None, **kwargs):
+    """
+    Starts a server on a background thread and returns it. Port 0 picks a
+    free port, which is available as server.port. The keyword arguments are
+    the same as for Server.
+    """
+    server = Server(port, latency, nzbget, **kwargs)
+    server.thread = threading.Thread(target=server.serve_forever)
+    server.thread.daemon = True
+    server.thread.start()
+
+    return server
+
+
+# News server
+##############################################################################
+
+class NewsRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Answers the NNTP commands the scripts send: AUTHINFO, STAT and QUIT.
+    Pipelined commands are answered in order as they are read.
+    """
+    def handle(self):
+        server = self.server
+        server.enter()
+
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+
+            self.send('200 nzbserver news ready')
+            authenticated = server.username is None
+            username = None
+
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+
+                command, _, argument = line.strip().partition(' ')
+                command = command.upper()
+                server.record(command)
+
+                if command == 'QUIT':
+                    self.send('205 Bye')
+                    break
+                elif command == 'AUTHINFO':
+                    kind, _, value = argument.partition(' ')
+                    if kind.upper() == 'USER':
+                        username = value
+                        self.send('381 Password required')
+                    elif username == server.username and value == server.password:
+                        authenticated = True
+                        self.send('281 Authentication accepted')
+                    else:
+                        self.send('481 Authentication failed')
+                elif command == 'STAT':
+                    if not authenticated:
+                        self.send('480 Authentication required')
+                    elif argument.strip('<>') in server.articles:
+                        self.send('223 0 %s' % argument)
+                    else:
+                        self.send('430 No such article')
+                else:
+                    self.send('500 Unknown command')
+        finally:
+            server.leave()
+
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+
+class NewsServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Serves the articles, counting every command and keeping track of the
+    most connections that were open at once. With a certfile (holding both
+    the certificate and its key), connections are encrypted.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, articles=(), username=None, password=None, certfile=None, latency=0):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', port), NewsRequestHandler)
+        self.articles = set(article.strip('<>') for article in articles)
+        self.username = username
+        self.password = password
+        self.certfile = certfile
+        self.latency = latency
+        self.active = 0
+        self.peak = 0
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def get_request(self):
+        request, client_address = SocketServer.TCPServer.get_request(self)
+
+        if self.certfile:
+            # A client that refuses the certificate fails the handshake, which
+            # the server treats like any other failed accept.
+            try:
+                request = ssl.wrap_socket(request, server_side=True, certfile=self.certfile)
+            except ssl.SSLError:
+                request.close()
+                raise
+
+        return request, client_address
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up without a QUIT are expected here.
+        if not isinstance(sys.exc_info()[1], IOError):
+            SocketServer.TCPServer.handle_error(self, request, client_address)
+
+    def enter(self):
+        with self.counters_lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def leave(self):
+        with self.counters_lock:
+            self.active -= 1
+
+    def record(self, name):
+        with self.counters_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def get_counters(self):
+        with self.counters_lock:
+            return dict(self.counters)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def start_news(port=0, **kwargs):
+    """
+    Starts a news server on a background thread and returns it. The keyword
+    arguments are the same as for NewsServer.
+    """
+    server = NewsServer(port, **kwargs)
+    server.thread = threading.Thread(target=server.serve_forever)
+    server.thread.daemon = True
+    server.thread.start()
+
+    return server
+
+
+# Main entry-point
+##############################################################################
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Stand-in for the NZBGet control port.')
+    parser.add_argument('--port', type=int, default=6789)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = Server(args.port, **get_arguments(args))
+    server.nzbget.populate(args.groups, args.files, args.history, seed=args.seed)
+    print('Serving %s groups, %s files and %s history entries on 127.0.0.1:%s.' % (len(server.nzbget.groups),
+        sum(len(files) for files in server.nzbget.files.values()), len(server.nzbget.history_items), server.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    for name, count in sorted(server.get_counters().items()):
+        print('%s: %s' % (name, count))
+
+
+def add_arguments(parser):
+    """
+    Adds the options for the synthetic queue and injected errors, which
+    nzbreplay.py takes as well.
+    """
+    parser.add_argument('--groups', type=int, default=0, help='number of synthetic groups in the queue')
+    parser.add_argument('--files', type=int, default=20, help='number of files in each synthetic group')
+    parser.add_argument('--history', type=int, default=0, help='number of synthetic history entries')
+    parser.add_argument('--seed', type=int, help='seed for the synthetic queue and injected errors')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many more seconds added at random')
+    parser.add_argument('--error-rate', type=float, default=0, help='chance of a request failing with HTTP 500')
+    parser.add_argument('--drop-rate', type=float, default=0, help='chance of a connection being closed unanswered')
+    parser.add_argument('--fault', action='append', default=[], metavar='METHOD=RATE',
+        help='chance of a method call returning a fault, can be given more than once')
+
+
+def get_arguments(args):
+    faults = {}
+    for fault in args.fault:
+        method, rate = fault.split('=', 1)
+        faults[method] = float(rate)
+
+    return {
+        'latency' : args.latency,
+        'jitter' : args.jitter,
+        'error_rate' : args.error_rate,
+        'drop_rate' : args.drop_rate,
+        'faults' : faults,
+        'seed' : args.seed,
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 NativeCode Development <support@nativecode.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+##############################################################################
+#
+# Resident worker for the NZBGet scripts.
+#
+# NZBGet starts a new interpreter for every event, which means every event
+# pays for importing nzb.py and its dependencies. When a script enables the
+# ResidentWorker option, it hands the event over to a long-lived worker
+# process through a Unix socket instead. The worker runs the script in a
+# forked child with the forwarded environment and streams the output back,
+# so NZBGet still sees the usual [LEVEL] and [NZB] lines and the exit code.
+# Every event gets its own child, so a long move or check doesn't hold up
+# the events behind it.
+#
+# Scripts opt in by calling forward() before importing anything else:
+#
+#   import nzbworker
+#   nzbworker.forward(__file__)
+#
+# If no worker is listening, forward() starts one in the background for the
+# next event and returns so the script runs in-process as usual. The same
+# happens when the worker doesn't answer or take the event in time.
+#
+# The worker can also be started and stopped by hand:
+#
+#   python nzbworker.py [start|stop]
+#
+##############################################################################
+
+
+# Imports
+##############################################################################
+
+# NOTE: Keep this list short. Everything imported here is paid for by every
+#       event, which is exactly the cost the worker is meant to avoid.
+import json
+import os
+import socket
+import sys
+
+
+# Constants
+##############################################################################
+
+WORKER_SOCKET='nzbworker.sock'
+WORKER_LOCK='nzbworker.lock'
+WORKER_IDLE_SECONDS=600
+
+# Seconds to wait for the worker to accept the connection, and then to take
+# the event, before giving up and running the event in-process.
+WORKER_CONNECT_TIMEOUT=1
+WORKER_START_TIMEOUT=5
+
+# Mirrors nzb.PROCESS_ERROR, which we can't import here.
+PROCESS_ERROR=94
+
+# Set while the worker is running a script, so that the script's own call to
+# forward() runs it in-process instead of forwarding it back to us.
+RESIDENT=False
+
+
+# Launcher
+##############################################################################
+
+def forward(script):
+    """
+    Forwards the current event to the resident worker and exits with the
+    worker's exit code. Returns without doing anything if the script has not
+    enabled the worker or the worker is not available.
+    """
+    if RESIDENT or os.environ.get('NZBPO_RESIDENTWORKER') != 'Enabled':
+        return
+
+    path = get_socket_path()
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(WORKER_CONNECT_TIMEOUT)
+
+    try:
+        client.connect(path)
+    except socket.error:
+        client.close()
+        start()
+        return
+
+    try:
+        request = {
+            'script' : os.path.abspath(script),
+            'argv' : sys.argv,
+            'cwd' : os.getcwd(),
+            'env' : dict(os.environ),
+        }
+        client.sendall(json.dumps(request) + '\n')
+
+        # The worker only runs the event once we confirm that we're still
+        # waiting for it, so an event it was too slow to take is never run
+        # twice.
+        client.settimeout(WORKER_START_TIMEOUT)
+        if receive_line(client) != 'S\n':
+            client.close()
+            return
+
+        client.sendall('G\n')
+    except (socket.error, ValueError):
+        # Nothing has run yet, so it's still safe to run in-process.
+        client.close()
+        return
+
+    client.settimeout(None)
+    sys.exit(relay(client))
+
+
+def receive_line(client):
+    """
+    Reads a single short line without buffering past it.
+    """
+    line = ''
+
+    while not line.endswith('\n'):
+        data = client.recv(1)
+        if not data:
+            break
+        line += data
+
+    return line
+
+
+def relay(client):
+    """
+    Copies the worker's output to our stdout/stderr and returns the exit
+    code it reports.
+    """
+    exit_code = None
+    reader = client.makefile('rb')
+
+    try:
+        for line in reader:
+            tag, data = line[:1], line[1:]
+            if tag == 'O':
+                sys.stdout.write(data)
+            elif tag == 'E':
+                sys.stderr.write(data)
+            elif tag == 'X':
+                exit_code = int(data)
+                break
+    except socket.error:
+        pass
+    finally:
+        reader.close()
+        client.close()
+
+    sys.stdout.flush()
+
+    if exit_code is None:
+        print('[ERROR] Resident worker stopped before the event completed.')
+        return PROCESS_ERROR
+
+    return exit_code
+
+
+def start():
+    """
+    Starts a detached worker in the background. The worker holds a lock for
+    its lifetime, so starting one while another is running is harmless.
+    """
+    import subprocess
+
+    devnull = open(os.devnull, 'r+')
+    try:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'start'],
+            stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+            preexec_fn=os.setsid, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except Exception:
+        pass
+    finally:
+        devnull.close()
+
+
+def stop():
+    path = get_socket_path()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(path)
+        client.sendall(json.dumps({ 'command' : 'stop' }) + '\n')
+    except socket.error:
+        pass
+    finally:
+        client.close()
+
+
+def get_socket_path():
+    tempdir = os.environ.get('NZBOP_TEMPDIR')
+    return os.path.join(tempdir, WORKER_SOCKET) if tempdir else None
+
+
+# Worker
+##############################################################################
+
+class SocketWriter(object):
+    """
+    File-like object that sends everything written to it to the launcher,
+    one tagged line at a time.
+    """
+    def __init__(self, client, tag):
+        self.client = client
+        self.tag = tag
+        self.buffer = ''
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.send(line)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        # Lines are sent as soon as they are complete, and a partial line is
+        # held back until finish() so it isn't split in two.
+        pass
+
+    def finish(self):
+        if self.buffer:
+            self.send(self.buffer)
+            self.buffer = ''
+
+    def send(self, line):
+        try:
+            self.client.sendall(self.tag + line + '\n')
+        except socket.error:
+            pass
+
+    def isatty(self):
+        return False
+
+
+def serve(idle_seconds=WORKER_IDLE_SECONDS):
+    """
+    Accepts events until the worker is stopped, has been idle for too long,
+    or notices that nzb.py changed on disk. Each event runs in a forked
+    child, since the environment and stdout are process-wide.
+    """
+    import fcntl
+
+    path = get_socket_path()
+    if not path:
+        print('[ERROR] NZBOP_TEMPDIR is not set.')
+        return
+
+    lock = open(os.path.join(os.path.dirname(path), WORKER_LOCK), 'a')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        print('[INFO] Resident worker is already running.')
+        return
+
+    # Anything left at the path belongs to a worker that is no longer alive,
+    # since it would still be holding the lock otherwise.
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0600)
+    server.listen(16)
+    server.settimeout(idle_seconds)
+
+    # Import the framework once for every event we're going to run.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import nzb
+    framework_mtime = get_mtime(nzb.__file__)
+
+    try:
+        while True:
+            try:
+                client, address = server.accept()
+            except socket.timeout:
+                break
+
+            try:
+                request = read_request(client)
+                if request and request.get('command') == 'stop':
+                    break
+                elif request:
+                    spawn(request, client, [server, lock])
+            finally:
+                client.close()
+
+            reap()
+
+            if get_mtime(nzb.__file__) != framework_mtime:
+                break
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+        lock.close()
+
+
+def read_request(client):
+    """
+    Reads one request from the launcher, or returns None if it didn't send
+    one in time.
+    """
+    client.settimeout(WORKER_START_TIMEOUT)
+    reader = client.makefile('rb')
+
+    try:
+        return json.loads(reader.readline())
+    except (socket.error, ValueError):
+        return None
+    finally:
+        reader.close()
+
+
+def spawn(request, client, inherited):
+    """
+    Forks a child to handle the event, so the worker can take the next one
+    right away. The child starts with the framework already imported, and
+    closes the worker's socket and lock so they go away with the worker.
+    """
+    # Compile in the worker so that every child reuses the code object. The
+    # child reports the error if the script can't be compiled.
+    try:
+        compile_script(to_str(request['script']))
+    except Exception:
+        pass
+
+    if os.fork():
+        return
+
+    exit_code = 0
+
+    try:
+        for item in inherited:
+            item.close()
+        handle(request, client)
+    except BaseException:
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def handle(request, client):
+    """
+    Tells the launcher that the event was taken, and runs it once the
+    launcher confirms it is still waiting.
+    """
+    try:
+        client.settimeout(WORKER_START_TIMEOUT)
+        client.sendall('S\n')
+        if receive_line(client) != 'G\n':
+            return
+    except socket.error:
+        return
+
+    client.settimeout(None)
+    exit_code = run(request, client)
+
+    try:
+        client.sendall('X%s\n' % exit_code)
+    except socket.error:
+        pass
+
+
+def reap():
+    # Collect the children that finished, so they don't linger as zombies.
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except OSError:
+        pass
+
+
+SCRIPTS = {}
+
+
+def compile_script(filepath):
+    """
+    Compiles the script, reusing the code object until the file changes.
+    """
+    mtime = get_mtime(filepath)
+    cached = SCRIPTS.get(filepath)
+
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(filepath, 'rU') as script_file:
+        code = compile(script_file.read(), filepath, 'exec')
+
+    SCRIPTS[filepath] = (mtime, code)
+
+    return code
+
+
+def run(request, client):
+    """
+    Runs the script as __main__ with the forwarded environment, sending its
+    output to the launcher, and returns the exit code.
+    """
+    global RESIDENT
+
+    import nzb
+
+    script = to_str(request['script'])
+    saved_environ = dict(os.environ)
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+    saved_stdout, saved_stderr = sys.stdout, sys.stderr
+
+    stdout = SocketWriter(client, 'O')
+    stderr = SocketWriter(client, 'E')
+    exit_code = 0
+
+    os.environ.clear()
+    os.environ.update(dict((to_str(key), to_str(value)) for key, value in request['env'].items()))
+    sys.argv = [to_str(arg) for arg in request['argv']]
+    sys.stdout, sys.stderr = stdout, stderr
+    RESIDENT = True
+
+    try:
+        os.chdir(to_str(request['cwd']))
+        nzb.reset_state()
+
+        code = compile_script(script)
+        namespace = { '__name__' : '__main__', '__file__' : script, '__builtins__' : __builtins__ }
+        exec code in namespace
+    except SystemExit as e:
+        exit_code = get_exit_code(e.code)
+    except Exception:
+        nzb.log_traceback()
+        exit_code = PROCESS_ERROR
+    finally:
+        RESIDENT = False
+        nzb.trace_finish(exit_code)
+        release_locks(nzb)
+        nzb.log_flush()
+        stdout.finish()
+        stderr.finish()
+        sys.stdout, sys.stderr = saved_stdout, saved_stderr
+        sys.argv = saved_argv
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+
+    return exit_code
+
+
+def release_locks(nzb):
+    # A process that exits gives up its locks, so an event run here has to
+    # give them up too, even if it failed.
+    try:
+        nzb.lock_release_owned()
+    except Exception as e:
+        print('[WARNING] Failed to release the locks of the event (%s).' % e)
+
+
+def get_exit_code(code):
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    else:
+        sys.stderr.write('%s\n' % code)
+        return 1
+
+
+def get_mtime(filepath):
+    # Compare against the source, not the compiled module.
+    if filepath.endswith('.pyc'):
+        filepath = filepath[:-1]
+
+    try:
+        return os.path.getmtime(filepath)
+    except OSError:
+        return None
+
+
+def to_str(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+# Main entry-point
+##############################################################################
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'start'
+
+    if command == 'stop':
+        stop()
+    else:
+        serve()
+
+
+if __name__ == '__main__':
+    # Serve from the imported module rather than __main__, so that scripts
+    # importing nzbworker see the same RESIDENT flag.
+    import nzbworker
+    nzbworker.main()
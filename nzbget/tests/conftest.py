@@ -0,0 +1,108 @@
+#
+# Copyright (C) 2015 NativeCode Development <support@nativecode.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+##############################################################################
+#
+# Shared fixtures for the nzbget tests. Run them from the nzbget folder with:
+#
+#   python -m pytest tests
+#
+##############################################################################
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+SCRIPT_DIRECTORY=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# nzb.py reads the control port settings when it is imported, so they have
+# to be in place before any test imports it.
+os.environ.update({
+    'NZBOP_CONTROLIP' : '127.0.0.1',
+    'NZBOP_CONTROLPORT' : '6789',
+    'NZBOP_CONTROLUSERNAME' : 'nzbget',
+    'NZBOP_CONTROLPASSWORD' : 'nzbget',
+    'NZBOP_TEMPDIR' : tempfile.mkdtemp(prefix='nzbtests-'),
+    'NZBOP_VERSION' : '21.0',
+})
+
+sys.path.insert(0, SCRIPT_DIRECTORY)
+
+import nzb
+import nzbserver
+
+
+@pytest.fixture
+def tempdir(tmpdir, monkeypatch):
+    """
+    Gives the test its own NZBOP_TEMPDIR, and so its own state store and
+    snapshots.
+    """
+    monkeypatch.setenv('NZBOP_TEMPDIR', str(tmpdir))
+    nzb.reset_state()
+
+    yield str(tmpdir)
+
+    nzb.reset_state()
+
+
+@pytest.fixture
+def server():
+    """
+    Starts a fake NZBGet control port for the test.
+    """
+    server = nzbserver.start()
+
+    yield server
+
+    server.stop()
+
+
+@pytest.fixture
+def run_script(tempdir, server):
+    """
+    Runs one of the scripts the way NZBGet does, against the fake server,
+    returning the exit code and output. Options not given fall back to the
+    defaults in the script's header.
+    """
+    def run(script, env, **options):
+        import nzbreplay
+
+        environment = dict(os.environ)
+        environment.update(env)
+
+        for name, value in nzbreplay.get_script_defaults(script).items():
+            nzbreplay.set_option(environment, name, options.pop(name, value))
+        for name, value in options.items():
+            nzbreplay.set_option(environment, name, value)
+
+        environment.update({
+            'NZBOP_CONTROLPORT' : str(server.port),
+            'NZBOP_TEMPDIR' : tempdir,
+            'PYTHONDONTWRITEBYTECODE' : '1',
+        })
+
+        process = subprocess.Popen([sys.executable, nzbreplay.get_script_path(script)], env=environment,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+
+        return process.returncode, output
+
+    return run
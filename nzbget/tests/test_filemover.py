@@ -0,0 +1,53 @@
+import os
+
+import nzb
+
+
+def test_post_processing_moves_while_another_holds_the_lock(tempdir, run_script):
+    directory = os.path.join(tempdir, 'Some.Movie')
+    target = os.path.join(tempdir, 'movies')
+    os.makedirs(directory)
+    os.makedirs(target)
+
+    with open(os.path.join(directory, 'some.movie.mkv'), 'wb') as handle:
+        handle.write('x' * 1024)
+
+    # A scheduled FileMover in this process is busy with the history.
+    assert nzb.lock_create('FileMover')
+
+    env = {
+        'NZBPP_NZBID' : '9',
+        'NZBPP_NZBNAME' : 'Some.Movie',
+        'NZBPP_DIRECTORY' : directory,
+        'NZBPP_CATEGORY' : 'movies',
+        'NZBPP_STATUS' : 'SUCCESS/ALL',
+        'NZBPP_TOTALSTATUS' : 'SUCCESS',
+    }
+
+    exit_code, output = run_script('FileMover', env, CategoryLocations='movies:%s' % target)
+
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+    assert '[NZB] FINALDIR=%s' % target in output
+    assert os.path.isfile(os.path.join(target, 'some.movie.mkv'))
+    assert not os.path.exists(directory)
+
+
+def test_history_added_in_the_same_second_is_hidden(tempdir, server, run_script):
+    target = os.path.join(tempdir, 'movies')
+    options = { 'CategoryLocations' : 'movies:%s' % target }
+
+    server.nzbget.add_history(20, 'First.Movie', 'movies', finaldir=target)
+    server.nzbget.history_items[-1]['HistoryTime'] = 1000
+
+    exit_code, output = run_script('FileMover', {}, **options)
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+    assert server.nzbget.history_items == []
+
+    # NZBIDs don't follow the order entries reach the history.
+    for nzbid, time in [(10, 1000), (21, 999)]:
+        server.nzbget.add_history(nzbid, 'Movie.%s' % nzbid, 'movies', finaldir=target)
+        server.nzbget.history_items[-1]['HistoryTime'] = time
+
+    exit_code, output = run_script('FileMover', {}, **options)
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+    assert [item['NZBID'] for item in server.nzbget.history_items] == [21]
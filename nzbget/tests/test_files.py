@@ -0,0 +1,120 @@
+import errno
+import os
+
+import pytest
+
+import nzb
+
+
+@pytest.fixture
+def cross_device(monkeypatch):
+    """
+    Makes renaming a file between the test's source and target fail the way
+    it does across filesystems, and turns off cloning so the file is copied.
+    """
+    rename = os.rename
+
+    def cross_device_rename(source, target):
+        if not source.endswith('.part'):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        rename(source, target)
+
+    monkeypatch.setattr(os, 'rename', cross_device_rename)
+    monkeypatch.setattr(nzb, 'clone_file', lambda reader, writer: False)
+
+
+def write(filepath, data):
+    with open(filepath, 'wb') as handle:
+        handle.write(data)
+
+
+def read(filepath):
+    with open(filepath, 'rb') as handle:
+        return handle.read()
+
+
+def test_move_across_devices_copies_and_verifies(tmpdir, cross_device, monkeypatch):
+    source = str(tmpdir.join('source.mkv'))
+    target = str(tmpdir.join('target.mkv'))
+    data = os.urandom(100000)
+    write(source, data)
+
+    # Copy in small pieces, so the CRC is worked out over several reads.
+    monkeypatch.setattr(nzb, 'FILE_COPY_BUFFER', 4096)
+
+    assert nzb.move_file(source, target) == 'copy'
+    assert read(target) == data
+    assert not os.path.exists(source)
+    assert not os.path.exists(target + '.part')
+
+
+def test_failed_verification_leaves_the_source(tmpdir, cross_device, monkeypatch):
+    source = str(tmpdir.join('source.mkv'))
+    target = str(tmpdir.join('target.mkv'))
+    write(source, 'data')
+
+    # The copy reads back differently from what was written.
+    monkeypatch.setattr(nzb, 'get_file_crc', lambda filepath, data=None: 0)
+
+    with pytest.raises(IOError):
+        nzb.move_file(source, target)
+
+    assert read(source) == 'data'
+    assert not os.path.exists(target)
+    assert not os.path.exists(target + '.part')
+
+
+def test_move_on_the_same_device_renames(tmpdir):
+    source = str(tmpdir.join('source.mkv'))
+    write(source, 'data')
+
+    assert nzb.move_file(source, str(tmpdir.join('target.mkv'))) == 'rename'
+
+
+@pytest.fixture(params=['scandir', 'listdir'])
+def walker(request, monkeypatch):
+    # Walk the tree both ways iter_files can.
+    if request.param == 'listdir':
+        monkeypatch.setattr(nzb, 'scandir', None)
+    elif not nzb.scandir:
+        pytest.skip('scandir is not available.')
+
+
+def test_iter_files_skips_junk_directories(tmpdir, walker):
+    for path, data in [
+        ('movie.mkv', 'x' * 10),
+        ('Subs/movie.srt', 'x'),
+        ('Sample/sample.mkv', 'x' * 50),
+        ('Extras/Featurettes/interview.mkv', 'x' * 50),
+    ]:
+        tmpdir.join(path).write(data, ensure=True)
+
+    # A symlinked directory isn't followed.
+    os.symlink(str(tmpdir.join('Subs')), str(tmpdir.join('Linked')))
+
+    files = sorted((os.path.relpath(path, str(tmpdir)), size)
+        for path, size in nzb.iter_files(str(tmpdir), ['sample', 'extras']))
+
+    assert files == [('Subs/movie.srt', 1), ('movie.mkv', 10)]
+
+
+def test_largest_file_leaves_out_junk(tempdir, run_script):
+    directory = os.path.join(tempdir, 'Some.Movie')
+    target = os.path.join(tempdir, 'movies')
+    os.makedirs(os.path.join(directory, 'Sample'))
+    os.makedirs(target)
+
+    write(os.path.join(directory, 'some.movie.mkv'), 'x' * 1024)
+    write(os.path.join(directory, 'Sample', 'bigger.mkv'), 'x' * 4096)
+
+    exit_code, output = run_script('FileMover', {
+        'NZBPP_NZBID' : '9',
+        'NZBPP_NZBNAME' : 'Some.Movie',
+        'NZBPP_DIRECTORY' : directory,
+        'NZBPP_CATEGORY' : 'movies',
+        'NZBPP_STATUS' : 'SUCCESS/ALL',
+        'NZBPP_TOTALSTATUS' : 'SUCCESS',
+    }, CategoryLocations='movies:%s' % target)
+
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+    assert os.listdir(target) == ['some.movie.mkv']
@@ -0,0 +1,44 @@
+import time
+
+import nzb
+
+
+def test_resume_reads_the_queue_fresh(tempdir, server, run_script):
+    # A snapshot from before post-processing sent the NZBs back to the queue.
+    nzb.get_snapshot('groups', lambda: [])
+
+    server.nzbget.add_group(1, 'Returned.NZB', status='PAUSED')
+    server.nzbget.add_history(2, 'Still.In.History')
+
+    for nzbid in [1, 2, 3]:
+        nzb.set_deadline('HealthCheck', nzbid, time.time() - 60)
+
+    exit_code, output = run_script('HealthCheck', {})
+
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+    assert server.nzbget.groups[1]['Status'] == 'QUEUED'
+
+    # NZB 3 is gone from both the queue and the history.
+    assert nzb.get_due_deadlines('HealthCheck') == [2]
+
+
+def test_failed_pause_does_not_requeue(server, run_script):
+    server.nzbget.add_history(5, 'Some.Release')
+    editqueue = server.funcs['editqueue']
+
+    def refuse_pause(command, offset, param, ids):
+        return command != 'GroupPause' and editqueue(command, offset, param, ids)
+
+    server.funcs['editqueue'] = refuse_pause
+
+    exit_code, output = run_script('HealthCheck', {
+        'NZBPP_NZBID' : '5',
+        'NZBPP_NZBNAME' : 'Some.Release',
+        'NZBPP_DIRECTORY' : '/downloads/Some.Release',
+        'NZBPP_CATEGORY' : '',
+        'NZBPP_STATUS' : 'FAILURE/HEALTH',
+        'NZBPP_TOTALSTATUS' : 'FAILURE',
+    })
+
+    assert exit_code == nzb.PROCESS_FAIL_PROXY, output
+    assert 5 not in server.nzbget.groups
@@ -0,0 +1,76 @@
+import errno
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+import nzb
+
+
+def test_commands_stay_in_order_with_log_lines(tempdir, capsys):
+    nzb.log_info('Moving files.')
+    nzb.set_nzb_directory_final('/downloads/movies')
+    nzb.log_info('Moved files.')
+    nzb.log_flush()
+
+    assert capsys.readouterr()[0].splitlines() == [
+        '[INFO] Moving files.',
+        '[NZB] FINALDIR=/downloads/movies',
+        '[INFO] Moved files.',
+    ]
+
+
+def test_lines_are_written_once_they_have_waited(tempdir, capsys, monkeypatch):
+    nzb.log_info('First.')
+    assert capsys.readouterr()[0] == ''
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + nzb.LOG_BUFFER_SECONDS)
+    nzb.log_info('Second.')
+
+    assert capsys.readouterr()[0] == '[INFO] First.\n[INFO] Second.\n'
+
+
+def test_traceback_follows_earlier_lines(tmpdir):
+    filepath = str(tmpdir.join('Failing.py'))
+    with open(filepath, 'w') as script_file:
+        script_file.write('import nzb\nnzb.log_info("Before.")\ntry:\n    raise ValueError("Broken")\n'
+            'except ValueError:\n    nzb.log_traceback()\n')
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(nzb.__file__), PYTHONDONTWRITEBYTECODE='1')
+    process = subprocess.Popen([sys.executable, filepath], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+
+    assert output.startswith('[INFO] Before.\nTraceback')
+    assert output.rstrip().endswith('ValueError: Broken')
+
+
+def test_moving_a_file_writes_the_lines_before_it(tempdir, tmpdir, capsys, monkeypatch):
+    source = str(tmpdir.join('source.mkv'))
+    with open(source, 'w') as source_file:
+        source_file.write('data')
+
+    rename = os.rename
+    written = []
+
+    def cross_device_rename(old, new):
+        if old == source:
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        rename(old, new)
+
+    def copy_file(old, new, verify=True):
+        written.append(capsys.readouterr()[0])
+        shutil.copyfile(old, new)
+        return 'copy'
+
+    monkeypatch.setattr(os, 'rename', cross_device_rename)
+    monkeypatch.setattr(nzb, 'copy_file', copy_file)
+
+    nzb.log_detail('Moving source.mkv.')
+    assert nzb.move_file(source, str(tmpdir.join('target.mkv'))) == 'copy'
+
+    # The line was out before the copy started.
+    assert written == ['[DETAIL] Moving source.mkv.\n']
@@ -0,0 +1,105 @@
+import os
+import subprocess
+
+import pytest
+
+import nzb
+import nzbserver
+
+
+ARTICLES=['part%s@example' % index for index in range(100)]
+
+
+@pytest.fixture
+def news():
+    server = nzbserver.start_news(articles=ARTICLES[:80], latency=0.05)
+
+    yield server
+
+    server.stop()
+
+
+def get_server(news, **kwargs):
+    server = nzb.get_nntp_server('127.0.0.1:%s' % news.port)
+    server.update(kwargs)
+    return server
+
+
+def test_articles_are_checked_with_pipelined_stat(news):
+    result = nzb.check_nntp_articles(get_server(news), ARTICLES, connections=4)
+
+    assert result == { 'checked' : 100, 'found' : 80 }
+    assert news.get_counters()['STAT'] == 100
+    assert news.peak == 4
+
+
+def test_connections_are_capped_at_the_server_limit(news):
+    result = nzb.check_nntp_articles(get_server(news, connections=1), ARTICLES, connections=4)
+
+    assert result == { 'checked' : 100, 'found' : 80 }
+    assert news.peak == 1
+
+
+def test_server_connections_come_from_the_options(monkeypatch):
+    monkeypatch.setenv('NZBOP_SERVER1_HOST', 'news.example.com')
+    monkeypatch.setenv('NZBOP_SERVER1_PORT', '563')
+    monkeypatch.setenv('NZBOP_SERVER1_CONNECTIONS', '3')
+    monkeypatch.setenv('NZBOP_SERVER1_ENCRYPTION', 'yes')
+
+    server = nzb.get_nntp_server()
+
+    assert server['connections'] == 3
+    assert server['encryption'] and server['verify']
+
+
+def test_login_is_required():
+    news = nzbserver.start_news(articles=ARTICLES, username='user', password='secret')
+
+    try:
+        server = get_server(news, username='user', password='wrong')
+        with pytest.raises(IOError):
+            nzb.check_nntp_articles(server, ARTICLES, connections=1)
+
+        server['password'] = 'secret'
+        assert nzb.check_nntp_articles(server, ARTICLES, connections=1)['found'] == 100
+    finally:
+        news.stop()
+
+
+@pytest.fixture
+def certfile(tmpdir):
+    certfile = str(tmpdir.join('news.pem'))
+
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=localhost', '-keyout', certfile, '-out', certfile],
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip('openssl is not available.')
+
+    return certfile
+
+
+def test_certificate_is_verified(certfile, monkeypatch):
+    news = nzbserver.start_news(articles=ARTICLES, certfile=certfile)
+
+    try:
+        server = nzb.get_nntp_server('localhost:%s' % news.port)
+        server['encryption'] = True
+
+        # Self-signed, so only trusted once it's in the CertStore.
+        with pytest.raises(IOError):
+            nzb.check_nntp_articles(server, ARTICLES, connections=1)
+
+        monkeypatch.setenv('NZBOP_CERTSTORE', certfile)
+        assert nzb.check_nntp_articles(server, ARTICLES, connections=1)['found'] == 100
+
+        # The certificate is for localhost, not the address.
+        server['host'] = '127.0.0.1'
+        with pytest.raises(IOError):
+            nzb.check_nntp_articles(server, ARTICLES, connections=1)
+
+        server['verify'] = False
+        assert nzb.check_nntp_articles(server, ARTICLES, connections=1)['found'] == 100
+    finally:
+        news.stop()
@@ -0,0 +1,89 @@
+import json
+import os
+
+import nzb
+import nzbreplay
+import nzbserver
+
+
+def get_post_processing_env(nzbid):
+    return {
+        'NZBPP_NZBID' : str(nzbid),
+        'NZBPP_NZBNAME' : 'Some.Release',
+        'NZBPP_DIRECTORY' : '/downloads/Some.Release',
+        'NZBPP_CATEGORY' : '',
+        'NZBPP_STATUS' : 'FAILURE/HEALTH',
+        'NZBPP_TOTALSTATUS' : 'FAILURE',
+    }
+
+
+def test_requeue_succeeds_without_faults(server, run_script):
+    server.nzbget.add_history(5, 'Some.Release')
+
+    exit_code, output = run_script('HealthCheck', get_post_processing_env(5))
+
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+    assert server.nzbget.groups[5]['Status'] == 'QUEUED'
+
+
+def test_requeue_fails_on_injected_fault(server, run_script):
+    server.nzbget.add_history(5, 'Some.Release')
+    server.faults['editqueue'] = 1.0
+
+    exit_code, output = run_script('HealthCheck', get_post_processing_env(5))
+
+    assert exit_code == nzb.PROCESS_FAIL_PROXY, output
+    assert 'Failed to pause' in output
+    assert server.get_counters()['faults'] >= 1
+    assert 5 not in server.nzbget.groups
+
+
+def test_dropped_connections_are_retried(server, run_script):
+    server.random.seed(1)
+    server.drop_rate = 0.3
+    server.nzbget.add_history(5, 'Some.Release')
+
+    exit_code, output = run_script('HealthCheck', get_post_processing_env(5))
+
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+    assert server.nzbget.groups[5]['Status'] == 'QUEUED'
+
+
+def test_errors_on_every_request_fail_the_script(server, run_script):
+    server.error_rate = 1.0
+    server.nzbget.add_history(5, 'Some.Release')
+
+    exit_code, output = run_script('HealthCheck', get_post_processing_env(5))
+
+    assert exit_code == nzb.PROCESS_ERROR, output
+    assert server.get_counters()['errors'] >= 3
+
+
+def test_replay_reports_exit_codes_under_faults(tempdir):
+    record = {
+        'script' : 'HealthCheck',
+        'event' : 'POST_PROCESSING',
+        'argv' : ['HealthCheck.py'],
+        'env' : dict(get_post_processing_env(6), NZBOP_VERSION='21.0'),
+        'exit_code' : nzb.PROCESS_SUCCESS,
+    }
+    tracepath = os.path.join(tempdir, 'trace.jsonl')
+    with open(tracepath, 'w') as trace_file:
+        trace_file.write(json.dumps(record) + '\n')
+        trace_file.write('{"cut short\n')
+
+    records = nzbreplay.read_trace(tracepath)
+    assert len(records) == 1
+
+    server = nzbserver.start(faults={ 'editqueue' : 1.0 })
+    try:
+        server.nzbget.add_history(6, 'Some.Release')
+        server.nzbget.populate(groups=50, files=5, history=50, seed=1)
+
+        results = nzbreplay.replay(records, None, server, tempdir, os.path.join(tempdir, 'downloads'), repeat=2)
+    finally:
+        server.stop()
+
+    assert [result['exit_code'] for result in results] == [nzb.PROCESS_FAIL_PROXY] * 2
+    assert all(result['recorded_exit_code'] == nzb.PROCESS_SUCCESS for result in results)
+    assert all(result['calls'].get('editqueue') for result in results)
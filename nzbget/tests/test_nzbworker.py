@@ -0,0 +1,158 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import nzb
+
+
+def test_reset_state_reads_environment_again(tempdir, monkeypatch):
+    nzb.SNAPSHOTS['groups'] = { 'timestamp' : 0, 'items' : [], 'index' : {} }
+    monkeypatch.setenv('NZBOP_CONTROLPORT', '16789')
+
+    nzb.reset_state()
+
+    assert nzb.NZBGET_PORT == '16789'
+    assert nzb.SNAPSHOTS == {}
+    assert nzb.RPC_CONNECTION is None
+
+
+def test_locks_are_owned_by_event(tempdir):
+    assert nzb.lock_create('Test')
+
+    # The next event in the same process must not get the lock for free.
+    first = nzb.get_lock_owner()
+    nzb.LOCK_OWNER['owner'] = None
+    assert nzb.get_lock_owner() != first
+    assert not nzb.lock_create('Test')
+
+    nzb.LOCK_OWNER['owner'] = first
+    nzb.lock_release_owned()
+
+    nzb.LOCK_OWNER['owner'] = None
+    assert nzb.lock_create('Test')
+
+
+def test_lock_of_exited_process_is_taken_over(tempdir):
+    with nzb.store_transaction() as store:
+        store.execute('INSERT INTO locks (name, owner, acquired, expires) VALUES (?, ?, ?, ?)',
+            ('Test', '999999999-abc', 0, 1e12))
+
+    assert nzb.lock_create('Test')
+
+
+# Resident worker
+##############################################################################
+
+EVENT_SCRIPT = '''
+import os
+import sys
+import time
+
+sys.path.insert(0, %r)
+
+import nzbworker
+nzbworker.forward(__file__)
+
+time.sleep(float(sys.argv[1]))
+print('[INFO] Resident: %%s' %% nzbworker.RESIDENT)
+sys.stderr.write('Finished %%s.\\n' %% sys.argv[1])
+sys.exit(93)
+'''
+
+
+@pytest.fixture
+def worker(tempdir):
+    """
+    Starts a resident worker for the test's TempDir.
+    """
+    import nzbworker
+
+    process = subprocess.Popen([sys.executable, nzbworker.__file__.replace('.pyc', '.py'), 'start'],
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
+
+    path = nzbworker.get_socket_path()
+    deadline = time.time() + 10
+    while not os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.05)
+
+    yield process
+
+    nzbworker.stop()
+    process.wait()
+
+
+def start_event(tempdir, seconds, resident='Enabled'):
+    filepath = os.path.join(tempdir, 'Event.py')
+    if not os.path.exists(filepath):
+        with open(filepath, 'w') as script_file:
+            script_file.write(EVENT_SCRIPT % os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    env = dict(os.environ, NZBPO_RESIDENTWORKER=resident, PYTHONDONTWRITEBYTECODE='1')
+    return subprocess.Popen([sys.executable, filepath, str(seconds)], env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def test_worker_relays_output_and_exit_code(tempdir, worker):
+    process = start_event(tempdir, 0)
+    output, error = process.communicate()
+
+    assert process.returncode == 93
+    assert output == '[INFO] Resident: True\n'
+    assert error == 'Finished 0.\n'
+
+
+def test_long_event_does_not_hold_up_the_next(tempdir, worker):
+    slow = start_event(tempdir, 3)
+    time.sleep(0.5)
+
+    start = time.time()
+    fast = start_event(tempdir, 0)
+    output, error = fast.communicate()
+
+    assert fast.returncode == 93
+    assert output == '[INFO] Resident: True\n'
+    assert time.time() - start < 2
+
+    output, error = slow.communicate()
+    assert slow.returncode == 93
+    assert output == '[INFO] Resident: True\n'
+
+
+def test_event_runs_in_process_when_worker_does_not_answer(tempdir, monkeypatch):
+    import nzbworker
+
+    # A socket that is listening but never takes the event.
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(nzbworker.get_socket_path())
+    server.listen(1)
+
+    monkeypatch.setenv('NZBPO_RESIDENTWORKER', 'Enabled')
+    monkeypatch.setattr(nzbworker, 'WORKER_START_TIMEOUT', 0.2)
+
+    try:
+        start = time.time()
+        assert nzbworker.forward('Event.py') is None
+        assert time.time() - start < 1
+    finally:
+        server.close()
+
+
+def test_script_runs_through_worker(server, run_script, worker):
+    server.nzbget.add_history(5, 'Some.Release')
+
+    exit_code, output = run_script('HealthCheck', {
+        'NZBPP_NZBID' : '5',
+        'NZBPP_NZBNAME' : 'Some.Release',
+        'NZBPP_DIRECTORY' : '/downloads/Some.Release',
+        'NZBPP_CATEGORY' : '',
+        'NZBPP_STATUS' : 'FAILURE/HEALTH',
+        'NZBPP_TOTALSTATUS' : 'FAILURE',
+    }, ResidentWorker='Enabled')
+
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+    assert '[WARNING] Pausing Some.Release' in output
+    assert server.nzbget.groups[5]['Status'] == 'QUEUED'
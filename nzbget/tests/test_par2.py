@@ -0,0 +1,146 @@
+import hashlib
+import struct
+
+import nzb
+
+
+RECOVERY_SET='\x01' * 16
+
+
+def packet(packet_type, body):
+    body += '\x00' * (-len(body) % 4)
+    checksum = hashlib.md5(RECOVERY_SET + packet_type + body).digest()
+    return nzb.PAR2_HEADER.pack(nzb.PAR2_MAGIC, nzb.PAR2_HEADER.size + len(body), checksum, RECOVERY_SET, packet_type) + body
+
+
+def main_packet(slice_size, fileids):
+    return packet(nzb.PAR2_PACKET_MAIN, struct.pack('<QI', slice_size, len(fileids)) + ''.join(fileids))
+
+
+def file_packet(fileid, filename, size):
+    body = struct.pack('<16s16s16sQ', fileid, hashlib.md5(filename).digest(), hashlib.md5(filename[:4]).digest(), size)
+    return packet(nzb.PAR2_PACKET_FILE, body + filename)
+
+
+def recovery_packet(exponent, slice_size):
+    return packet(nzb.PAR2_PACKET_RECOVERY, struct.pack('<I', exponent) + '\x00' * slice_size)
+
+
+def write(tmpdir, data):
+    filepath = str(tmpdir.join('Some.Release.vol00+02.par2'))
+    with open(filepath, 'wb') as par2_file:
+        par2_file.write(data)
+    return filepath
+
+
+def get_volume():
+    fileids = ['\xaa' * 16, '\xbb' * 16]
+    return [
+        main_packet(64, fileids),
+        file_packet(fileids[0], 'Some.Release.part01.rar', 1000),
+        file_packet(fileids[1], 'Some.Release.part02.rar', 500),
+        recovery_packet(0, 64),
+        recovery_packet(1, 64),
+    ]
+
+
+def test_counts_main_file_and_recovery_packets(tmpdir):
+    info = nzb.get_par2_info(write(tmpdir, ''.join(get_volume())))
+
+    assert info['slice_size'] == 64
+    assert info['blocks'] == 2
+    assert sorted(item['filename'] for item in info['files'].values()) == ['Some.Release.part01.rar', 'Some.Release.part02.rar']
+    assert info['files']['aa' * 16]['size'] == 1000
+    assert info['files']['aa' * 16]['md5'] == hashlib.md5('Some.Release.part01.rar').hexdigest()
+
+
+def test_resyncs_past_garbage(tmpdir):
+    packets = get_volume()
+    # A missing article leaves junk where part of the volume should be, and
+    # a damaged packet fails its checksum.
+    damaged = packets[2][:-8] + 'XXXXXXXX'
+    data = 'junk' * 5 + packets[0] + '\x00PAR2' * 7 + packets[1] + damaged + 'PAR2\x00PK' + packets[3] + packets[4]
+
+    info = nzb.get_par2_info(write(tmpdir, data))
+
+    assert info['slice_size'] == 64
+    assert info['blocks'] == 2
+    assert [item['filename'] for item in info['files'].values()] == ['Some.Release.part01.rar']
+
+
+def test_skips_truncated_final_packet(tmpdir):
+    data = ''.join(get_volume())
+
+    info = nzb.get_par2_info(write(tmpdir, data[:-20]))
+
+    assert info['blocks'] == 1
+    assert len(info['files']) == 2
+
+
+def test_finds_signature_split_across_reads(tmpdir, monkeypatch):
+    monkeypatch.setattr(nzb, 'PAR2_SCAN_CHUNK', 16)
+    filepath = write(tmpdir, 'x' * 13 + nzb.PAR2_MAGIC + 'x' * 20)
+
+    with open(filepath, 'rb') as handle:
+        assert nzb.find_par2_packet(handle, 1) == 13
+        assert nzb.find_par2_packet(handle, 14) is None
+
+
+# Repair budget
+##############################################################################
+
+def get_group(data_size, par2_size, failed, health=None):
+    # One article per byte keeps the failed bytes easy to follow.
+    size = data_size + par2_size
+    group = { 'FileSizeLo' : size, 'FileSizeHi' : 0, 'TotalArticles' : size, 'FailedArticles' : failed }
+    if health is not None:
+        group['Health'] = health
+    return group
+
+
+def get_item(filename, size):
+    return { 'Filename' : filename, 'FileSizeLo' : size, 'FileSizeHi' : 0 }
+
+
+def test_budget_without_par2_is_skipped():
+    budget = nzb.get_repair_budget(get_group(1000, 0, 1), [get_item('Some.Release.part01.rar', 1000)])
+
+    assert budget['possible'] is None
+
+
+def test_budget_with_only_the_index():
+    budget = nzb.get_repair_budget(get_group(1000, 40, 1), [get_item('Some.Release.par2', 40)])
+
+    assert budget['recovery'] == 0
+    assert budget['possible'] is False
+
+
+def test_budget_from_queued_volumes():
+    filelist = [get_item('Some.Release.par2', 40), get_item('Some.Release.vol00+02.par2', 200)]
+
+    budget = nzb.get_repair_budget(get_group(1000, 240, 150), filelist)
+    assert (budget['failed'], budget['recovery'], budget['blocks']) == (150, 200, 2)
+    assert budget['possible'] is True
+
+    assert nzb.get_repair_budget(get_group(1000, 240, 250), filelist)['possible'] is False
+
+
+def test_budget_subtracts_failed_recovery_blocks(tmpdir):
+    index = get_volume()[:3]
+    tmpdir.join('Some.Release.par2').write(''.join(index), 'wb')
+    index_size = tmpdir.join('Some.Release.par2').size()
+
+    # 400 bytes of volumes hold 6 blocks of 64 bytes, and 60 of the 600
+    # bytes of data failed, so Health is 900. The other 250 failed bytes
+    # were in the volumes, leaving 384 * 150 / 400 = 144 recovery bytes.
+    filelist = [get_item('Some.Release.vol00+06.par2', 400)]
+    group = get_group(600, 400 + index_size, 310, health=900)
+
+    budget = nzb.get_repair_budget(group, filelist, str(tmpdir))
+
+    assert (budget['failed'], budget['recovery'], budget['blocks']) == (60, 144, 6)
+    assert budget['possible'] is True
+
+    # Losing more of the volumes leaves too few blocks.
+    group = get_group(600, 400 + index_size, 400, health=900)
+    assert nzb.get_repair_budget(group, filelist, str(tmpdir))['possible'] is False
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+import nzb
+
+
+@pytest.fixture
+def profiling(tempdir, monkeypatch):
+    """
+    Turns on ScriptState=Profile for the test, with no timings recorded yet.
+    """
+    monkeypatch.setenv('NZBPO_ScriptState', 'Profile')
+    monkeypatch.setenv('NZBPO_SCRIPTSTATE', 'Profile')
+    nzb.profile_reset()
+
+
+def read_stats():
+    with open(os.path.join(nzb.get_script_tempfolder(), nzb.PROFILE_FILENAME), 'r') as stats_file:
+        return json.load(stats_file)
+
+
+def test_percentiles_are_saved(profiling):
+    for seconds in range(1, 11):
+        nzb.profile_record('subprocess:unrar', seconds / 10.0)
+    nzb.save_profile('Rejector-FILE_DOWNLOADED')
+
+    entry = read_stats()['Rejector-FILE_DOWNLOADED']['subprocess:unrar']
+
+    assert entry['count'] == 10
+    assert (entry['p50'], entry['p90'], entry['p99'], entry['max']) == (0.5, 0.9, 1.0, 1.0)
+
+
+def test_samples_are_kept_across_runs(profiling, monkeypatch):
+    monkeypatch.setattr(nzb, 'PROFILE_SAMPLES', 4)
+
+    for seconds in [5.0, 1.0, 2.0]:
+        nzb.profile_record('options', seconds)
+        nzb.save_profile('FileMover-SCHEDULED')
+
+    nzb.profile_record('options', 3.0)
+    nzb.profile_record('options', 4.0)
+    nzb.save_profile('FileMover-SCHEDULED')
+
+    entry = read_stats()['FileMover-SCHEDULED']['options']
+
+    # Only the latest samples are kept, but every one is counted.
+    assert entry['count'] == 5
+    assert entry['samples'] == [1.0, 2.0, 3.0, 4.0]
+    assert (entry['p50'], entry['max']) == (2.0, 4.0)
+
+
+def test_handler_that_exits_is_profiled(profiling):
+    def handler():
+        nzb.profile_record('subprocess:unrar', 0.25)
+        raise SystemExit(nzb.PROCESS_SUCCESS)
+
+    with pytest.raises(SystemExit):
+        nzb.run_profiled('SCHEDULED', handler)
+
+    stats = read_stats()['%s-SCHEDULED' % nzb.get_script_name()]
+
+    assert set(['options', 'handler', 'handler_cpu', 'subprocess:unrar']) <= set(stats)
+    assert stats['subprocess:unrar']['p99'] == 0.25
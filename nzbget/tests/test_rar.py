@@ -0,0 +1,244 @@
+import os
+import stat
+import struct
+import zlib
+
+import nzb
+
+
+# RAR 4
+##############################################################################
+
+def rar4_block(block_type, flags, header, data=''):
+    base = struct.pack('<BHH', block_type, flags, 7 + len(header))
+    covered = header[:6] if block_type == nzb.RAR4_BLOCK_MAIN else header
+    crc = zlib.crc32(base + covered) & 0xffff
+    return struct.pack('<H', crc) + base + header + data
+
+
+def rar4_file(filename, data='', flags=0):
+    header = struct.pack('<IIBIIBBHI', len(data), len(data), 2, 0, 0, 29, 0x30, len(filename), 0x20) + filename
+    return rar4_block(nzb.RAR4_BLOCK_FILE, flags | nzb.RAR4_LONG_BLOCK, header, data)
+
+
+def rar4_archive(files, main_flags=0):
+    blocks = [nzb.RAR4_SIGNATURE, rar4_block(nzb.RAR4_BLOCK_MAIN, main_flags, '\x00' * 6)]
+    blocks.extend(files)
+    blocks.append(rar4_block(nzb.RAR4_BLOCK_END, 0, ''))
+    return ''.join(blocks)
+
+
+# RAR 5
+##############################################################################
+
+def vint(value):
+    data = ''
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data += chr(byte | 0x80)
+        else:
+            return data + chr(byte)
+
+
+def rar5_block(header_type, fields, extra='', data=''):
+    flags = 0
+    sizes = ''
+
+    if extra:
+        flags |= nzb.RAR5_FLAG_EXTRA
+        sizes += vint(len(extra))
+    if data:
+        flags |= nzb.RAR5_FLAG_DATA
+        sizes += vint(len(data))
+
+    header = vint(header_type) + vint(flags) + sizes + fields + extra
+    header = vint(len(header)) + header
+    return struct.pack('<I', zlib.crc32(header) & 0xffffffff) + header + data
+
+
+def rar5_file(filename, data='', encrypted=False):
+    fields = vint(0) + vint(len(data)) + vint(0x20) + vint(0) + vint(0) + vint(len(filename)) + filename
+    extra = ''
+    if encrypted:
+        record = vint(nzb.RAR5_EXTRA_ENCRYPTION) + '\x00' * 16
+        extra = vint(len(record)) + record
+    return rar5_block(nzb.RAR5_HEADER_FILE, fields, extra=extra, data=data)
+
+
+def rar5_archive(files, encrypted_headers=False):
+    blocks = [nzb.RAR5_SIGNATURE]
+    if encrypted_headers:
+        blocks.append(rar5_block(nzb.RAR5_HEADER_ENCRYPTION, vint(0) + vint(0) + '\x00' * 16))
+        blocks.append('\xff' * 64)
+    else:
+        blocks.append(rar5_block(nzb.RAR5_HEADER_MAIN, vint(0)))
+        blocks.extend(files)
+        blocks.append(rar5_block(nzb.RAR5_HEADER_END, vint(0)))
+    return ''.join(blocks)
+
+
+def write(tmpdir, filename, data):
+    filepath = str(tmpdir.join(filename))
+    with open(filepath, 'wb') as rar_file:
+        rar_file.write(data)
+    return filepath
+
+
+def write_unrar(tmpdir, monkeypatch, listing, output):
+    """
+    Puts a stand-in unrar in place, which prints the listing for 'vb' and
+    the output for anything else.
+    """
+    filepath = str(tmpdir.join('unrar'))
+    with open(filepath, 'w') as script:
+        script.write('#!/bin/sh\nif [ "$1" = "vb" ]; then printf "%s"; else printf "%s"; fi\n' % (listing, output))
+    os.chmod(filepath, stat.S_IRWXU)
+    monkeypatch.setenv('NZBOP_UNRARCMD', filepath)
+
+
+# Tests
+##############################################################################
+
+def test_rar4_entries(tmpdir):
+    filepath = write(tmpdir, 'Some.Release.rar', rar4_archive([
+        rar4_file('movie.mkv', 'x' * 100),
+        rar4_file('sample\\sample.mkv', 'y' * 10),
+    ]))
+
+    info = nzb.get_rar_info(filepath)
+
+    assert info['format'] == 4
+    assert [entry['filename'] for entry in info['entries']] == ['movie.mkv', 'sample/sample.mkv']
+    assert [entry['size'] for entry in info['entries']] == [100, 10]
+    assert not info['truncated'] and not info['corrupt']
+    assert info['last_volume'] is True
+    assert not nzb.is_rar_protected(filepath)
+
+
+def test_rar4_encrypted_file(tmpdir):
+    filepath = write(tmpdir, 'Some.Release.rar', rar4_archive([
+        rar4_file('readme.txt', 'x'),
+        rar4_file('movie.mkv', 'x' * 100, nzb.RAR4_FILE_PASSWORD),
+    ]))
+
+    info = nzb.get_rar_info(filepath)
+
+    assert [entry['encrypted'] for entry in info['entries']] == [False, True]
+    assert nzb.is_rar_protected(filepath)
+
+
+def test_rar4_encrypted_headers(tmpdir):
+    filepath = write(tmpdir, 'Some.Release.rar', rar4_archive(['\xff' * 64], nzb.RAR4_MAIN_PASSWORD))
+
+    info = nzb.get_rar_info(filepath)
+
+    assert info['encrypted_headers']
+    assert info['entries'] == []
+    assert nzb.is_rar_protected(filepath)
+
+
+def test_rar4_truncated_volume(tmpdir):
+    data = rar4_archive([rar4_file('first.mkv', 'x' * 100), rar4_file('second.mkv', 'y' * 100)])
+    filepath = write(tmpdir, 'Some.Release.rar', data[:data.index('second.mkv') - 10])
+
+    info = nzb.get_rar_info(filepath)
+
+    assert [entry['filename'] for entry in info['entries']] == ['first.mkv']
+    assert info['truncated'] and not info['corrupt']
+    assert info['last_volume'] is None
+
+
+def test_rar4_sfx_stub(tmpdir):
+    data = 'MZ' + '\x00' * 1000 + rar4_archive([rar4_file('movie.mkv', 'x')])
+
+    info = nzb.get_rar_info(write(tmpdir, 'setup.exe', data))
+    assert [entry['filename'] for entry in info['entries']] == ['movie.mkv']
+
+    # Only names that could be self-extracting are searched.
+    assert nzb.get_rar_info(write(tmpdir, 'movie.bin', data)) is None
+
+
+def test_rar4_crc_mismatch_falls_back_to_unrar(tmpdir, monkeypatch):
+    data = bytearray(rar4_archive([rar4_file('movie.mkv', 'x')]))
+    position = str(data).index('movie.mkv')
+    data[position] = ord('M')
+    filepath = write(tmpdir, 'Some.Release.rar', str(data))
+
+    info = nzb.get_rar_info(filepath)
+    assert info['corrupt'] and info['entries'] == []
+
+    write_unrar(tmpdir, monkeypatch, 'Movie.mkv\\n', 'The specified password is incorrect.')
+
+    assert nzb.get_rar_filelist(filepath) == ['Movie.mkv']
+    assert nzb.is_rar_protected(filepath)
+
+
+def test_rar5_entries(tmpdir):
+    filepath = write(tmpdir, 'Some.Release.rar', rar5_archive([
+        rar5_file('movie.mkv', 'x' * 300),
+        rar5_file('sample/sample.mkv', 'y' * 10),
+    ]))
+
+    info = nzb.get_rar_info(filepath)
+
+    assert info['format'] == 5
+    assert [entry['filename'] for entry in info['entries']] == ['movie.mkv', 'sample/sample.mkv']
+    assert [entry['size'] for entry in info['entries']] == [300, 10]
+    assert not info['truncated'] and not info['corrupt']
+    assert info['last_volume'] is True
+    assert not nzb.is_rar_protected(filepath)
+
+
+def test_rar5_encrypted_file(tmpdir):
+    filepath = write(tmpdir, 'Some.Release.rar', rar5_archive([
+        rar5_file('readme.txt', 'x'),
+        rar5_file('movie.mkv', 'x' * 100, encrypted=True),
+    ]))
+
+    info = nzb.get_rar_info(filepath)
+
+    assert [entry['encrypted'] for entry in info['entries']] == [False, True]
+    assert nzb.is_rar_protected(filepath)
+
+
+def test_rar5_encrypted_headers(tmpdir):
+    filepath = write(tmpdir, 'Some.Release.rar', rar5_archive([], encrypted_headers=True))
+
+    info = nzb.get_rar_info(filepath)
+
+    assert info['encrypted_headers']
+    assert nzb.is_rar_protected(filepath)
+
+
+def test_rar5_truncated_volume(tmpdir):
+    data = rar5_archive([rar5_file('first.mkv', 'x' * 100), rar5_file('second.mkv', 'y' * 100)])
+    filepath = write(tmpdir, 'Some.Release.rar', data[:data.index('second.mkv') - 5])
+
+    info = nzb.get_rar_info(filepath)
+
+    assert [entry['filename'] for entry in info['entries']] == ['first.mkv']
+    assert info['truncated'] and not info['corrupt']
+
+
+def test_rar5_sfx_stub(tmpdir):
+    data = 'MZ' + '\x00' * 1000 + rar5_archive([rar5_file('movie.mkv', 'x')])
+
+    info = nzb.get_rar_info(write(tmpdir, 'setup.exe', data))
+
+    assert info['format'] == 5
+    assert [entry['filename'] for entry in info['entries']] == ['movie.mkv']
+
+
+def test_rar5_crc_mismatch_falls_back_to_unrar(tmpdir, monkeypatch):
+    data = rar5_archive([rar5_file('movie.mkv', 'x')])
+    filepath = write(tmpdir, 'Some.Release.rar', data.replace('movie.mkv', 'Movie.mkv'))
+
+    info = nzb.get_rar_info(filepath)
+    assert info['corrupt'] and info['entries'] == []
+
+    write_unrar(tmpdir, monkeypatch, 'Movie.mkv\\n', 'Everything is OK')
+
+    assert nzb.get_rar_filelist(filepath) == ['Movie.mkv']
+    assert not nzb.is_rar_protected(filepath)
@@ -0,0 +1,159 @@
+import os
+import struct
+import zlib
+
+import pytest
+
+import nzb
+
+
+def write_rar4_volume(filepath, number, last, filenames):
+    """
+    Writes the headers of one volume of a RAR 4 set, with empty entries.
+    """
+    def block(block_type, flags, header):
+        base = struct.pack('<BHH', block_type, flags, 7 + len(header))
+        crc = zlib.crc32(base + header) & 0xffff
+        return struct.pack('<H', crc) + base + header
+
+    flags = nzb.RAR4_MAIN_VOLUME | (nzb.RAR4_MAIN_FIRSTVOLUME if number == 0 else 0)
+    data = nzb.RAR4_SIGNATURE + block(nzb.RAR4_BLOCK_MAIN, flags, '\x00' * 6)
+
+    for filename in filenames:
+        header = struct.pack('<IIBIIBBHI', 0, 0, 2, 0, 0, 29, 0x30, len(filename), 0x20) + filename
+        data += block(nzb.RAR4_BLOCK_FILE, nzb.RAR4_LONG_BLOCK, header)
+
+    flags = nzb.RAR4_END_VOLNUMBER | (0 if last else nzb.RAR4_END_NEXT_VOLUME)
+    data += block(nzb.RAR4_BLOCK_END, flags, struct.pack('<H', number))
+
+    with open(filepath, 'wb') as handle:
+        handle.write(data)
+
+
+def test_middle_volume_is_inspected_after_last(tempdir, server, run_script):
+    directory = os.path.join(tempdir, 'Some.Release')
+    os.makedirs(directory)
+    server.nzbget.add_group(7, 'Some.Release', directory)
+
+    env = {
+        'NZBNA_EVENT' : 'FILE_DOWNLOADED',
+        'NZBNA_NZBID' : '7',
+        'NZBNA_NZBNAME' : 'Some.Release',
+        'NZBNA_DIRECTORY' : directory,
+        'NZBNA_CATEGORY' : '',
+    }
+
+    # The download plan fetches the first and last volumes before the rest.
+    write_rar4_volume(os.path.join(directory, 'release.part1.rar'), 0, False, ['movie.mkv'])
+    write_rar4_volume(os.path.join(directory, 'release.part3.rar'), 2, True, ['movie.mkv'])
+
+    exit_code, output = run_script('Rejector', env, FakeBlacklist='.exe', RejectAction='Pause')
+    assert exit_code == nzb.PROCESS_SUCCESS, output
+
+    # The only file that gives the release away is in the middle volume.
+    write_rar4_volume(os.path.join(directory, 'release.part2.rar'), 1, False, ['movie.mkv', 'setup.exe'])
+
+    exit_code, output = run_script('Rejector', env, FakeBlacklist='.exe', RejectAction='Pause')
+    assert exit_code == nzb.PROCESS_ERROR, output
+    assert 'setup.exe' in output
+    assert server.nzbget.groups[7]['Status'] == 'PAUSED'
+
+
+def test_volume_that_fails_is_inspected_again(tempdir, server, monkeypatch, capsys):
+    import runpy
+    import nzbreplay
+
+    directory = os.path.join(tempdir, 'Some.Release')
+    os.makedirs(directory)
+    server.nzbget.add_group(8, 'Some.Release', directory)
+    write_rar4_volume(os.path.join(directory, 'release.rar'), 0, True, ['setup.exe'])
+
+    env = {
+        'NZBNA_EVENT' : 'FILE_DOWNLOADED',
+        'NZBNA_NZBID' : '8',
+        'NZBNA_NZBNAME' : 'Some.Release',
+        'NZBNA_DIRECTORY' : directory,
+        'NZBNA_CATEGORY' : '',
+        'NZBOP_CONTROLPORT' : str(server.port),
+    }
+    options = nzbreplay.get_script_defaults('Rejector')
+    options.update(FakeBlacklist='.exe', RejectAction='Pause')
+
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    for name, value in options.items():
+        monkeypatch.setenv('NZBPO_' + name, value)
+        monkeypatch.setenv('NZBPO_' + name.upper(), value)
+
+    def run():
+        nzb.reset_state()
+        try:
+            runpy.run_path(nzbreplay.get_script_path('Rejector'), run_name='__main__')
+        except SystemExit as e:
+            return e.code
+
+    def fail(filepath, info):
+        raise IOError('Timed out reading %s.' % filepath)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(nzb, 'iter_rar_entries', fail)
+        assert run() == nzb.PROCESS_SUCCESS
+
+    assert 'Timed out' in capsys.readouterr()[0]
+
+    assert run() == nzb.PROCESS_ERROR
+    assert server.nzbget.groups[8]['Status'] == 'PAUSED'
+
+
+def test_sweep_failing_before_the_first_volume_is_logged(tempdir, monkeypatch, capsys):
+    import runpy
+    import nzbreplay
+
+    for name, value in nzbreplay.get_script_defaults('Rejector').items():
+        monkeypatch.setenv('NZBPO_' + name, value)
+        monkeypatch.setenv('NZBPO_' + name.upper(), value)
+
+    # The script runs its main() when it's loaded, so sweep from inside its
+    # event instead, with the handlers it sets.
+    handlers = {}
+    results = []
+    task = { 'nzbid' : 9, 'directory' : tempdir, 'files' : None }
+
+    def execute():
+        results.append(handlers['SCHEDULED'].__globals__['sweep_archive'](task))
+
+    monkeypatch.setattr(nzb, 'set_handler', lambda event, callback: handlers.setdefault(event, callback))
+    monkeypatch.setattr(nzb, 'execute', execute)
+
+    with pytest.raises(SystemExit):
+        runpy.run_path(nzbreplay.get_script_path('Rejector'), run_name='__main__')
+
+    assert results == [(9, None)]
+
+    output, error = capsys.readouterr()
+    assert '[ERROR] Failed to inspect the files of NZB 9' in output
+    assert 'TypeError' in error
+
+
+def test_pool_threads_share_the_store_schema(tempdir, monkeypatch):
+    import threading
+
+    nzb.get_store()
+    # The schema is only run by the first connection to the database.
+    monkeypatch.setattr(nzb, 'STORE_SCHEMA', 'NOT SQL;')
+    errors = []
+
+    def open_store():
+        try:
+            nzb.get_store().execute('SELECT COUNT(*) FROM seen').fetchone()
+            nzb.store_close()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=open_store) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
@@ -0,0 +1,71 @@
+import xmlrpclib
+
+import nzb
+import nzbserver
+
+
+def get_client(server):
+    return xmlrpclib.ServerProxy('http://127.0.0.1:%s/xmlrpc' % server.port)
+
+
+def test_edits_with_the_same_command_are_merged(server):
+    for nzbid in [1, 2, 3]:
+        server.nzbget.add_group(nzbid, 'Release.%s' % nzbid)
+
+    batch = nzb.RpcBatch(get_client(server))
+    first = batch.editqueue('GroupPause', [1])
+    second = batch.editqueue('GroupPause', ['2'])
+    other = batch.editqueue('GroupPause', [3], offset=1)
+
+    assert len(batch) == 3
+    assert batch.execute() == [True, True, True]
+    assert (first, second, other) == (0, 1, 2)
+
+    counters = server.get_counters()
+    assert counters['system.multicall'] == 1
+    assert counters['editqueue'] == 2
+    assert [server.nzbget.groups[nzbid]['Status'] for nzbid in [1, 2, 3]] == ['PAUSED'] * 3
+
+
+def test_handles_map_to_their_own_results(server):
+    server.nzbget.add_group(1, 'Release.1', files=[('Release.1.rar', 100)])
+
+    batch = nzb.RpcBatch(get_client(server))
+    groups = batch.call('listgroups', 0)
+    pause = batch.editqueue('GroupPause', [1])
+    files = batch.call('listfiles', 0, 0, 1)
+    again = batch.editqueue('GroupPause', [1])
+    results = batch.execute()
+
+    assert [group['NZBID'] for group in results[groups]] == [1]
+    assert results[pause] is True and results[again] is True
+    assert [item['Filename'] for item in results[files]] == ['Release.1.rar']
+
+    # The batch starts over once it has been sent.
+    assert len(batch) == 0
+    assert batch.execute() == []
+
+
+def test_fault_inside_multicall_fails_only_that_call(server):
+    server.nzbget.add_group(1, 'Release.1')
+    server.faults['listfiles'] = 1.0
+
+    batch = nzb.RpcBatch(get_client(server))
+    files = batch.call('listfiles', 0, 0, 1)
+    pause = batch.editqueue('GroupPause', [1])
+    results = batch.execute()
+
+    assert isinstance(results[files], xmlrpclib.Fault)
+    assert results[files].faultCode == nzbserver.FAULT_INJECTED
+    assert results[pause] is True
+    assert server.nzbget.groups[1]['Status'] == 'PAUSED'
+
+
+def test_fault_in_a_single_call_is_returned(server):
+    server.faults['editqueue'] = 1.0
+
+    batch = nzb.RpcBatch(get_client(server))
+    pause = batch.editqueue('GroupPause', [1])
+
+    assert isinstance(batch.execute()[pause], xmlrpclib.Fault)
+    assert 'system.multicall' not in server.get_counters()
@@ -0,0 +1,30 @@
+import nzb
+
+
+def get_rule(kind, value, reason, group='pattern', exclude=False):
+    return { 'kind' : kind, 'value' : value, 'group' : group, 'reason' : reason, 'exclude' : exclude }
+
+
+def test_patterns_sharing_a_group_name():
+    matcher = nzb.compile_rules([
+        get_rule('pattern', r'(?P<word>sample)\.mkv$', 'Sample (%s).'),
+        get_rule('pattern', r'(?P<word>proof)\.jpg$', 'Proof (%s).'),
+        get_rule('pattern', r'\.url$', 'Link (%s).'),
+    ])
+
+    assert nzb.match_rules(matcher, 'movie.sample.mkv')['reason'] == 'Sample (%s).'
+    assert nzb.match_rules(matcher, 'movie.proof.jpg')['reason'] == 'Proof (%s).'
+    assert nzb.match_rules(matcher, 'Visit.url')['reason'] == 'Link (%s).'
+    assert nzb.match_rules(matcher, 'movie.mkv') is None
+
+
+def test_patterns_are_combined():
+    matcher = nzb.compile_rules([
+        get_rule('pattern', r'\.url$', 'Link (%s).'),
+        get_rule('pattern', r'password', 'Password (%s).'),
+        get_rule('extension', '.exe', 'Fake (%s).', group='fake'),
+    ])
+
+    assert len(matcher['patterns']) == 1
+    assert nzb.match_rules(matcher, 'password.txt')['reason'] == 'Password (%s).'
+    assert nzb.match_rules(matcher, 'setup.EXE')['reason'] == 'Fake (%s).'
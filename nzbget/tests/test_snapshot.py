@@ -0,0 +1,51 @@
+import os
+
+import nzb
+
+
+def get_fetch(calls):
+    def fetch():
+        calls.append(True)
+        return [{ 'NZBID' : 1, 'NZBName' : 'Some.Release' }]
+
+    return fetch
+
+
+def test_snapshot_is_reused_within_ttl(tempdir):
+    calls = []
+
+    nzb.get_snapshot('groups', get_fetch(calls), ttl=60)
+    nzb.get_snapshot('groups', get_fetch(calls), ttl=60)
+    assert len(calls) == 1
+
+    # Another script reads the shared file instead of fetching again.
+    nzb.SNAPSHOTS.clear()
+    snapshot = nzb.get_snapshot('groups', get_fetch(calls), ttl=60)
+    assert len(calls) == 1
+    assert snapshot['index'] == { '1' : [0] }
+
+    nzb.get_snapshot('groups', get_fetch(calls), ttl=0)
+    assert len(calls) == 2
+
+
+def test_invalidated_snapshot_is_fetched_again(tempdir):
+    calls = []
+
+    nzb.get_snapshot('history', get_fetch(calls), ttl=60)
+    nzb.invalidate_snapshot('history')
+
+    assert not os.path.exists(nzb.get_snapshot_filepath('history'))
+
+    nzb.get_snapshot('history', get_fetch(calls), ttl=60)
+    assert len(calls) == 2
+
+
+def test_deleting_nzb_state_removes_its_files_snapshot(tempdir):
+    nzb.get_snapshot('files-7', get_fetch([]), ttl=60)
+    nzb.get_snapshot('files-8', get_fetch([]), ttl=60)
+
+    nzb.delete_nzb_state(7, 'Rejector')
+
+    assert not os.path.exists(nzb.get_snapshot_filepath('files-7'))
+    assert 'files-7' not in nzb.SNAPSHOTS
+    assert os.path.exists(nzb.get_snapshot_filepath('files-8'))